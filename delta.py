@@ -1,21 +1,42 @@
+import os
+import sys
 import dash
 from dash import dcc
 from dash import html
 
+from delta_core.pages import PageRegistry, startup
+from delta_core.cache import figure_cache
+from delta_core.metrics import metrics
+from delta_core.store import store
+from delta_core.transport import compression
+
 # import projects as <trigramme>_lib
-from nrj_energies import energies as nrj_lib
-from wfr_fertilite_revenus import main as wfr_lib
-from fdc_deces import deces as fdc_lib
-from ndf_naissance_deces import naissance_deces as ndf_lib
+nrj_lib = startup.timed_import('nrj_energies.energies')
+wfr_lib = startup.timed_import('wfr_fertilite_revenus.main')
+fdc_lib = startup.timed_import('fdc_deces.deces')
+ndf_lib = startup.timed_import('ndf_naissance_deces.naissance_deces')
 
 # external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
 app = dash.Dash(__name__,  title="Delta", suppress_callback_exceptions=True) # , external_stylesheets=external_stylesheets)
 server = app.server
-wfr = wfr_lib.WorldPopulationStats(app)
-nrj = nrj_lib.Energies(app)
-fdc = fdc_lib.Deces(app)
-ndf = ndf_lib.Naissance(app)
+figure_cache.init_app(server)
+compression.init_app(server)  # avant metrics, qui voit donc la taille non compressée
+metrics.init_app(server)  # latence, taille et erreurs des callbacks sur /metrics
+
+# projects are built the first time their page is visited, callbacks are registered now
+pages = PageRegistry(app)
+wfr = pages.register('/wfr', wfr_lib.WorldPopulationStats)
+nrj = pages.register('/nrj', nrj_lib.Energies)
+fdc = pages.register('/fdc', fdc_lib.Deces)
+ndf = pages.register('/ndf', ndf_lib.Naissance)
+
+# with gunicorn --preload, load everything in the master so that workers share it
+if os.environ.get('DELTA_PRELOAD'):
+    store.preload()
+    pages.load_all()
+    store.freeze()
+print(startup, file=sys.stderr, flush=True)
 
 main_layout = html.Div([
     html.Div(className = "row",
@@ -59,14 +80,8 @@ app.layout = main_layout
 @app.callback(dash.dependencies.Output('page_content', 'children'),
               [dash.dependencies.Input('url', 'pathname')])
 def display_page(pathname):
-    if pathname == '/nrj':
-        return nrj.main_layout
-    elif pathname == '/wfr':
-        return wfr.main_layout
-    elif pathname == '/fdc':
-        return fdc.main_layout
-    elif pathname == '/ndf':
-        return ndf.main_layout
+    if pathname in pages:
+        return pages.layout(pathname)
     else:
         return home_page
 
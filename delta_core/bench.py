@@ -0,0 +1,334 @@
+"""Benchmark of the callbacks of every page, without a browser.
+
+Each project is instantiated on its own and its callbacks are called directly
+over a grid of inputs covering the page: every year and department selection
+for ndf, every price type, month and year for nrj, every mean for fdc and
+every country for wfr. The figure cache is disabled.
+
+For each callback the report gives p50/p99 latency (callback and JSON
+serialization of its figure, as in the worker), peak memory (tracemalloc
+on a sample of inputs), the size of the serialized figure and its size once
+gzipped, as sent to the browsers. Against a baseline it also gives the ratio
+of the latency and of the size. For the line figures it gives their points
+and traces and the share drawn with WebGL (see delta_core.figures), the
+browser rendering itself being out of reach of this bench.
+
+    python -m delta_core.bench --save        # write the baseline
+    python -m delta_core.bench               # compare with it, exit 1 on regression
+
+The run fails when a p50, p99, peak memory or payload exceeds the baseline by
+more than --threshold (25 % by default) plus a small absolute margin, or when
+a callback exceeds its budget in BUDGETS, with or without a baseline.
+"""
+import argparse
+import gzip
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+import flask
+import numpy as np
+from plotly.io.json import to_json_plotly
+
+from delta_core import figures
+
+BASELINE_FILE = 'bench_baseline.json'
+MEMORY_SAMPLES = 5
+# marges absolues sous lesquelles une différence n'est pas une régression
+MARGIN = {'p50_ms': 2, 'p99_ms': 5, 'peak_kb': 256, 'bytes': 1024, 'gzip_bytes': 1024, 'errors': 0}
+# limites absolues, vérifiées à chaque run : la carte des communes doit rester interactive
+BUDGETS = {
+    'Naissance.commune_map': {'p99_ms': 100, 'max_bytes': 150_000},
+    'Naissance.communes_geojson': {'p99_ms': 20, 'max_bytes': 1_000_000},
+    'Naissance.commune_selection': {'p99_ms': 20},
+}
+
+
+def deces_cases(page):
+    zooms = [None, {'xaxis.range[0]': '2003-06-15', 'xaxis.range[1]': '2003-09-15'},
+             {'xaxis.range': ['2019-09-01', '2021-09-01']}, {'xaxis.range[0]': '1985', 'xaxis.range[1]': '2005'}]
+    selections = [([0, 1], [0, 20], 'total'), ([0], [13, 20], 'total'), ([0, 1], [0, 20], 'sexe'),
+                  ([0, 1], [12, 20], 'age')]
+    for mean in [0, 1, 2]:
+        for relayout in zooms:
+            for selection in selections:
+                yield 'update_graph', (mean, relayout, *selection, None)
+
+
+def energies_cases(page):
+    for price_type in [0, 1, 2, 3, 4]:
+        for year in page.years:
+            for month in range(1, 13):
+                for xaxis_type in ['Linéaire', 'Logarithmique']:
+                    yield 'update_graph', (price_type, month, int(year), xaxis_type)
+
+
+def world_cases(page):
+    for country in sorted(page.df['Nom'].unique()):
+        hover = {'points': [{'hovertext': country}]}
+        for callback in ['update_income_timeseries', 'update_fertility_timeseries', 'update_pop_timeseries']:
+            yield callback, (hover,)
+
+
+def naissance_selections(page):
+    deps = sorted(page.dep_map)
+    rnd = random.Random(0)
+    yield None  # toute la France
+    for d in deps:
+        yield [d]
+    for several in [['75', '77', '78', '91', '92', '93', '94', '95'], ['69', '01', '38', '42'],
+                    sorted(rnd.sample(deps, 10)), sorted(rnd.sample(deps, 40))]:
+        yield several
+    yield deps  # les 96 sélectionnés un par un
+
+
+def naissance_cases(page):
+    from ndf_naissance_deces.naissance_deces import YEARS, ALL_YEARS
+    for year in YEARS + [ALL_YEARS]:
+        for deps in naissance_selections(page):
+            selected = None if deps is None else {'points': [{'location': d} for d in deps]}
+            yield 'map_figure', (None, selected, year)
+            yield 'map_patch', ('map.selectedData', None, selected, year)
+            deps = page.get_selected_department(selected)
+            for mode in ['Somme', 'Chacun']:
+                yield 'courbe_naissances_deces', (deps, ['Naissance', 'Décès'], mode, year)
+                yield 'ville_naissance', (deps, mode, year)
+                yield 'courbe_naissance', (deps, mode, ['Mère', 'Père'], year)
+                yield 'courbe_deces', (deps, mode, ['Femme', 'Homme', 'H + F', 'Moyenne H/F'], year)
+        yield 'map_patch', ('year.value', None, None, year)
+        for zoom in [4.42, 6, 8]:
+            yield 'map_patch', ('map.relayoutData', {'mapbox.center': {'lat': 45.76, 'lon': 4.84}, 'mapbox.zoom': zoom},
+                                None, year)
+    if page.communes is not None:  # sans les contours des communes, pas de drill-down
+        yield from commune_cases(page)
+
+
+def commune_cases(page):
+    from ndf_naissance_deces.naissance_deces import YEARS, ALL_YEARS
+    deps = sorted((d for d in page.dep_map if d in page.communes), key=lambda d: -len(page.communes.of_department(d)))
+    for dep in deps[:5] + deps[5::10]:  # les plus grands puis quelques autres
+        click = {'points': [{'location': dep}]}
+        x0, y0, x1, y1 = page.communes.bounds(dep)
+        xm, ym = (x0 + x1) / 2, (y0 + y1) / 2
+        codes = page.communes.codes[page.communes.of_department(dep)]
+        selections = [{'lassoPoints': {'mapbox': [[x0, y0], [x1, y0], [xm, y1], [x0, ym]]}},
+                      {'range': {'mapbox': [[x0, y1], [xm, ym]]}},
+                      {'points': [{'location': c} for c in codes[:20]]}]
+        yield 'communes_geojson', (dep,)
+        for year in YEARS + [ALL_YEARS]:
+            yield 'commune_map', (dep, year)
+            for selected in selections:
+                yield 'commune_selection', (selected, click, year)
+
+
+def projects():
+    from nrj_energies.energies import Energies
+    from wfr_fertilite_revenus.main import WorldPopulationStats
+    from fdc_deces.deces import Deces
+    from ndf_naissance_deces.naissance_deces import Naissance
+    return [(Deces, deces_cases), (Energies, energies_cases),
+            (WorldPopulationStats, world_cases), (Naissance, naissance_cases)]
+
+
+def payload_size(data):
+    """Size of the JSON of a figure, raw and gzipped."""
+    if isinstance(data, str):
+        data = data.encode()
+    return len(data), len(gzip.compress(data, 6))
+
+
+def serialize(result):
+    """What the worker sends for a result: the body of a Flask response, the JSON of anything else."""
+    if isinstance(result, flask.Response):
+        return result.get_data()
+    return to_json_plotly(result)
+
+
+def callback_outputs(callback):
+    """'id.property' of the outputs of a registered callback, one or several."""
+    output = callback['output']
+    return output.strip('.').split('...') if output.startswith('..') else [output]
+
+
+def round_trips(app, prop_id):
+    """Number of requests sent to the server when prop_id changes in the browser.
+
+    Every callback whose inputs change, directly or through the outputs of
+    other callbacks, runs once; the clientside ones send no request.
+    """
+    callbacks = app._callback_list
+    changed, fired = {prop_id}, set()
+    while True:
+        new = [i for i, cb in enumerate(callbacks)
+               if i not in fired and any(f"{x['id']}.{x['property']}" in changed for x in cb['inputs'])]
+        if not new:
+            break
+        for i in new:
+            fired.add(i)
+            changed.update(callback_outputs(callbacks[i]))
+    return sum(1 for i in fired if not callbacks[i]['clientside_function'])
+
+
+def interactions(app):
+    """round_trips of every input of the callbacks of the app."""
+    inputs = sorted({f"{x['id']}.{x['property']}" for cb in app._callback_list for x in cb['inputs']})
+    return {prop_id: round_trips(app, prop_id) for prop_id in inputs}
+
+
+def run(only=None, sample=None):
+    from delta_core.cache import figure_cache
+    figure_cache.enabled = False
+
+    results = {}
+    for cls, cases in projects():
+        if only and cls.__name__ not in only:
+            continue
+        start = time.perf_counter()
+        page = cls()
+        page.load()
+        results[f'{cls.__name__}.load'] = {'calls': 1, 'p50_ms': (time.perf_counter() - start) * 1000,
+                                           'requests': interactions(page.app)}
+
+        grouped = {}
+        for name, args in cases(page):
+            grouped.setdefault(name, []).append(args)
+        context = page.app.server.test_request_context()  # pour les routes Flask
+        context.push()
+        for name, inputs in grouped.items():
+            if sample and len(inputs) > sample:
+                inputs = random.Random(0).sample(inputs, sample)
+            callback = getattr(page, name)
+            times = []
+            sizes = []
+            gzip_sizes = []
+            shapes = []  # (points, traces, WebGL) des figures de lignes
+            errors = 0
+            for args in inputs[:1] + inputs:  # le premier appel sert d'échauffement (imports paresseux)
+                t = time.perf_counter()
+                try:
+                    fig = callback(*args)
+                except Exception:  # une entrée qui plante est comptée, pas mesurée
+                    errors += 1
+                    continue
+                data = serialize(fig)  # le worker sérialise aussi la figure, on le compte
+                times.append(time.perf_counter() - t)
+                size, gzip_size = payload_size(data)
+                sizes.append(size)
+                gzip_sizes.append(gzip_size)
+                for output in fig if isinstance(fig, (list, tuple)) else [fig]:  # un callback à plusieurs sorties
+                    if isinstance(output, dict) and figures.size(output)[1]:
+                        shapes.append(figures.size(output))
+            times = times[1:] or times
+            tracemalloc.start()
+            peak = 0
+            for args in inputs[::max(1, len(inputs) // MEMORY_SAMPLES)][:MEMORY_SAMPLES]:
+                tracemalloc.reset_peak()
+                try:
+                    callback(*args)
+                except Exception:
+                    pass
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            results[f'{cls.__name__}.{name}'] = {
+                'calls': len(inputs),
+                'errors': errors,
+                'p50_ms': float(np.percentile(times, 50) * 1000),
+                'p99_ms': float(np.percentile(times, 99) * 1000),
+                'peak_kb': peak / 1024,
+                'bytes': int(np.mean(sizes or [0])),
+                'max_bytes': int(np.max(sizes or [0])),
+                'gzip_bytes': int(np.mean(gzip_sizes or [0])),
+            }
+            if shapes:
+                points, traces, gl = np.array(shapes[1:] or shapes).T
+                results[f'{cls.__name__}.{name}'].update(
+                    {'max_points': int(points.max()), 'max_traces': int(traces.max()), 'webgl': float(gl.mean())})
+        context.pop()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """List of the measures which are worse than the baseline."""
+    regressions = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for prop_id, n in res.get('requests', {}).items():
+            if n > base.get('requests', {}).get(prop_id, n):
+                regressions.append(f"{name} requests on {prop_id}: {base['requests'][prop_id]} -> {n}")
+        if name.endswith('.load'):  # le chargement dépend trop de la machine
+            continue
+        for key, margin in MARGIN.items():
+            if key in res and key in base and res[key] > base[key] * (1 + threshold) + margin:
+                regressions.append(f"{name} {key}: {base[key]:.1f} -> {res[key]:.1f}")
+    return regressions
+
+
+def over_budget(results, budgets=BUDGETS):
+    """List of the measures which exceed their budget."""
+    return [f"{name} {key}: {results[name][key]:.1f} > budget {limit}"
+            for name, budget in budgets.items() if name in results
+            for key, limit in budget.items() if results[name].get(key, 0) > limit]
+
+
+def report(results, baseline=None):
+    lines = [f"{'callback':50} {'calls':>6} {'errors':>6} {'p50 ms':>9} {'p99 ms':>9} {'peak kB':>9} {'bytes':>10} {'gzip':>9}"]
+    for name, r in results.items():
+        line = (f"{name:50} {r['calls']:6} {r.get('errors', 0):6} {r['p50_ms']:9.2f} {r.get('p99_ms', float('nan')):9.2f} "
+                f"{r.get('peak_kb', float('nan')):9.0f} {r.get('bytes', 0):10} {r.get('gzip_bytes', 0):9}")
+        if baseline and name in baseline:
+            base = baseline[name]
+            line += f"   (p50 {r['p50_ms'] / max(base['p50_ms'], 1e-3):.2f}x"
+            if base.get('bytes'):
+                line += f", bytes {r.get('bytes', 0) / base['bytes']:.2f}x"
+            line += ')'
+        lines.append(line)
+    lines.append(f"\n{'line figures':50} {'points':>9} {'traces':>7} {'WebGL':>7}   "
+                 f"(thresholds {figures.MAX_POINTS} points, {figures.MAX_TRACES} traces)")
+    for name, r in results.items():
+        if 'webgl' in r:
+            lines.append(f"{name:50} {r['max_points']:9} {r['max_traces']:7} {r['webgl']:7.0%}")
+    for name, r in results.items():
+        if r.get('requests'):
+            lines.append(f"\nrequests per change, {name[:-len('.load')]}")
+            for prop_id, n in r['requests'].items():
+                base = (baseline or {}).get(name, {}).get('requests', {}).get(prop_id)
+                lines.append(f"  {prop_id:48} {n:3}" + (f"   (was {base})" if base is not None and base != n else ''))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline file (default: %(default)s)')
+    parser.add_argument('--save', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='tolerated slowdown, 0.25 = 25 %%')
+    parser.add_argument('--only', nargs='*', help='project classes to run, e.g. Deces Naissance')
+    parser.add_argument('--sample', type=int, help='at most this many inputs per callback')
+    args = parser.parse_args()
+
+    results = run(args.only, args.sample)
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        baseline = None
+    print(report(results, baseline))
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1)
+        print(f"baseline written to {args.baseline}")
+    regressions = over_budget(results)
+    if baseline and not args.save:
+        regressions += compare(results, baseline, args.threshold)
+    if regressions:
+        print('\nregressions:\n  ' + '\n  '.join(regressions))
+        sys.exit(1)
+    print('\nno regression')
+
+
+if __name__ == '__main__':
+    main()
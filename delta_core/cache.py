@@ -0,0 +1,213 @@
+"""Figure cache shared by every gunicorn worker.
+
+Callback inputs are small discrete values, so the same figures are asked for
+again and again. ``cached_figure`` stores the JSON of the figure returned by a
+callback in a SQLite database, in shared memory (/dev/shm) when available,
+which all workers read and write. The least recently used figures are evicted
+once the database exceeds its size.
+
+A hit is a read only: the last use of a figure is written at most once every
+TOUCH_INTERVAL seconds, the hit and miss counts are kept in the process and
+added to the database every STATS_INTERVAL seconds, and the size of the
+database is only summed after a worker wrote a twentieth of it, the eviction
+then bringing it down to 90 %. The workers thus rarely wait for the writer of
+the database.
+
+The key of a figure includes the callback, its arguments, a fingerprint of the
+data files of the page and the version of the code: the sources of the package
+of the page and of delta_core, the versions of plotly and dash and the
+FIGURE_SETTINGS. The database outlives the workers, so changing the data, a
+helper or a setting invalidates the figures built before.
+
+Environment: DELTA_FIGURE_CACHE=0 disables the cache, DELTA_CACHE_DIR sets the
+directory of the database and DELTA_CACHE_SIZE its size in MB (50 by default,
+Docker gives 64 MB to /dev/shm).
+"""
+import collections
+import functools
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import dash
+import flask
+import plotly
+from plotly.io.json import to_json_plotly
+
+from delta_core.transport import compact_figure
+
+
+def fingerprint(patterns):
+    """Hash of the name, size and modification time of the files matching the patterns."""
+    h = hashlib.sha1()
+    for path in sorted(p for pattern in patterns for p in glob.glob(pattern)):
+        st = os.stat(path)
+        h.update(f"{path}:{st.st_size}:{st.st_mtime_ns};".encode())
+    return h.hexdigest()
+
+
+# variables d'environnement qui changent les figures renvoyées (voir figures.py et transport.py)
+FIGURE_SETTINGS = ['DELTA_WEBGL_POINTS', 'DELTA_WEBGL_TRACES', 'DELTA_TYPED_ARRAYS']
+
+_versions = {}
+_code_versions = {}
+
+
+def code_version(module):
+    """Hash of the sources of the package of a module and of delta_core, of plotly and dash and of the settings.
+
+    The code does not change while the process runs, so it is computed once per package.
+    """
+    package = os.path.dirname(os.path.abspath(sys.modules[module].__file__))
+    if package not in _code_versions:
+        h = hashlib.sha1(json.dumps([plotly.__version__, dash.__version__,
+                                     {name: os.environ.get(name) for name in FIGURE_SETTINGS}]).encode())
+        for directory in sorted({package, os.path.dirname(os.path.abspath(__file__))}):
+            for path in sorted(glob.glob(os.path.join(directory, '*.py'))):
+                with open(path, 'rb') as f:
+                    h.update(f"{os.path.basename(path)}:".encode() + f.read())
+        _code_versions[package] = h.hexdigest()
+    return _code_versions[package]
+
+
+def data_version(page):
+    """Fingerprint of the data files of a page and version of its code, checked at each call with reload_data."""
+    cls = type(page)
+    if cls not in _versions or getattr(cls, 'reload_data', False):
+        _versions[cls] = fingerprint(cls.data_files) + code_version(cls.__module__)
+    return _versions[cls]
+
+
+class FigureCache():
+    TOUCH_INTERVAL = 60  # secondes entre deux mises à jour de la dernière utilisation d'une figure
+    STATS_INTERVAL = 10  # secondes entre deux écritures des comptes de hits et de misses
+
+    def __init__(self, path=None, max_bytes=None):
+        if path is None:
+            directory = os.environ.get('DELTA_CACHE_DIR',
+                                       '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+            path = os.path.join(directory, f'delta-figures-{os.getuid()}.sqlite')
+        self.path = path
+        self.max_bytes = max_bytes or int(float(os.environ.get('DELTA_CACHE_SIZE', 50)) * 2**20)
+        self.enabled = os.environ.get('DELTA_FIGURE_CACHE', '1') != '0'
+        self._local = threading.local()
+        self._counts = collections.Counter()  # (callback, hit) -> nombre, pas encore écrits
+        self._flushed = time.time()
+        self._written = 0  # octets écrits depuis la dernière mesure de la taille
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        # une connexion par processus (elles ne survivent pas au fork) et par thread
+        if getattr(self._local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=OFF')
+            db.execute('CREATE TABLE IF NOT EXISTS figures (key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, hits INTEGER, misses INTEGER)')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    def _count(self, name, hit):
+        with self._lock:
+            self._counts[name, hit] += 1
+            if time.time() - self._flushed < self.STATS_INTERVAL:
+                return
+        self.flush()
+
+    def flush(self):
+        """Add the hit and miss counts of the process to the database."""
+        with self._lock:
+            counts, self._counts = self._counts, collections.Counter()
+            self._flushed = time.time()
+        rows = [(name, counts[name, True], counts[name, False]) for name in {name for name, _ in counts}]
+        try:
+            self.db.executemany('INSERT INTO stats VALUES (?, ?, ?) ON CONFLICT(name) DO UPDATE SET '
+                                'hits = hits + excluded.hits, misses = misses + excluded.misses', rows)
+        except sqlite3.Error:
+            pass
+
+    def get(self, key, name):
+        """JSON of the figure or None, counted as a hit or a miss of the callback ``name``."""
+        try:
+            row = self.db.execute('SELECT value, used FROM figures WHERE key = ?', (key,)).fetchone()
+            if row is not None and time.time() - row[1] > self.TOUCH_INTERVAL:
+                self.db.execute('UPDATE figures SET used = ? WHERE key = ?', (time.time(), key))
+        except sqlite3.Error:
+            return None
+        self._count(name, row is not None)
+        return None if row is None else zlib.decompress(row[0]).decode()
+
+    def put(self, key, value):
+        data = zlib.compress(value.encode(), 1)
+        try:
+            self.db.execute('INSERT OR REPLACE INTO figures VALUES (?, ?, ?, ?)', (key, data, len(data), time.time()))
+            with self._lock:
+                self._written += len(data)
+                check = self._written > self.max_bytes / 20
+                if check:
+                    self._written = 0
+            if check and self.db.execute('SELECT COALESCE(SUM(size), 0) FROM figures').fetchone()[0] > self.max_bytes:
+                self.evict()
+        except sqlite3.Error:
+            pass
+
+    def evict(self, fraction=0.9):
+        """Remove the least recently used figures beyond ``fraction`` of ``max_bytes``."""
+        total = 0
+        old = []
+        for key, size in self.db.execute('SELECT key, size FROM figures ORDER BY used DESC'):
+            total += size
+            if total > self.max_bytes * fraction:
+                old.append((key,))
+        if old:
+            self.db.executemany('DELETE FROM figures WHERE key = ?', old)
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+        self.db.execute('DELETE FROM figures')
+        self.db.execute('DELETE FROM stats')
+
+    def stats(self):
+        self.flush()
+        callbacks = {name: {'hits': hits, 'misses': misses}
+                     for name, hits, misses in self.db.execute('SELECT * FROM stats ORDER BY name')}
+        count, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM figures').fetchone()
+        return {'figures': count, 'bytes': size, 'max_bytes': self.max_bytes, 'callbacks': callbacks}
+
+    def init_app(self, server):
+        """Show the hit and miss counts on /cache-stats."""
+        server.add_url_rule('/cache-stats', 'cache_stats', lambda: flask.jsonify(self.stats()))
+
+
+figure_cache = FigureCache()
+
+
+def cached_figure(method):
+    """Decorate a callback which returns a figure so that it is computed once for all workers.
+
+    The figure is returned, and cached, in the compact form of delta_core.transport.
+    """
+    name = method.__qualname__
+
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        if not figure_cache.enabled:
+            return compact_figure(method(self, *args))
+        key = hashlib.sha1(json.dumps([name, data_version(self), args], sort_keys=True, default=str).encode()).hexdigest()
+        value = figure_cache.get(key, name)
+        if value is not None:
+            return json.loads(value)
+        fig = compact_figure(method(self, *args))
+        figure_cache.put(key, to_json_plotly(fig))
+        return fig
+    return wrapper
@@ -0,0 +1,48 @@
+"""Min/max envelope of long series, precomputed at every bucket size.
+
+A series of n points is cut in buckets of 2**k points and each bucket keeps
+its smallest and its largest point, in their order. Drawn as a line, the
+envelope looks like the full series, peaks included, with 2 points per
+bucket. The levels k = 0, 1, 2... are computed once from one another, so
+the points to draw for any range are a slice of a level.
+
+    pyramid = Pyramid(df.morts)
+    positions = pyramid.positions(start, end, max_points=3000)
+    df.iloc[positions]
+"""
+import numpy as np
+
+
+class Pyramid():
+    def __init__(self, values):
+        values = np.asarray(values, dtype=float)
+        self.n = len(values)
+        positions = np.arange(self.n)
+        self.levels = [positions[:, None]]  # niveau 0 : un point par paquet
+        low = high = positions
+        while len(low) > 1:
+            if len(low) % 2:  # le dernier paquet est complété avec son propre point
+                low, high = np.r_[low, low[-1]], np.r_[high, high[-1]]
+            low, high = low.reshape(-1, 2), high.reshape(-1, 2)
+            low = np.take_along_axis(low, values[low].argmin(axis=1)[:, None], axis=1).ravel()
+            high = np.take_along_axis(high, values[high].argmax(axis=1)[:, None], axis=1).ravel()
+            self.levels.append(np.sort(np.stack([low, high], axis=1), axis=1))
+
+    def level(self, start, end, max_points):
+        """Smallest level at which [start, end) has at most max_points points."""
+        for k in range(len(self.levels)):
+            if -(-(end - start) // 2**k) * self.levels[k].shape[1] <= max_points:
+                return k
+        return len(self.levels) - 1
+
+    def at(self, k, start=0, end=None):
+        """Positions of the points of level k in [start, end), in increasing order."""
+        end = self.n if end is None else end
+        size = 2**k
+        res = self.levels[k][start // size:-(-end // size)].ravel()
+        return res[np.r_[True, res[1:] != res[:-1]]] if len(res) else res
+
+    def positions(self, start=0, end=None, max_points=3000):
+        """Positions of the points to draw for [start, end) with at most about max_points points."""
+        end = self.n if end is None else end
+        return self.at(self.level(start, end, max_points), start, end)
@@ -0,0 +1,80 @@
+"""WebGL rendering of the large line figures of the pages.
+
+Plotly draws a ``scatter`` trace in SVG, one path per trace: past about ten
+thousand points or fifty traces, every zoom or pan redraws a large DOM and gets
+slow on modest machines. A ``scattergl`` trace draws the same lines, dashes,
+markers, colors, hover templates and legend with WebGL. ``webgl`` is the last
+step of the line figures of the pages: it turns their scatter traces into
+scattergl ones when the figure has more than MAX_POINTS points or MAX_TRACES
+traces.
+
+Stacked areas (stackgroup) and spline lines have no WebGL version, so a figure
+with one of them stays in SVG. Browsers only allow a few WebGL contexts per
+page, another reason to leave the small figures, the most common, in SVG.
+
+Environment: DELTA_WEBGL_POINTS and DELTA_WEBGL_TRACES set the thresholds, 0
+disables the corresponding one.
+"""
+import base64
+import os
+
+import numpy as np
+
+MAX_POINTS = int(os.environ.get('DELTA_WEBGL_POINTS', 10_000))
+MAX_TRACES = int(os.environ.get('DELTA_WEBGL_TRACES', 50))
+# attributs de scatter que scattergl n'a pas, sans effet sur des lignes qui ne sont pas empilées
+SVG_ONLY = {'alignmentgroup', 'cliponaxis', 'fillgradient', 'fillpattern', 'groupnorm', 'hoveron', 'offsetgroup',
+            'orientation', 'stackgaps', 'zorder'}
+SVG_ONLY_LINE = {'backoff', 'backoffsrc', 'simplify', 'smoothing'}
+
+
+def _points(trace):
+    values = trace.get('y')
+    if values is None:
+        values = trace.get('x')
+    if isinstance(values, dict) and 'bdata' in values:  # tableau typé de delta_core.transport
+        return len(base64.b64decode(values['bdata'])) // np.dtype(values['dtype']).itemsize
+    return 0 if values is None else len(values)
+
+
+def _traces(fig):
+    """Traces of a figure dict as dicts, some callbacks giving a list of trace objects."""
+    return [t.to_plotly_json() if hasattr(t, 'to_plotly_json') else t for t in fig.get('data', [])]
+
+
+def size(fig):
+    """(points, traces, whether drawn with WebGL) of the scatter traces, SVG or WebGL, of a figure dict."""
+    traces = [t for t in _traces(fig) if t.get('type', 'scatter') in ('scatter', 'scattergl')]
+    return sum(_points(t) for t in traces), len(traces), any(t.get('type') == 'scattergl' for t in traces)
+
+
+def _convertible(trace):
+    return 'stackgroup' not in trace and (trace.get('line') or {}).get('shape') != 'spline'
+
+
+def webgl(fig, max_points=None, max_traces=None):
+    """Figure as a dict, its scatter traces drawn with WebGL when it is large.
+
+    :param fig: figure or figure dict.
+    :param max_points: points above which the figure is drawn with WebGL, MAX_POINTS by default.
+    :param max_traces: traces above which the figure is drawn with WebGL, MAX_TRACES by default.
+    """
+    if hasattr(fig, 'to_dict'):
+        fig = fig.to_dict()
+    else:
+        fig = dict(fig, data=_traces(fig))
+    max_points = MAX_POINTS if max_points is None else max_points
+    max_traces = MAX_TRACES if max_traces is None else max_traces
+    points, n, _ = size(fig)  # plotly express passe déjà en WebGL au-delà de 1000 lignes, ses traces comptent
+    if not ((max_points and points > max_points) or (max_traces and n > max_traces)):
+        return fig
+    traces = [t for t in fig['data'] if t.get('type', 'scatter') == 'scatter']
+    if not all(_convertible(t) for t in traces):
+        return fig
+    for trace in traces:
+        for key in SVG_ONLY & trace.keys():
+            del trace[key]
+        for key in SVG_ONLY_LINE & (trace.get('line') or {}).keys():
+            del trace['line'][key]
+        trace['type'] = 'scattergl'
+    return fig
@@ -0,0 +1,89 @@
+"""RSS and PSS of the gunicorn master and of each of its workers.
+
+PSS divides every shared page between the processes which map it, so the sum
+of the PSS is the real memory used by the server, while the sum of the RSS
+counts the shared pages once per worker.
+
+    python -m delta_core.memory <master pid> [--url http://localhost:8000]
+
+With ``--url`` every page is requested first so that the report shows the
+memory before and after the workers have built their pages. Compare a run
+of ``make run`` with a run of ``make run_preload``.
+"""
+import argparse
+import json
+import os
+import time
+from urllib.request import Request, urlopen
+
+PAGES = ['/nrj', '/wfr', '/fdc', '/ndf']
+
+
+def memory_usage(pid='self'):
+    """Memory of a process in MB: rss, pss, shared and private."""
+    fields = {'Rss': 0, 'Pss': 0, 'Shared_Clean': 0, 'Shared_Dirty': 0, 'Private_Clean': 0, 'Private_Dirty': 0}
+    path = f'/proc/{pid}/smaps_rollup'
+    if not os.path.exists(path):  # noyaux antérieurs au 4.14
+        path = f'/proc/{pid}/smaps'
+    with open(path) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in fields:
+                fields[key] += int(value.split()[0])  # en kB
+    return {'rss': fields['Rss'] / 1024,
+            'pss': fields['Pss'] / 1024,
+            'shared': (fields['Shared_Clean'] + fields['Shared_Dirty']) / 1024,
+            'private': (fields['Private_Clean'] + fields['Private_Dirty']) / 1024}
+
+
+def children(pid):
+    res = []
+    for task in os.listdir(f'/proc/{pid}/task'):
+        with open(f'/proc/{pid}/task/{task}/children') as f:
+            res += [int(c) for c in f.read().split()]
+    return res
+
+
+def report(master, title):
+    lines = [title, f"{'pid':>8} {'':7} {'rss MB':>8} {'pss MB':>8} {'shared':>8} {'private':>8}"]
+    total = {'rss': 0, 'pss': 0}
+    for pid, role in [(master, 'master')] + [(c, 'worker') for c in children(master)]:
+        m = memory_usage(pid)
+        total['rss'] += m['rss']
+        total['pss'] += m['pss']
+        lines.append(f"{pid:8} {role:7} {m['rss']:8.1f} {m['pss']:8.1f} {m['shared']:8.1f} {m['private']:8.1f}")
+    lines.append(f"{'total':>16} {total['rss']:8.1f} {total['pss']:8.1f}")
+    return '\n'.join(lines)
+
+
+def warm_up(url, rounds):
+    """Request every page several times so that each worker is likely to build them."""
+    for _ in range(rounds):
+        for page in PAGES:
+            body = json.dumps({'output': 'page_content.children',
+                               'outputs': {'id': 'page_content', 'property': 'children'},
+                               'inputs': [{'id': 'url', 'property': 'pathname', 'value': page}],
+                               'changedPropIds': ['url.pathname']}).encode()
+            request = Request(url + '/_dash-update-component', data=body,
+                              headers={'Content-Type': 'application/json'})
+            with urlopen(request) as r:
+                r.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('master', type=int, help='pid of the gunicorn master')
+    parser.add_argument('--url', help='server to warm up, e.g. http://localhost:8000')
+    parser.add_argument('--rounds', type=int, default=10, help='requests per page during the warm up')
+    args = parser.parse_args()
+
+    print(report(args.master, 'before' if args.url else 'now'))
+    if args.url:
+        warm_up(args.url, args.rounds)
+        time.sleep(1)
+        print()
+        print(report(args.master, 'after building the pages'))
+
+
+if __name__ == '__main__':
+    main()
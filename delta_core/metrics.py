@@ -0,0 +1,170 @@
+"""Latency, payload size and errors of every Dash callback, on /metrics.
+
+Callbacks are measured around the Flask request which runs them, so nothing
+is added to the callbacks themselves and the payload is the response Dash
+already serialized. Metrics are labelled by the output of the callback, e.g.
+``mpj-main-graph.figure``.
+
+Each worker keeps its metrics in memory and copies them, at most once per
+second, to a file of DELTA_METRICS_DIR (/dev/shm by default) named after its
+pid, in a directory named after the gunicorn master. /metrics adds up the
+files of all the workers and answers in the Prometheus text format.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+import flask
+
+BUCKETS = {
+    'delta_callback_seconds': [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+    'delta_callback_bytes': [1e3, 1e4, 1e5, 3e5, 1e6, 3e6, 1e7],
+    'delta_callback_wire_bytes': [1e3, 1e4, 1e5, 3e5, 1e6, 3e6, 1e7],
+    'delta_pool_wait_seconds': [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10],
+}
+
+HELP = {
+    'delta_callback_seconds': ('histogram', 'Time spent in the callback request.'),
+    'delta_callback_bytes': ('histogram', 'Size of the JSON response of the callback.'),
+    'delta_callback_wire_bytes': ('histogram', 'Size of the compressed response of the callback.'),
+    'delta_callback_errors_total': ('counter', 'Callback requests which ended with a server error.'),
+    'delta_pool_wait_seconds': ('histogram', 'Time a heavy callback waited for a process of the pool.'),
+    'delta_pool_queue': ('gauge', 'Heavy callbacks submitted to the pool and not finished yet.'),
+    'delta_pool_timeouts_total': ('counter', 'Heavy callbacks abandoned after the timeout.'),
+}
+
+
+class Metrics():
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.environ.get('DELTA_METRICS_DIR',
+                                       '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+        self.directory = os.path.join(directory, f'delta-metrics-{os.getuid()}')
+        self.data = {}  # (metric, label name, label) -> [counts par seau..., sum, count] ou valeur
+        self.flushed = 0
+        self._lock = threading.Lock()
+
+    def observe(self, metric, label, value, label_name='output'):
+        buckets = BUCKETS[metric]
+        with self._lock:
+            h = self.data.setdefault((metric, label_name, label), [0] * (len(buckets) + 2))
+            for i, b in enumerate(buckets):
+                if value <= b:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def inc(self, metric, label, n=1, label_name='output'):
+        with self._lock:
+            self.data[(metric, label_name, label)] = self.data.get((metric, label_name, label), 0) + n
+
+    def set(self, metric, label, value, label_name='output'):
+        """Gauge, summed over the workers."""
+        with self._lock:
+            self.data[(metric, label_name, label)] = value
+
+    # partage entre workers
+
+    def _path(self, pid=None):
+        return os.path.join(self.directory, str(os.getppid()), f'{pid or os.getpid()}.json')
+
+    def flush(self, every=1):
+        now = time.monotonic()
+        if now - self.flushed < every:
+            return
+        self.flushed = now
+        path = self._path()
+        with self._lock:
+            data = [[list(k), v] for k, v in self.data.items()]
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(data, f)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            pass
+
+    def collect(self):
+        """Metrics of every worker of the server, this one being up to date."""
+        self.flush(every=0)
+        total = {}
+        directory = os.path.dirname(self._path())
+        for name in os.listdir(directory) if os.path.isdir(directory) else []:
+            if not name.endswith('.json'):
+                continue
+            try:
+                os.kill(int(name[:-5]), 0)
+            except ProcessLookupError:  # worker mort, ses métriques partent avec lui
+                os.remove(os.path.join(directory, name))
+                continue
+            except (ValueError, OSError):
+                pass
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for key, value in data:
+                key = tuple(key)
+                if isinstance(value, list):
+                    old = total.get(key, [0] * len(value))
+                    total[key] = [a + b for a, b in zip(old, value)]
+                else:
+                    total[key] = total.get(key, 0) + value
+        return total
+
+    def prometheus(self):
+        lines = []
+        data = self.collect()
+        for metric in sorted({k[0] for k in data}):
+            kind, text = HELP.get(metric, ('gauge', ''))
+            lines += [f'# HELP {metric} {text}', f'# TYPE {metric} {kind}']
+            for (m, label_name, label), value in sorted(data.items()):
+                if m != metric:
+                    continue
+                label = label.replace('\\', '\\\\').replace('"', '\\"')
+                if kind == 'histogram':
+                    for b, count in zip([f'{b:g}' for b in BUCKETS[metric]] + ['+Inf'], value[:-2] + [value[-1]]):
+                        lines.append(f'{metric}_bucket{{{label_name}="{label}",le="{b}"}} {count}')
+                    lines.append(f'{metric}_sum{{{label_name}="{label}"}} {value[-2]:.10g}')
+                    lines.append(f'{metric}_count{{{label_name}="{label}"}} {value[-1]}')
+                else:
+                    lines.append(f'{metric}{{{label_name}="{label}"}} {value:.10g}')
+        return '\n'.join(lines) + '\n'
+
+    # enregistrement dans Flask
+
+    def init_app(self, server):
+        server.before_request(self._before)
+        server.after_request(self._after)
+        server.add_url_rule('/metrics', 'metrics',
+                            lambda: flask.Response(self.prometheus(), mimetype='text/plain; version=0.0.4'))
+
+    @staticmethod
+    def output_label(body):
+        outputs = body.get('outputs', [])
+        if isinstance(outputs, dict):
+            outputs = [outputs]
+        return ','.join(f"{o['id']}.{o['property']}" for o in outputs if isinstance(o, dict)) or body.get('output', '?')
+
+    def _before(self):
+        if flask.request.path.endswith('/_dash-update-component'):
+            flask.g.delta_start = time.perf_counter()
+
+    def _after(self, response):
+        start = flask.g.pop('delta_start', None)
+        if start is None:
+            return response
+        label = self.output_label(flask.request.get_json(silent=True) or {})
+        self.observe('delta_callback_seconds', label, time.perf_counter() - start)
+        if response.status_code >= 500:
+            self.inc('delta_callback_errors_total', label)
+        elif response.status_code == 200:
+            self.observe('delta_callback_bytes', label, response.calculate_content_length() or 0)
+        self.flush()
+        return response
+
+
+metrics = Metrics()
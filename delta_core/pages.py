@@ -0,0 +1,163 @@
+"""Lazy construction of the project pages served by delta.py.
+
+A project registers its callbacks when it is instantiated, which is cheap, and
+builds its data and ``main_layout`` the first time a page or a callback needs
+them. With several gunicorn workers a callback may reach a worker that never
+served the page itself, hence the ``needs_data`` guard on callbacks.
+
+A page with ``reload_data`` is built again when one of its ``data_files``
+changes, on the next page or callback, so that a rebuilt dataset is served
+without restarting the workers.
+"""
+import contextlib
+import functools
+import importlib
+import os
+import resource
+import sys
+import threading
+import time
+
+import dash
+from dash.exceptions import MissingCallbackContextException
+
+from delta_core.cache import fingerprint
+from delta_core.store import store
+
+
+def rss_mb():
+    """Resident memory of the current process in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:  # pas de /proc, on se contente du maximum atteint
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+
+
+class StartupReport():
+    """Wall time and memory taken by each module while the worker starts."""
+
+    def __init__(self, verbose=True):
+        self.entries = []  # (module, phase, seconds, MB)
+        self.verbose = verbose
+
+    @contextlib.contextmanager
+    def measure(self, module, phase):
+        rss = rss_mb()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = (module, phase, time.perf_counter() - start, rss_mb() - rss)
+            self.entries.append(entry)
+            if self.verbose and phase in ('load', 'reload'):
+                print(f"[{os.getpid()}] {self.format_entry(entry)}", file=sys.stderr, flush=True)
+
+    def timed_import(self, module):
+        with self.measure(module, 'import'):
+            return importlib.import_module(module)
+
+    @staticmethod
+    def format_entry(entry):
+        module, phase, seconds, mb = entry
+        return f"{module:35} {phase:8} {seconds:8.3f} s {mb:+8.1f} MB"
+
+    def __str__(self):
+        lines = [f"startup report (pid {os.getpid()}, rss {rss_mb():.1f} MB)"]
+        lines += [self.format_entry(e) for e in self.entries]
+        lines.append(f"{'total':35} {'':8} {sum(e[2] for e in self.entries):8.3f} s")
+        return '\n'.join(lines)
+
+
+startup = StartupReport()
+
+
+class Page():
+    """Base class of a project page.
+
+    Subclasses register their callbacks in ``__init__`` and put every costly
+    step, including ``main_layout``, in ``build()``.
+    """
+    loaded = False
+    data_files = []
+    reload_data = False  # construite à nouveau quand un de data_files change
+    data_seen = None     # empreinte de data_files à la dernière construction
+    _locks = threading.Lock()  # ne protège que la création du verrou de chaque page
+
+    def build(self):
+        raise NotImplementedError
+
+    def _load_lock(self):
+        # un verrou par page, créé ici car les sous-classes n'appellent pas Page.__init__ :
+        # la construction d'une page lente ne bloque pas la première visite des autres
+        with Page._locks:
+            if '_lock' not in self.__dict__:
+                self._lock = threading.RLock()
+            return self._lock
+
+    def data_changed(self):
+        return self.reload_data and fingerprint(self.data_files) != self.data_seen
+
+    def load(self):
+        """Build the page once, on first use, and again when its data changed with reload_data."""
+        if self.loaded and not self.data_changed():
+            return
+        with self._load_lock():
+            if not self.loaded or self.data_changed():
+                seen = fingerprint(self.data_files) if self.reload_data else None
+                if self.loaded:
+                    store.forget(self.data_files)
+                with startup.measure(type(self).__module__, 'load' if not self.loaded else 'reload'):
+                    self.build()
+                self.data_seen = seen
+                self.loaded = True
+
+    def bound_caches(self):
+        """Bound the caches of the page for this process, called in the processes of a pool (see pool.py)."""
+
+    def layout(self):
+        self.load()
+        return self.main_layout
+
+
+def needs_data(method):
+    """Decorate a callback so that it builds its page before running."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.load()
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+def triggered():
+    """Inputs which triggered the running callback, as 'id.property', none outside a callback or at first."""
+    try:
+        return set(dash.ctx.triggered_prop_ids)
+    except MissingCallbackContextException:
+        return set()
+
+
+class PageRegistry():
+    """Map an url to a project page, built the first time the url is visited."""
+
+    def __init__(self, app, report=startup):
+        self.app = app
+        self.report = report
+        self.pages = {}
+
+    def register(self, path, page_class):
+        with self.report.measure(page_class.__module__, 'register'):
+            page = page_class(self.app)
+        self.pages[path] = page
+        return page
+
+    def __contains__(self, path):
+        return path in self.pages
+
+    def layout(self, path):
+        return self.pages[path].layout()
+
+    def load_all(self):
+        for page in self.pages.values():
+            page.load()
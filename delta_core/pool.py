@@ -0,0 +1,194 @@
+"""Process pools for the heavy callbacks.
+
+A callback decorated with ``@heavy`` runs in a bounded pool of processes
+started by the worker, so that the threads of a gunicorn worker (gthread)
+keep serving the light callbacks while a heavy one computes.
+
+A process forked while another thread holds a lock (of a cache, of the store,
+of sqlite or of logging) keeps it locked forever, so the processes of a pool
+are forked only from a process with a single thread: gunicorn.conf.py starts
+the pool in ``post_fork``, before the threads of the worker, and its processes
+inherit the pages loaded with --preload instead of loading them again. A pool
+started later, for a new page or after a timeout, spawns its processes, which
+build their pages themselves. It starts in a background thread and, until it
+is ready, the heavy callbacks run in the request thread as without a pool.
+
+A call which does not complete within the timeout raises TimeoutError, which
+Dash reports as a server error. Its process cannot be interrupted, so the
+processes of the pool, whose pids they sent when they started, are killed and
+a new pool is started. Queue depth, wait time and timeouts are on /metrics.
+
+Each process has its own copy of the caches of a page: a page sizes them with
+``share``, in ``build`` and in ``bound_caches`` for the processes which
+inherited them, so that a worker and its pool keep the bound together.
+
+Environment: DELTA_HEAVY_WORKERS processes per pool (0, the default, runs
+heavy callbacks inline) and DELTA_HEAVY_TIMEOUT seconds (60 by default).
+"""
+import concurrent.futures
+import functools
+import importlib
+import multiprocessing
+import os
+import threading
+import time
+
+from delta_core.metrics import metrics
+
+_functions = {}  # qualname -> fonction, enregistrées à l'import donc connues des processus fils
+_pages = {}      # nom de la classe -> page, héritées par fork ou construites par _start
+
+
+def _start(classes, pids):
+    """Initializer of the processes of a pool: send the pid, load the pages, built first when the process was spawned."""
+    pids.put(os.getpid())
+    for name, (module, qualname) in classes.items():
+        if name not in _pages:
+            _pages[name] = getattr(importlib.import_module(module), qualname)()
+        _pages[name].load()
+        _pages[name].bound_caches()  # héritées du worker par fork avec ses bornes
+
+
+def _run(qualname, page_name, args, submitted):
+    start = time.time()
+    result = _functions[qualname](_pages[page_name], *args)
+    if hasattr(result, 'to_dict'):  # une figure plotly est renvoyée en dict, moins cher à transmettre
+        result = result.to_dict()
+    return start - submitted, result
+
+
+class ProcessPool():
+    def __init__(self, name, workers=None, timeout=None):
+        self.name = name
+        self.workers = int(os.environ.get('DELTA_HEAVY_WORKERS', 0)) if workers is None else workers
+        self.timeout = float(os.environ.get('DELTA_HEAVY_TIMEOUT', 60)) if timeout is None else timeout
+        self.executor = None
+        self.pids = None      # file où les processus de executor mettent leur pid au démarrage
+        self.pid = None
+        self.classes = {}     # nom de la classe -> (module, nom) des pages connues des fils
+        self.starting = False  # un nouveau pool démarre dans un thread
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    def share(self, size):
+        """Part of a cache bound of ``size`` for this process: one for a process of the pool, the rest for the worker."""
+        if self.workers <= 0:
+            return size
+        if multiprocessing.parent_process() is not None:
+            return 1
+        return max(1, size - self.workers)
+
+    def start(self, pages):
+        """Load the pages with heavy callbacks and start their pool, in a worker which has no thread yet."""
+        pages = [p for p in pages if any(q.startswith(type(p).__qualname__ + '.') for q in _functions)]
+        if self.workers <= 0 or not pages:
+            return
+        for page in pages:
+            page.load()
+        with self._lock:
+            self._register(pages)
+            self.starting = True
+        self._replace()
+
+    def _register(self, pages):
+        for page in pages:
+            _pages[type(page).__name__] = page
+            self.classes[type(page).__name__] = (type(page).__module__, type(page).__qualname__)
+
+    def _replace(self):
+        """Start a pool with the known pages, which replaces the current one once its processes are ready."""
+        try:
+            # un fork n'est sûr que sans autre thread, qui pourrait tenir un verrou copié fermé dans les fils
+            context = multiprocessing.get_context('fork' if threading.active_count() == 1 else 'spawn')
+            pids = context.SimpleQueue()
+            executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=context, initializer=_start, initargs=(dict(self.classes), pids))
+            try:  # on crée tous les fils tout de suite plutôt qu'au fil des requêtes
+                for f in [executor.submit(time.sleep, 0) for _ in range(self.workers)]:
+                    f.result()
+            except Exception:  # page qui ne se construit pas : les appels restent dans le worker
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+            with self._lock:
+                old = self.executor if self.pid == os.getpid() else None
+                self.executor, self.pids, self.pid = executor, pids, os.getpid()
+            if old is not None:
+                old.shutdown(wait=False)  # ses calculs en cours se terminent
+        finally:
+            with self._lock:
+                self.starting = False
+
+    def _start_replace(self):
+        # appelé avec self._lock : le pool démarre hors du chemin des requêtes
+        if not self.starting:
+            self.starting = True
+            threading.Thread(target=self._replace, name=f'{self.name}-pool', daemon=True).start()
+
+    def _executor(self, page):
+        """Pool of the page, None while a pool which knows it starts."""
+        with self._lock:
+            if self.pid != os.getpid():  # pool hérité d'un autre processus par fork de gunicorn
+                self.executor, self.pids, self.pid, self.starting = None, None, os.getpid(), False
+            if self.executor is not None and type(page).__name__ in self.classes:
+                return self.executor
+            self._register([page])
+            self._start_replace()
+            return None
+
+    def _restart(self, executor):
+        """Kill the processes of a pool which timed out or broke and start a new pool."""
+        with self._lock:
+            if self.executor is not executor:  # déjà remplacé par un autre thread
+                return
+            pids = self.pids
+            self.executor = self.pids = None
+            self._start_replace()
+        # un calcul en cours ne s'annule pas : on tue les processus, les appels en attente échouent
+        killed = set()
+        while not pids.empty():
+            killed.add(pids.get())
+        for process in multiprocessing.active_children():
+            if process.pid in killed:
+                process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, page, method, qualname, args):
+        page.load()
+        executor = self._executor(page)
+        if executor is None:
+            return method(page, *args)
+        with self._lock:
+            self.pending += 1
+            metrics.set('delta_pool_queue', self.name, self.pending, label_name='pool')
+        try:
+            future = executor.submit(_run, qualname, type(page).__name__, args, time.time())
+            try:
+                wait, result = future.result(timeout=self.timeout)
+            except concurrent.futures.TimeoutError:
+                self._restart(executor)
+                metrics.inc('delta_pool_timeouts_total', self.name, label_name='pool')
+                raise TimeoutError(f"{qualname} took more than {self.timeout} s")
+            except concurrent.futures.process.BrokenProcessPool:
+                self._restart(executor)  # processus tué, par un timeout ou faute de mémoire
+                raise
+            metrics.observe('delta_pool_wait_seconds', self.name, wait, label_name='pool')
+            return result
+        finally:
+            with self._lock:
+                self.pending -= 1
+                metrics.set('delta_pool_queue', self.name, self.pending, label_name='pool')
+
+    def __call__(self, method):
+        """Decorate a page callback so that it runs in this pool."""
+        qualname = method.__qualname__
+        _functions[qualname] = method
+
+        @functools.wraps(method)
+        def wrapper(page, *args):
+            if self.workers <= 0 or multiprocessing.parent_process() is not None:
+                return method(page, *args)
+            return self.run(page, method, qualname, args)
+        return wrapper
+
+
+heavy = ProcessPool('heavy')
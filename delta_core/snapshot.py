@@ -0,0 +1,102 @@
+"""Snapshot of the derived state of the pages, so that workers boot fast.
+
+Pages wrap their deterministic and costly computations with
+``snapshot.derived(key, files, compute, *params)``. The value is taken from the
+snapshot file when it was computed from the same files (hash of their content)
+and the same parameters, otherwise it is computed again.
+
+The snapshot is written by the build step only, never by the workers:
+
+    make precompute          # python -m delta_core.snapshot [--force]
+
+A page which keeps other derived data in files writes them only when
+``snapshot.building`` is true, in the build step too.
+"""
+import argparse
+import glob
+import hashlib
+import os
+import pickle
+import sys
+import threading
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FILE = 'data/snapshot.pkl'
+
+
+def content_hash(files, params=()):
+    """Hash of the content of the files matching the patterns and of the parameters."""
+    h = hashlib.sha1(repr(params).encode())
+    for path in sorted(p for pattern in files for p in glob.glob(pattern)):
+        h.update(path.encode())
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+class Snapshot():
+    def __init__(self, path=SNAPSHOT_FILE):
+        self.path = path
+        self.entries = None  # key -> (hash, value), lu au premier usage
+        self.fresh = {}      # entrées recalculées, à écrire par save()
+        self.force = False
+        self.building = False  # vrai dans make precompute, seul à écrire des fichiers
+        self._lock = threading.Lock()
+
+    def _read(self):
+        self.entries = {}
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+            if data.get('version') == SNAPSHOT_VERSION:
+                self.entries = data['entries']
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            pass
+
+    def derived(self, key, files, compute, *params):
+        """Value of ``compute()`` from the snapshot if it is up to date, else computed now."""
+        with self._lock:
+            if self.entries is None:
+                self._read()
+        digest = content_hash(files, params)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == digest and not self.force:
+            return entry[1]
+        if entry is not None:
+            print(f"snapshot: {key} is stale, run make precompute", file=sys.stderr, flush=True)
+        value = compute()
+        self.fresh[key] = (digest, value)
+        return value
+
+    def save(self):
+        """Write the snapshot with the entries computed since it was read."""
+        if self.entries is None:
+            self._read()
+        self.entries.update(self.fresh)
+        tmp = f"{self.path}.{os.getpid()}"
+        with open(tmp, 'wb') as f:
+            pickle.dump({'version': SNAPSHOT_VERSION, 'entries': self.entries}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)  # les workers ne voient jamais un fichier à moitié écrit
+        return list(self.fresh)
+
+
+snapshot = Snapshot()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the snapshot of the derived state of every page.')
+    parser.add_argument('--force', action='store_true', help='recompute every entry, even the up to date ones')
+    args = parser.parse_args()
+
+    # avec python -m ce module est __main__, les pages utilisent l'instance de delta_core.snapshot
+    from delta_core.snapshot import snapshot as shared
+    shared.force = args.force
+    shared.building = True
+    import delta  # enregistre les pages
+    delta.pages.load_all()
+    updated = shared.save()
+    print(f"{shared.path}: {len(shared.entries)} entries, updated: {', '.join(updated) or 'none'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Datasets shared by every page and, with gunicorn --preload, by every worker.
+
+Each file is read once per process. When ``DELTA_PRELOAD`` is set, delta.py
+loads everything in the gunicorn master, then ``freeze()`` moves the loaded
+objects out of the garbage collector's reach so that forked workers keep
+sharing their memory pages instead of copying them on the first collection.
+
+Frames are compacted on load so that their content lives in numpy buffers:
+object columns become categories (integer codes) and geojson rings become
+float arrays. Reading them afterwards only touches a few object headers.
+"""
+import fnmatch
+import gc
+import glob
+import json
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+# every data file read by the pages, preloaded with DELTA_PRELOAD=1
+DATA_FILES = [
+    'wfr_fertilite_revenus/data/subWDIdata.pkl',
+    'nrj_energies/data/energies.pkl',
+    'fdc_deces/data/morts_par_jour-*.pkl',
+    'ndf_naissance_deces/data/*.pkl',
+    'ndf_naissance_deces/data/departements.geojson',
+]
+
+
+def compact_frame(df):
+    """Store object columns of a frame as categories."""
+    for c in df.columns:
+        if df[c].dtype == object and df[c].nunique() < len(df) / 2:
+            df[c] = df[c].astype('category')
+    return df
+
+
+def compact_geojson(geojson):
+    """Replace the coordinates of every polygon ring by a (n, 2) float array."""
+    for feature in geojson['features']:
+        geometry = feature['geometry']
+        if geometry['type'] == 'Polygon':
+            geometry['coordinates'] = [np.array(ring, dtype='float64') for ring in geometry['coordinates']]
+        elif geometry['type'] == 'MultiPolygon':
+            geometry['coordinates'] = [[np.array(ring, dtype='float64') for ring in polygon]
+                                       for polygon in geometry['coordinates']]
+    return geojson
+
+
+class DatasetStore():
+    """Read each data file once and return the same object to every caller.
+
+    Returned objects are shared: callers must copy them before any change.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.frozen = False
+        self._lock = threading.Lock()
+
+    def _get(self, path, read, keep=True):
+        if path not in self.data:
+            if not keep:
+                return read(path)
+            with self._lock:
+                if path not in self.data:
+                    self.data[path] = read(path)
+        return self.data[path]
+
+    def read_pickle(self, path, keep=True):
+        """Frame of a pickle; with keep=False it is only shared if already loaded (preload)."""
+        return self._get(path, lambda p: compact_frame(pd.read_pickle(p)), keep)
+
+    def read_json(self, path):
+        def read(p):
+            with open(p) as f:
+                data = json.load(f)
+            return compact_geojson(data) if data.get('type') == 'FeatureCollection' else data
+        return self._get(path, read)
+
+    def forget(self, patterns):
+        """Drop the files matching the patterns, read again on next use."""
+        with self._lock:
+            for path in [p for p in self.data if any(fnmatch.fnmatch(p, pattern) for pattern in patterns)]:
+                del self.data[path]
+
+    def preload(self, patterns=DATA_FILES):
+        for pattern in patterns:
+            for path in sorted(glob.glob(pattern)):
+                if path.endswith('.pkl'):
+                    self.read_pickle(path)
+                else:
+                    self.read_json(path)
+
+    def freeze(self):
+        """To be called in the gunicorn master once everything is loaded, just before the fork."""
+        gc.collect()
+        gc.freeze()
+        self.frozen = True
+
+
+store = DatasetStore()
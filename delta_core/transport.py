@@ -0,0 +1,230 @@
+"""Smaller callback responses: compact figures and compressed HTTP bodies.
+
+``compact_figure`` rewrites the numeric arrays of the traces of a figure as
+plotly.js typed arrays (``{'dtype': 'f4', 'bdata': <base64>}``), which are
+about three times smaller than JSON numbers and decoded without parsing by the
+browser. Floats are sent as float32 and integers, or floats without decimals,
+in the smallest integer type which holds them. Floats which stay in mixed arrays (e.g. customdata with the
+department names) are rounded to DIGITS significant digits and dates at
+midnight lose their time. Typed arrays need plotly.js 2.28 in the browser:
+the version checked is the one of the bundle Dash serves, its own in
+dash/dcc for the Dash releases which have one, plotly's otherwise. With an
+older plotly.js the floats are rounded instead.
+
+``Compression`` gzips (or brotli-compresses when the brotli module is there
+and the browser accepts it) the JSON and text responses of the server. The
+compressed bodies are kept in a small LRU keyed by their content, so a figure
+served from the cache is not compressed again.
+
+Environment: DELTA_TYPED_ARRAYS=0 keeps plain JSON arrays, DELTA_COMPRESS=0
+disables the compression.
+"""
+import base64
+import collections
+import datetime
+import gzip
+import hashlib
+import os
+import re
+import threading
+
+import dash
+import flask
+import numpy as np
+from plotly.offline import get_plotlyjs_version
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from delta_core.metrics import metrics
+
+DIGITS = 6
+MIN_LENGTH = 16  # en dessous le JSON est aussi court
+# attributs des traces qui sont des tableaux de données pour plotly.js
+DATA_ARRAYS = {'x', 'y', 'z', 'customdata', 'lat', 'lon', 'values', 'color', 'size', 'open', 'high', 'low',
+               'close', 'base', 'width', 'r', 'theta', 'a', 'b', 'c', 'u', 'v', 'w', 'intensity'}
+INT_TYPES = [('u1', np.uint8), ('i1', np.int8), ('u2', np.uint16), ('i2', np.int16),
+             ('u4', np.uint32), ('i4', np.int32)]
+
+
+def served_plotlyjs_version():
+    """(major, minor) of the plotly.js served by Dash, None when it cannot be found."""
+    bundle = os.path.join(os.path.dirname(dash.dcc.__file__), 'async-plotlyjs.js')
+    if not os.path.isfile(bundle):  # Dash sert le plotly.js du paquet plotly
+        version = get_plotlyjs_version()
+    else:
+        version = None
+        for path in (bundle + '.LICENSE.txt', bundle):  # bannière « plotly.js v2.18.2 » du bundle de dcc
+            if os.path.isfile(path):
+                with open(path, encoding='utf-8', errors='replace') as f:
+                    m = re.search(r'plotly\.js v(\d+\.\d+)', f.read())
+                if m:
+                    version = m.group(1)
+                    break
+    try:
+        return tuple(int(v) for v in version.split('.')[:2])
+    except (AttributeError, ValueError):
+        return None
+
+
+def _typed_arrays_supported():
+    if os.environ.get('DELTA_TYPED_ARRAYS', '1') == '0':
+        return False
+    version = served_plotlyjs_version()
+    return version is not None and version >= (2, 28)
+
+
+TYPED_ARRAYS = _typed_arrays_supported()
+
+
+def round_significant(a, digits=DIGITS):
+    """Floats of ``a`` rounded to ``digits`` significant digits."""
+    a = np.asarray(a, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = 10.0 ** (digits - 1 - np.floor(np.log10(np.abs(a))))
+        rounded = np.round(a * scale) / scale
+    return np.where(np.isfinite(rounded), rounded, a)
+
+
+def typed_array(a):
+    """Plotly.js typed array of a numeric ndarray, or None when it should stay as it is."""
+    if a.dtype.kind == 'b' or a.dtype.kind not in 'iuf' or a.size < MIN_LENGTH or a.ndim > 2:
+        return None
+    if a.dtype.kind == 'f' and np.isfinite(a).all() and (a == np.round(a)).all():
+        a = a.astype(np.int64)  # des comptes rangés en flottants
+    if a.dtype.kind == 'f':
+        finite = a[np.isfinite(a)]
+        if finite.size and (np.abs(finite).max() > 1e38 or
+                            np.ptp(finite) < 1e-5 * np.abs(finite).max()):  # float32 ne les distinguerait plus
+            dtype, a = 'f8', a.astype('<f8')
+        else:
+            dtype, a = 'f4', a.astype('<f4')
+    else:
+        low, high = (a.min(), a.max()) if a.size else (0, 0)
+        for dtype, t in INT_TYPES:
+            info = np.iinfo(t)
+            if info.min <= low and high <= info.max:
+                a = a.astype(np.dtype(t).newbyteorder('<'))
+                break
+        else:
+            dtype, a = 'f8', a.astype('<f8')
+    res = {'dtype': dtype, 'bdata': base64.b64encode(np.ascontiguousarray(a).tobytes()).decode()}
+    if a.ndim == 2:
+        res['shape'] = f'{a.shape[0]}, {a.shape[1]}'
+    return res
+
+
+def short_dates(a):
+    """Dates as 'YYYY-MM-DD' when they are all at midnight, None otherwise."""
+    try:
+        a = a.astype('M8[ns]')
+    except (TypeError, ValueError):
+        return None
+    days = a.astype('M8[D]')
+    if (days != a)[~np.isnat(a)].any():
+        return None
+    return np.datetime_as_string(days, unit='D')
+
+
+def _compact_value(value):
+    if isinstance(value, (list, tuple, np.ndarray)):
+        a = np.asarray(value) if not isinstance(value, np.ndarray) else value
+        if a.dtype.kind in 'iuf':
+            if TYPED_ARRAYS:
+                typed = typed_array(a)
+                if typed is not None:
+                    return typed
+            return round_significant(a) if a.dtype.kind == 'f' else value
+        if a.dtype.kind == 'M' or (a.dtype.kind == 'O' and a.size and isinstance(a.flat[0], datetime.date)):
+            dates = short_dates(a)
+            if dates is not None:
+                return dates
+        if a.dtype.kind == 'O':  # tableau mixte, seuls les flottants sont arrondis
+            flat = a.ravel()
+            floats = np.array([isinstance(v, float) for v in flat], dtype=bool)
+            if floats.any():
+                flat = flat.copy()
+                flat[floats] = round_significant(flat[floats].astype(float)).tolist()
+                return flat.reshape(a.shape)
+    return value
+
+
+def _compact_trace(trace):
+    for key, value in trace.items():
+        if isinstance(value, dict):
+            _compact_trace(value)
+        elif key in DATA_ARRAYS:
+            trace[key] = _compact_value(value)
+    return trace
+
+
+def compact_figure(fig):
+    """Dict of the figure with its numeric trace arrays made compact."""
+    if hasattr(fig, 'to_dict'):
+        fig = fig.to_dict()
+    if isinstance(fig, dict) and isinstance(fig.get('data'), list):
+        for trace in fig['data']:
+            if isinstance(trace, dict):
+                _compact_trace(trace)
+    return fig
+
+
+class Compression():
+    MIMETYPES = {'application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript'}
+    MIN_SIZE = 1024
+
+    def __init__(self, level=6, cache_size=64):
+        self.level = level
+        self.enabled = os.environ.get('DELTA_COMPRESS', '1') != '0'
+        self.cache = collections.OrderedDict()  # (encoding, sha1 du corps) -> corps compressé
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def encoding(accept):
+        if brotli is not None and 'br' in accept:
+            return 'br'
+        if 'gzip' in accept:
+            return 'gzip'
+        return None
+
+    def compress(self, data, encoding):
+        key = (encoding, hashlib.sha1(data).digest())
+        with self._lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        if encoding == 'br':
+            body = brotli.compress(data, quality=5)
+        else:
+            body = gzip.compress(data, self.level, mtime=0)
+        with self._lock:
+            self.cache[key] = body
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return body
+
+    def init_app(self, server):
+        server.after_request(self._after)
+
+    def _after(self, response):
+        if (not self.enabled or response.status_code != 200 or response.direct_passthrough
+                or response.mimetype not in self.MIMETYPES or 'Content-Encoding' in response.headers):
+            return response
+        encoding = self.encoding(flask.request.headers.get('Accept-Encoding', ''))
+        data = response.get_data()
+        response.vary.add('Accept-Encoding')
+        if encoding is None or len(data) < self.MIN_SIZE:
+            return response
+        body = self.compress(data, encoding)
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        if flask.request.path.endswith('/_dash-update-component'):
+            label = metrics.output_label(flask.request.get_json(silent=True) or {})
+            metrics.observe('delta_callback_wire_bytes', label, len(body))
+        return response
+
+
+compression = Compression()
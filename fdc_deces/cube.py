@@ -0,0 +1,139 @@
+"""Deaths per day, sex and age bracket, from the columnar store of records.py.
+
+The cube of a year is a dense array of counts [day of the year, sex, age]
+with the sexes women then men and the ages in brackets of 5 years, the last
+but one for 100 and more and the last one for the unknown birth dates. As in
+the morts_par_jour files, the deaths whose day or month was 00 are left out,
+so the sum of the cube is the number of deaths per day.
+
+Each year is saved in fdc_deces/data/cube/<year>.npy. The manifest keeps the
+backups (and their signature) each year was built from, so an update only
+builds again the years found in new or changed backups.
+
+    python -m fdc_deces.cube         # after python -m fdc_deces.records build
+"""
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from fdc_deces import records
+
+CUBE_DIR = 'fdc_deces/data/cube'
+VERSION = 1
+BRACKET = 5
+AGES = [f'{a}-{a + BRACKET - 1}' for a in range(0, 100, BRACKET)] + ['100+', 'inconnu']
+SEXES = ['Femmes', 'Hommes']
+UNKNOWN = len(AGES) - 1
+
+
+def age_brackets(deces, naissance):
+    """Index in AGES of the age at death, from datetime64[D] arrays."""
+    dy, by = deces.astype('datetime64[Y]'), naissance.astype('datetime64[Y]')
+    dm, bm = deces.astype('datetime64[M]'), naissance.astype('datetime64[M]')
+    # l'anniversaire n'est pas encore passé si (mois, jour) du décès est avant celui de la naissance
+    before = ((dm - dy).astype(int) * 32 + (deces - dm).astype(int) <
+              (bm - by).astype(int) * 32 + (naissance - bm).astype(int))
+    age = (dy - by).astype(int) - before
+    res = np.clip(age // BRACKET, 0, UNKNOWN - 1)
+    return np.where(np.isnat(naissance) | (age < 0), UNKNOWN, res)
+
+
+def year_cube(parts, year):
+    """Cube of the deaths of a year from the scans of the store, as uint16 when it fits."""
+    first = np.datetime64(f'{year}-01-01', 'D')
+    days = int((np.datetime64(f'{year + 1}-01-01', 'D') - first).astype(int))
+    shape = (days, len(SEXES), len(AGES))
+    counts = np.zeros(np.prod(shape), dtype=np.int64)
+    for part in parts:
+        precise = part['deces_precise']
+        deces = part['deces'][precise]
+        cell = ((deces - first).astype(np.int64) * len(SEXES) + part['sexe'][precise]) * len(AGES) + \
+            age_brackets(deces, part['naissance'][precise])
+        counts += np.bincount(cell, minlength=len(counts))
+    dtype = np.uint16 if counts.max(initial=0) <= np.iinfo(np.uint16).max else np.uint32
+    return counts.astype(dtype).reshape(shape)
+
+
+def build(store_dir=records.RECORDS_DIR, directory=CUBE_DIR, force=False):
+    """Build the cubes of the years whose backups changed, return these years."""
+    store = records.RecordStore(store_dir)
+    inputs = {}  # année -> [[sauvegarde, signature]...]
+    for name in store.sources():
+        source = store.manifest['sources'][name]
+        for p in source['partitions']:
+            inputs.setdefault(p['year'], []).append([name, source['signature']])
+
+    manifest = read_manifest(directory)
+    os.makedirs(directory, exist_ok=True)
+    built = []
+    for year, used in sorted(inputs.items()):
+        if manifest['years'].get(str(year)) == used and not force:
+            continue
+        start = time.perf_counter()
+        parts = store.scan(['deces', 'deces_precise', 'naissance', 'sexe'], f'{year}-01-01', f'{year + 1}-01-01',
+                           [name for name, _ in used])
+        cube = year_cube(parts, year)
+        tmp = os.path.join(directory, f'{year}.{os.getpid()}.npy')
+        np.save(tmp, cube)
+        os.replace(tmp, os.path.join(directory, f'{year}.npy'))
+        manifest['years'][str(year)] = used
+        print(f"{year}: {cube.sum()} deaths in {time.perf_counter() - start:.2f} s")
+        built.append(year)
+    for year in set(manifest['years']) - {str(y) for y in inputs}:
+        del manifest['years'][year]
+        if os.path.isfile(os.path.join(directory, f'{year}.npy')):
+            os.remove(os.path.join(directory, f'{year}.npy'))
+    tmp = os.path.join(directory, f'manifest.json.{os.getpid()}')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, os.path.join(directory, 'manifest.json'))
+    return built
+
+
+def read_manifest(directory=CUBE_DIR):
+    try:
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest.get('version') == VERSION:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {'version': VERSION, 'years': {}}
+
+
+def exists(directory=CUBE_DIR):
+    return bool(glob.glob(os.path.join(directory, '*.npy')))
+
+
+def load(directory=CUBE_DIR):
+    """Cube of every year [day, sex, age] and its daily index, None when there is none."""
+    years = sorted(int(os.path.basename(p)[:-4]) for p in glob.glob(os.path.join(directory, '[0-9]*.npy')))
+    if not years:
+        return None, None
+    cubes = []
+    for year in range(years[0], years[-1] + 1):
+        if year in years:
+            cubes.append(np.load(os.path.join(directory, f'{year}.npy')))
+        else:  # année sans aucun décès dans les sauvegardes
+            days = int((np.datetime64(f'{year + 1}-01-01') - np.datetime64(f'{year}-01-01')).astype(int))
+            cubes.append(np.zeros((days, len(SEXES), len(AGES)), dtype=np.uint16))
+    index = pd.date_range(f'{years[0]}-01-01', f'{years[-1]}-12-31', freq='D', name='deces')
+    return np.concatenate(cubes), index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--store', default=records.RECORDS_DIR, help='directory of the records (default: %(default)s)')
+    parser.add_argument('--dir', default=CUBE_DIR, help='directory of the cubes (default: %(default)s)')
+    parser.add_argument('--force', action='store_true', help='build every year again')
+    args = parser.parse_args()
+    build(args.store, args.dir, args.force)
+
+
+if __name__ == '__main__':
+    main()
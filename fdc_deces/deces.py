@@ -1,5 +1,7 @@
 import sys
 import glob
+import collections
+import threading
 import dash
 import flask
 from dash import dcc
@@ -7,51 +9,89 @@ from dash import html
 import pandas as pd
 import numpy as np
 import plotly.graph_objs as go
-import plotly.express as px
 import dateutil as du
-from scipy import stats
-from scipy import fft
 import datetime
+from fdc_deces import cube, smoothing
+from delta_core.downsample import Pyramid
+from delta_core.pages import Page, needs_data
+from delta_core.cache import cached_figure
+from delta_core.figures import webgl
+from delta_core.store import store
+from delta_core.snapshot import snapshot
+
+# plotly.express et scipy sont importés là où ils servent car ils ralentissent le démarrage
+
+MAX_POINTS = 3000  # points par courbe envoyés au navigateur, environ deux par pixel
+
+
+def visible_range(relayout):
+    """Range of the x axis in a relayoutData, 'auto' when reset, None when the x axis did not change."""
+    if not relayout:
+        return None
+    if relayout.get('xaxis.autorange'):
+        return 'auto'
+    if 'xaxis.range[0]' in relayout and 'xaxis.range[1]' in relayout:
+        return [relayout['xaxis.range[0]'], relayout['xaxis.range[1]']]
+    if 'xaxis.range' in relayout:
+        return list(relayout['xaxis.range'])
+    return None
+
+
+class Deces(Page):
+    data_files = ['fdc_deces/data/morts_par_jour-*.pkl', 'fdc_deces/data/cube/*.npy']
+    MAX_MEANS = 32  # moyennes de sélections gardées
 
-class Deces():
     def __init__(self, application=None):
         self.dir = "fdc_deces/"
-        df = pd.concat([pd.read_pickle(f) for f in glob.glob(self.dir + 'data/morts_par_jour-*')])
+
+        if application:
+            self.app = application
+            # application should have its own layout and use self.main_layout as a page or in a component
+        else:
+            self.app = dash.Dash(__name__)
+            self.app.layout = self.layout
+
+        self.app.callback(
+            [dash.dependencies.Output('mpj-main-graph', 'figure'),
+             dash.dependencies.Output('mpj-view', 'data')],
+            [dash.dependencies.Input('mpj-mean', 'value'),
+             dash.dependencies.Input('mpj-main-graph', 'relayoutData'),
+             dash.dependencies.Input('mpj-sex', 'value'),
+             dash.dependencies.Input('mpj-age', 'value'),
+             dash.dependencies.Input('mpj-split', 'value')],
+            dash.dependencies.State('mpj-view', 'data'))(self.update_graph)
+
+    def build(self):
+        df = pd.concat([store.read_pickle(f) for f in glob.glob(self.dir + 'data/morts_par_jour-*')])
         df = df.groupby('deces').sum()
         df.sort_index(inplace=True)
         last_month = "02/2022"
         now = np.datetime64(datetime.datetime.now()).astype('datetime64[M]')
         df = df.loc['1973':now - np.timedelta64(2, 'M')]
 
-        # calcul de la moyenne journalière avec des fenêtres
-        # 2 passages pour retirer les valeurs qui dépassent l'écart type par rapport au sinus
-        width = 10
-        df2 = df.copy()
-        for _ in range(2):
-            prediction = pd.DataFrame({'x': np.zeros(len(df))}, index=df.index)
-            prediction_nb = pd.DataFrame({'x': np.zeros(len(df))}, index=df.index)
-            for step in range(1970, df.index[-1].year - width + 1):
-                dfp = df2.loc[f'{step}':f'{step + width}']
-                pente, v0 = np.polyfit(np.arange(len(dfp)), dfp.morts.values, 1)
-                y = fft.fft(dfp.morts)
-                y[y < 30 * len(dfp)] = 0
-                pred = fft.ifft(y)
-                pred -= dfp.morts.mean() - v0
-                pred += np.cumsum([pente, ] * len(dfp))
-                prediction.loc[f'{step}':f'{step + width}', 'x'] += pred
-                prediction_nb.loc[f'{step}':f'{step + width}', 'x'] += 1
-            prediction = np.array([p.real for p in prediction.x]) / prediction_nb.x
-            std = np.std(df.morts - prediction)
-            df2.morts[df2.morts > prediction + std] = prediction.astype('int') + int(std)
-            df2.morts[df2.morts < prediction - std] = prediction.astype('int') - int(std)
-        del df2
-
         self.df = df
-        self.day_mean = prediction
+        # make precompute met le résultat dans le snapshot
+        self.day_mean = snapshot.derived('fdc.day_mean', self.data_files[:1] + [smoothing.__file__],
+                                         lambda: self.compute_day_mean(df), str(now))
+        # enveloppes min/max précalculées, un zoom n'est qu'une tranche d'un niveau
+        self.pyramid = Pyramid(df.morts)
+        self.mean_pyramid = Pyramid(self.day_mean)
+
+        # décès par jour, sexe et tranche d'âge, aux jours de df, quand le cube a été construit
+        self.cube = None
+        self.selection_means = collections.OrderedDict()  # (sexes, âges) -> moyenne, la plus récente en dernier
+        self.means_lock = threading.Lock()
+        counts, index = cube.load(self.dir + 'data/cube')
+        if counts is not None:
+            positions = index.get_indexer(df.index)
+            self.cube = np.zeros((len(df),) + counts.shape[1:], dtype=counts.dtype)
+            self.cube[positions >= 0] = counts[positions[positions >= 0]]
+        last_age = len(cube.AGES) - 2  # 100+, les âges inconnus ne comptent qu'avec tous les âges
 
         self.main_layout = html.Div(children=[
             html.H3(children='Nombre de décès par jour en France'),
             html.Div([dcc.Graph(id='mpj-main-graph'), ], style={'width': '100%', }),
+            dcc.Store(id='mpj-view'),
             html.Div([dcc.RadioItems(id='mpj-mean',
                                      options=[{'label': 'Courbe seule', 'value': 0},
                                               {'label': 'Courbe + Tendence générale', 'value': 1},
@@ -61,10 +101,24 @@ class Deces():
                                      value=2,
                                      labelStyle={'display': 'block'}),
                       ]),
+            html.Div([
+                html.Br(),
+                dcc.Checklist(id='mpj-sex', options=[{'label': s, 'value': i} for i, s in enumerate(cube.SEXES)],
+                              value=[0, 1], inline=True),
+                dcc.RangeSlider(id='mpj-age', min=0, max=last_age, step=1, value=[0, last_age],
+                                marks={i: cube.AGES[i].split('-')[0] for i in range(0, last_age + 1, 2)}),
+                dcc.RadioItems(id='mpj-split',
+                               options=[{'label': 'Total', 'value': 'total'},
+                                        {'label': 'Empilé par sexe', 'value': 'sexe'},
+                                        {'label': "Empilé par tranche d'âge", 'value': 'age'}],
+                               value='total', inline=True),
+            ], style={'display': 'block' if self.cube is not None else 'none'}),
             html.Br(),
             dcc.Markdown("""
             Le graphique est interactif. En passant la souris sur les courbes vous avez une infobulle. 
             En utilisant les icônes en haut à droite, on peut agrandir une zone, déplacer la courbe, réinitialiser.
+            Vue de loin, la courbe garde le minimum et le maximum de chaque groupe de jours, en zoomant on retrouve
+            tous les jours. Sous les options, on peut choisir les sexes et les âges au décès (de 5 en 5 ans).
 
             Notes :
                * La grippe de l'hiver 1989-1990 a fait 20 000 morts (4,6 millions de malades en 11 semaines). La chute de la courbe au premier janvier 1990 est quand même très surprenante.
@@ -87,36 +141,120 @@ class Deces():
         }
         )
 
-        if application:
-            self.app = application
-            # application should have its own layout and use self.main_layout as a page or in a component
+    def compute_day_mean(self, df):
+        # les fenêtres déjà calculées sont gardées avec les données, seules les nouvelles sont calculées ;
+        # make precompute les écrit, les workers ne font que les lire
+        cache = smoothing.WindowCache(self.dir + 'data/day_mean_windows.pkl')
+        day_mean = smoothing.day_mean(df, cache=cache)
+        if snapshot.building:
+            cache.save()
+        return day_mean
+
+    def window(self, x_range):
+        """Level of the pyramid and positions of the data to send for a visible range (None for all).
+
+        The data cover the visible range and half of it on each side, for the pans, rounded so
+        that nearby zooms share the same figure in the cache.
+        """
+        n = len(self.df)
+        if x_range is None:
+            return self.pyramid.level(0, n, MAX_POINTS), 0, n
+        try:
+            start, end = self.df.index.searchsorted(pd.to_datetime(x_range))
+        except (TypeError, ValueError):
+            return self.pyramid.level(0, n, MAX_POINTS), 0, n
+        span = max(int(end - start), 1)
+        level = self.pyramid.level(start, start + span, MAX_POINTS)
+        step = 2**level * MAX_POINTS // 8
+        start = max(0, (start - span // 2) // step * step)
+        end = min(n, -(-(end + span // 2) // step) * step)
+        return level, int(start), int(end)
+
+    def selection(self, sexes, ages, split):
+        """Deaths per day of the selected sexes and ages, a column per group of the split, None for all."""
+        last_age = len(cube.AGES) - 2
+        all_ages = list(ages) == [0, last_age]
+        if self.cube is None or (sorted(sexes) == [0, 1] and all_ages and split == 'total'):
+            return None
+        sexes = sorted(sexes)
+        ages = range(len(cube.AGES)) if all_ages else range(ages[0], ages[1] + 1)
+        counts = self.cube[:, sexes][:, :, list(ages)].astype(np.int64)
+        if split == 'sexe':
+            columns = {cube.SEXES[s]: counts[:, i].sum(axis=1) for i, s in enumerate(sexes)}
+        elif split == 'age':
+            columns = {cube.AGES[a]: counts[:, :, i].sum(axis=1) for i, a in enumerate(ages)}
         else:
-            self.app = dash.Dash(__name__)
-            self.app.layout = self.main_layout
+            columns = {'morts': counts.sum(axis=(1, 2))}
+        return pd.DataFrame(columns, index=self.df.index)
 
-        self.app.callback(
-            dash.dependencies.Output('mpj-main-graph', 'figure'),
-            dash.dependencies.Input('mpj-mean', 'value'))(self.update_graph)
+    def selection_mean(self, key, total):
+        """Day mean of the total of a selection, the last ones are kept for the zooms."""
+        with self.means_lock:
+            if key in self.selection_means:
+                self.selection_means.move_to_end(key)
+                return self.selection_means[key]
+        res = smoothing.day_mean(pd.DataFrame({'morts': total}))
+        with self.means_lock:
+            self.selection_means[key] = res
+            while len(self.selection_means) > self.MAX_MEANS:
+                self.selection_means.popitem(last=False)
+        return res
+
+    @needs_data
+    def update_graph(self, mean, relayout, sexes, ages, split, view):
+        x_range = visible_range(relayout)
+        if x_range is None:  # autre changement de la mise en page, on garde le zoom connu
+            x_range = (view or {}).get('range')
+        elif x_range == 'auto':
+            x_range = None
+        window = list(self.window(x_range))
+        selection = [sorted(sexes or []), list(ages), split]
+        new_view = {'mean': mean, 'range': x_range, 'window': window, 'selection': selection}
+        if view and all(view.get(k) == new_view[k] for k in ['mean', 'window', 'selection']):
+            return dash.no_update, new_view
+        return self.figure(mean, *window, *selection), new_view
+
+    @cached_figure
+    def figure(self, mean, level, start, end, sexes=(0, 1), ages=(0, len(cube.AGES) - 2), split='total'):
+        import plotly.express as px
+        from scipy import stats
 
-    def update_graph(self, mean):
-        fig = px.line(self.df, template='plotly_white')
-        fig.update_traces(hovertemplate='%{y} décès le %{x:%d/%m/%y}', name='')
+        frame = self.selection(sexes, ages, split)
+        if frame is None:
+            df, day_mean, positions = self.df, self.day_mean, self.pyramid.at(level, start, end)
+            mean_positions = self.mean_pyramid.at(level, start, end)
+        else:
+            # les groupes empilés sont pris aux jours de l'enveloppe de leur somme
+            df = pd.DataFrame({'morts': frame.sum(axis=1)})
+            positions = Pyramid(df.morts).at(level, start, end)
+            day_mean = self.selection_mean((tuple(sexes), tuple(ages)), df.morts) if mean == 2 else None
+            mean_positions = Pyramid(day_mean).at(level, start, end) if mean == 2 else None
+
+        if frame is None or frame.shape[1] == 1:
+            fig = px.line(df.iloc[positions], template='plotly_white')
+            fig.update_traces(hovertemplate='%{y} décès le %{x:%d/%m/%y}', name='')
+        else:
+            fig = px.area(frame.iloc[positions], template='plotly_white')
+            fig.update_traces(hovertemplate='%{y} décès le %{x:%d/%m/%y}', line_width=0)
         fig.update_layout(
             # title = 'Évolution des prix de différentes énergies',
             xaxis=dict(title=""),  # , range=['2010', '2021']),
             yaxis=dict(title="Nombre de décès par jour"),
             height=450,
-            showlegend=False,
+            showlegend=frame is not None and frame.shape[1] > 1,
+            legend_title_text='',
+            uirevision='mpj',  # le zoom reste quand les données de la zone visible arrivent
         )
         if mean == 1:
-            reg = stats.linregress(np.arange(len(self.df)), self.df.morts)
-            fig.add_scatter(x=[self.df.index[0], self.df.index[-1]],
-                            y=[reg.intercept, reg.intercept + reg.slope * (len(self.df) - 1)], mode='lines',
-                            marker={'color': 'red'})
+            reg = stats.linregress(np.arange(len(df)), df.morts)
+            fig.add_scatter(x=[df.index[0], df.index[-1]],
+                            y=[reg.intercept, reg.intercept + reg.slope * (len(df) - 1)], mode='lines',
+                            marker={'color': 'red'}, showlegend=False)
         elif mean == 2:
-            fig.add_scatter(x=self.df.index, y=self.day_mean, mode='lines', marker={'color': 'red'})
+            fig.add_scatter(x=df.index[mean_positions], y=day_mean.iloc[mean_positions], mode='lines',
+                            marker={'color': 'red'}, showlegend=False)
 
-        return fig
+        return webgl(fig)
 
 
 if __name__ == '__main__':
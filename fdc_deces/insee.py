@@ -0,0 +1,320 @@
+"""Download and parse the INSEE files of deceased persons.
+
+Each line of a file is a record of fixed width: names, sex, birth date and
+place, death date and place and number of the death certificate. The lines
+are put in a matrix of bytes, one character per byte, whose columns are
+sliced for every field at once. Dates are checked and converted in bulk.
+A day or month at 00, which dateutil refuses, is set to 01 and the date gets
+the hour 6 to mark it as imprecise, as the original notebook did.
+
+The files of the years are downloaded and parsed in a process pool and the
+duplicated records are removed with a hash of the rows.
+
+    python -m fdc_deces.insee                        # update fdc_deces/data like get_data_deces.ipy
+    python -m fdc_deces.insee deces-2019.txt -o deces-2019.pkl
+"""
+import argparse
+import concurrent.futures
+import datetime
+import glob
+import json
+import os
+import re
+import urllib.request
+
+import numpy as np
+import pandas as pd
+
+from fdc_deces import cube, records
+
+API_URL = "https://www.data.gouv.fr/api/1/datasets/fichier-des-personnes-decedees/"
+WIDTH = 176
+FIELDS = {'nom_prenom': (0, 80), 'sexe': (80, 81), 'naissance': (81, 89), 'cp_naissance': (89, 94),
+          'ville_naissance': (94, 124), 'pays_naissance': (124, 154), 'deces': (154, 162),
+          'cp_deces': (162, 167), 'acte': (167, 176)}
+COLUMNS = ['nom', 'prenom', 'sexe', 'naissance', 'cp_naissance', 'ville_naissance', 'pays_naissance',
+           'deces', 'cp_deces', 'acte']
+IMPRECISE_HOUR = 6  # heure des dates dont le jour ou le mois était 00
+CHUNK = 50_000      # lignes copiées à la fois dans la matrice
+DAYS_IN_MONTH = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+def decode(data):
+    """Text of a file, in UTF-8 or else in latin-1 (some files are)."""
+    try:
+        return data.decode('UTF-8')
+    except UnicodeDecodeError:
+        return data.decode('ISO-8859-1')
+
+
+def byte_matrix(text):
+    """Matrix of the non-empty lines, one character per byte padded with spaces.
+
+    :return: the matrix, the start and end of the lines in the text, and the
+        indices of the lines with characters beyond latin-1 (replaced by ?).
+    """
+    buf = np.frombuffer(text.encode('latin-1', 'replace'), dtype=np.uint8)  # un caractère, un octet
+    ends = np.flatnonzero(buf == ord('\n'))
+    if len(buf) and buf[-1] != ord('\n'):
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64)
+    ends = ends - (ends > starts) * (buf[np.maximum(ends - 1, 0)] == ord('\r'))
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+
+    stride = starts[1] - starts[0] if len(starts) > 1 else 0
+    if (len(starts) > 1 and stride >= WIDTH and (np.diff(starts) == stride).all()
+            and starts[0] + stride * len(starts) <= len(buf) + 1):
+        # toutes les lignes ont la même longueur, le cas des fichiers de l'INSEE
+        rows = np.lib.stride_tricks.as_strided(buf[starts[0]:], (len(starts), WIDTH), (stride, 1))
+        matrix = np.where(np.arange(WIDTH) < (ends - starts)[:, None], rows, ord(' ')).astype(np.uint8)
+        return matrix, starts, ends, _wide_lines(text, starts)
+
+    matrix = np.full((len(starts), WIDTH), ord(' '), dtype=np.uint8)
+    cols = np.arange(WIDTH)
+    for c in range(0, len(starts), CHUNK):
+        s, e = starts[c:c + CHUNK], ends[c:c + CHUNK]
+        idx = s[:, None] + cols
+        inside = idx < e[:, None]
+        matrix[c:c + CHUNK][inside] = buf[idx[inside]]
+
+    return matrix, starts, ends, _wide_lines(text, starts)
+
+
+def _wide_lines(text, starts):
+    wide = [m.start() for m in re.finditer('[^\x00-\xff]', text)]
+    return np.unique(np.searchsorted(starts, wide, side='right') - 1)
+
+
+def to_str(block, start=None, end=None):
+    """Strings of the rows of a block of latin-1 bytes, from start to end (excluded)."""
+    width = block.shape[1]
+    if start is not None:
+        idx = start[:, None] + np.arange(width)
+        block = np.take_along_axis(block, np.clip(idx, 0, width - 1), axis=1)
+        block = np.where(idx < end[:, None], block, 0)  # les caractères nuls de la fin sont retirés par numpy
+    # un octet latin-1 a la valeur de son point de code, d'où la conversion directe en chaînes unicode
+    return np.ascontiguousarray(block, dtype=np.uint32).view(f'<U{width}').ravel().astype(object)
+
+
+def field(matrix, name, strip=False):
+    """Strings of a field, without the spaces around them when strip is True."""
+    a, b = FIELDS[name]
+    block = matrix[:, a:b]
+    if not strip:
+        return to_str(block)
+    text = block != ord(' ')
+    start = _first(text, b - a)
+    end = b - a - _first(text[:, ::-1], b - a)
+    return to_str(block, start, end)
+
+
+def digits(block):
+    """Integer value of columns of digits and whether they are all digits."""
+    d = block.astype(np.int64) - ord('0')
+    ok = ((d >= 0) & (d <= 9)).all(axis=1)
+    return (d * 10 ** np.arange(block.shape[1] - 1, -1, -1)).sum(axis=1), ok
+
+
+def _valid(year, month, day, ok):
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_ok = (month >= 1) & (month <= 12)
+    dim = DAYS_IN_MONTH[np.clip(month, 1, 12) - 1] + ((month == 2) & leap)
+    return ok & (year >= 1) & month_ok & (day >= 1) & (day <= dim)
+
+
+def before_01(block):
+    """Whether the 2 characters are before '01', as in max(s, '01') of the notebook."""
+    return (block[:, 0] < ord('0')) | ((block[:, 0] == ord('0')) & (block[:, 1] < ord('1')))
+
+
+def parse_dates(matrix, field):
+    """Dates YYYYMMDD of a field, with 00 set to 01 at 6 h, and whether they are valid.
+
+    Valid dates out of the range of pandas (before 1678) are NaT.
+    """
+    a, _ = FIELDS[field]
+    block = matrix[:, a:a + 8]
+    year, year_ok = digits(block[:, :4])
+    month, month_ok = digits(block[:, 4:6])
+    day, day_ok = digits(block[:, 6:8])
+    valid = _valid(year, month, day, year_ok & month_ok & day_ok)
+
+    # la date est refusée : jour et mois avant 01 sont mis à 01, l'heure à 6
+    repaired = ~valid
+    fix_month = repaired & before_01(block[:, 4:6])
+    fix_day = repaired & before_01(block[:, 6:8])
+    month = np.where(fix_month, 1, month)
+    day = np.where(fix_day, 1, day)
+    valid = _valid(year, month, day, year_ok & (month_ok | fix_month) & (day_ok | fix_day))
+
+    in_range = valid & (year >= 1678) & (year <= 2261)
+    dates = pd.to_datetime(pd.DataFrame({'year': np.where(in_range, year, 1970),
+                                         'month': np.where(in_range, month, 1),
+                                         'day': np.where(in_range, day, 1)}))
+    dates = dates + pd.to_timedelta(np.where(repaired, IMPRECISE_HOUR, 0), unit='h')
+    return dates.where(in_range).to_numpy(), valid
+
+
+def _first(mask, default):
+    """Column of the first True of each row, default when there is none."""
+    return np.where(mask.any(axis=1), mask.argmax(axis=1), default)
+
+
+def split_names(matrix):
+    """Name, first of the first names and whether there is a first name, from NOM*PRENOMS/."""
+    a, b = FIELDS['nom_prenom']
+    names = matrix[:, a:b]
+    cols = np.arange(b - a)
+    slash = _first(names == ord('/'), b - a)
+    before_slash = cols < slash[:, None]
+    star = _first((names == ord('*')) & before_slash, b - a)
+    separator = (names == ord(' ')) | (names == ord('*'))
+    end = _first(separator & before_slash & (cols > star[:, None]), b - a)
+    end = np.minimum(end, slash)
+    return (to_str(names, np.zeros(len(names), dtype=np.int64), np.minimum(star, slash)),
+            to_str(names, np.minimum(star + 1, b - a), end),
+            star < slash)
+
+
+def _split_line(line):
+    """Same fields as parse_records for a single line, for the lines beyond latin-1."""
+    nom_prenom = line[:80].split('/')[0]
+    nom, _, prenoms = nom_prenom.partition('*')
+    return {'nom': nom, 'prenom': prenoms.split('*')[0].split(' ')[0],
+            'ville_naissance': line[94:124].strip(), 'pays_naissance': line[124:154].strip(),
+            'acte': line[167:176].strip()}
+
+
+def parse_records(text):
+    """Dataframe of the records of an INSEE file, the invalid lines being dropped."""
+    matrix, starts, ends, wide_lines = byte_matrix(text)
+    nom, prenom, has_first_name = split_names(matrix)
+    naissance, naissance_ok = parse_dates(matrix, 'naissance')
+    deces, deces_ok = parse_dates(matrix, 'deces')
+    columns = {
+        'nom': nom,
+        'prenom': prenom,
+        'sexe': matrix[:, FIELDS['sexe'][0]] == ord('1'),  # True si homme
+        'naissance': naissance,
+        'cp_naissance': field(matrix, 'cp_naissance'),
+        'ville_naissance': field(matrix, 'ville_naissance', strip=True),
+        'pays_naissance': field(matrix, 'pays_naissance', strip=True),
+        'deces': deces,
+        'cp_deces': field(matrix, 'cp_deces'),
+        'acte': field(matrix, 'acte', strip=True),
+    }
+    if len(wide_lines):  # lignes avec des caractères hors latin-1, leurs textes sont pris dans la ligne
+        fixed = pd.DataFrame([_split_line(text[starts[i]:ends[i]]) for i in wide_lines])
+        for c in fixed.columns:
+            columns[c][wide_lines] = fixed[c].to_numpy()
+    df = pd.DataFrame({c: columns[c] for c in COLUMNS})
+    ok = has_first_name & naissance_ok & deces_ok & (ends - starts >= FIELDS['deces'][1])
+    return df[ok].reset_index(drop=True)
+
+
+def drop_duplicates(df):
+    """Dataframe without its duplicated rows, compared through a hash of each row."""
+    hashes = pd.util.hash_pandas_object(df, index=False)
+    return df[~hashes.duplicated().to_numpy()].reset_index(drop=True)
+
+
+def deaths_per_day(df):
+    """Number of deaths per day, without the imprecise dates, as the morts_par_jour files."""
+    deces = df['deces']
+    days = deces[deces.notna() & (deces.dt.hour != IMPRECISE_HOUR)].to_numpy().astype('datetime64[D]')
+    first, last = days.min(), days.max()
+    counts = np.bincount((days - first).astype(np.int64), minlength=int((last - first).astype(int)) + 1)
+    index = pd.date_range(first, last, freq='D', name='deces')
+    return pd.DataFrame({'morts': counts}, index=index)
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return parse_records(decode(f.read()))
+
+
+def fetch(url):
+    with urllib.request.urlopen(url) as response:
+        return parse_records(decode(response.read()))
+
+
+def fetch_all(urls, workers=None):
+    """Dataframes of the files, downloaded and parsed in a process pool."""
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(fetch, urls))
+
+
+def resources():
+    """URL of every file of the dataset, by title (deces-2019.txt, deces-2023-m01.txt...)."""
+    with urllib.request.urlopen(API_URL) as response:
+        return {d['title']: d['url'] for d in json.load(response)['resources']}
+
+
+def _exists(path):
+    return os.path.isfile(path) or os.path.isfile(path + '.bz2')
+
+
+def update(directory='fdc_deces/data', workers=None):
+    """Download the missing years, update the columnar store (records.py) and the morts_par_jour files."""
+    current_year = datetime.datetime.now().year
+    files = resources()
+
+    # une sauvegarde par décennie complète
+    for decade in range(1970, current_year, 10):
+        backup = os.path.join(directory, f"deces-{decade}-{min(current_year - 1, decade + 9)}.pkl")
+        print("Avons-nous le jeu complet : ", backup, "...", end=" ")
+        if _exists(backup):
+            print("oui")
+            continue
+        print("non. On télécharge")
+        years = range(decade, min(decade + 10, current_year))
+        df = pd.concat(fetch_all([files[f"deces-{year}.txt"] for year in years], workers))
+        if decade + 9 < current_year:
+            print(f"sauvegarde {backup}.bz2")
+            df.to_pickle(backup + '.bz2')
+
+    # la décennie courante avec les mois de l'année courante
+    decade = (current_year // 10) * 10
+    backup = os.path.join(directory, f"deces-{decade}-{current_year}.pkl")
+    if not _exists(backup):
+        res = []
+        previous = glob.glob(os.path.join(directory, f'deces-{decade}-{current_year - 1}*'))
+        if previous:
+            res.append(pd.read_pickle(previous[0]))
+        months = [f"deces-{current_year}-m{month:02}.txt" for month in range(1, 13)]
+        res += fetch_all([files[m] for m in months if m in files], workers)
+        df = drop_duplicates(pd.concat(res))
+        print(f"sauvegarde {backup}.bz2")
+        df.to_pickle(backup + '.bz2')
+        for path in previous:
+            os.remove(path)
+
+    # colonnes des sauvegardes nouvelles ou modifiées, puis nombre de morts par jour de chaque décennie
+    # et cubes par sexe et âge des années touchées
+    store = os.path.join(directory, 'records')
+    records.build(directory, store)
+    records.RecordStore(store).write_deaths_per_day(directory)
+    cube.build(store, os.path.join(directory, 'cube'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help='INSEE files to parse, else update the data directory')
+    parser.add_argument('-o', '--output', help='pickle of the parsed files (with --files)')
+    parser.add_argument('--dir', default='fdc_deces/data', help='data directory (default: %(default)s)')
+    parser.add_argument('--workers', type=int, help='processes of the pool (default: one per CPU)')
+    args = parser.parse_args()
+
+    if not args.files:
+        update(args.dir, args.workers)
+        return
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+        df = drop_duplicates(pd.concat(pool.map(read_file, args.files)))
+    print(f"{len(df)} records")
+    if args.output:
+        df.to_pickle(args.output)
+
+
+if __name__ == '__main__':
+    main()
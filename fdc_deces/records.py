@@ -0,0 +1,311 @@
+"""Columnar store of the death records, one memory-mapped numpy file per column.
+
+The decade backups deces-YYYY-YYYY.pkl.bz2 have to be decompressed and
+unpickled entirely, even to count the deaths per day. ``build`` converts each
+backup once into numeric columns saved as .npy files, partitioned by year of
+death and sorted by date of death:
+
+    fdc_deces/data/records/manifest.json
+    fdc_deces/data/records/<backup>/<year>/<column>.npy
+
+A backup holds the deaths registered during its years, some of them of earlier
+years, hence a partition per backup and year. The columns are
+
+    deces, naissance                   datetime64[D], NaT when unknown
+    deces_precise, naissance_precise   bool, False when the day or month was 00
+    sexe                               bool, True for men
+    cp_deces, cp_naissance             int32 (see encode_codes), -1 when not a code
+
+The names, places and certificate numbers stay in the backups. A query opens
+only the partitions whose dates overlap the range, maps only the requested
+columns and slices them with a binary search on deces, so memory is bounded by
+one partition with ``scan``.
+
+    python -m fdc_deces.records build      # after an update of the backups
+    python -m fdc_deces.records morts      # morts_par_jour files from the store
+    python -m fdc_deces.records check      # the morts_par_jour files add up to the store
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+RECORDS_DIR = 'fdc_deces/data/records'
+VERSION = 1
+COLUMNS = ['deces', 'deces_precise', 'naissance', 'naissance_precise', 'sexe', 'cp_deces', 'cp_naissance']
+IMPRECISE_HOUR = 6   # heure des dates dont le jour ou le mois était 00, voir insee.py
+CORSICA = {'2A': 100000, '2B': 200000}
+YEARS = re.compile(r'-(\d{4})-(\d{4})(?:\.pkl)?$')  # années d'une sauvegarde ou d'un fichier morts_par_jour
+
+
+def source_name(path):
+    """deces-2010-2019 for fdc_deces/data/deces-2010-2019.pkl.bz2."""
+    name = os.path.basename(path)
+    for ext in ('.bz2', '.pkl'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name
+
+
+def source_years(name):
+    """(2020, 2023) for deces-2020-2023 or morts_par_jour-2020-2023.pkl, None without years."""
+    m = YEARS.search(name)
+    return (int(m.group(1)), int(m.group(2))) if m else None
+
+
+def encode_codes(codes):
+    """INSEE commune codes as int32: 75056 -> 75056, 2A004 -> 100004, 2B033 -> 200033, else -1."""
+    idx, uniques = pd.factorize(np.asarray(codes, dtype=object))
+    res = np.full(len(uniques) + 1, -1, dtype=np.int32)  # le dernier pour les valeurs manquantes (-1)
+    for i, code in enumerate(uniques):
+        code = str(code).strip()
+        if len(code) != 5:
+            continue
+        if code.isdigit():
+            res[i] = int(code)
+        elif code[:2] in CORSICA and code[2:].isdigit():
+            res[i] = CORSICA[code[:2]] + int(code[2:])
+    return res[idx]
+
+
+def decode_codes(values):
+    """INSEE commune codes of encode_codes' integers, None for -1."""
+    idx, uniques = pd.factorize(np.asarray(values))
+    names = []
+    for v in uniques:
+        if v < 0:
+            names.append(None)
+        elif v >= min(CORSICA.values()):
+            prefix = max((base, p) for p, base in CORSICA.items() if base <= v)[1]
+            names.append(f'{prefix}{v - CORSICA[prefix]:03}')
+        else:
+            names.append(f'{v:05}')
+    return np.array(names, dtype=object)[idx]
+
+
+def _dates(series):
+    values = series.to_numpy(dtype='datetime64[ns]')
+    precise = series.dt.hour.to_numpy() != IMPRECISE_HOUR  # NaN != 6 pour NaT
+    return values.astype('datetime64[D]'), precise
+
+
+def encode(df):
+    """Numeric columns of a dataframe of records as read by insee.parse_records."""
+    deces, deces_precise = _dates(df['deces'])
+    naissance, naissance_precise = _dates(df['naissance'])
+    return {
+        'deces': deces,
+        'deces_precise': deces_precise,
+        'naissance': naissance,
+        'naissance_precise': naissance_precise,
+        'sexe': df['sexe'].to_numpy(dtype=bool),
+        'cp_deces': encode_codes(df['cp_deces']),
+        'cp_naissance': encode_codes(df['cp_naissance']),
+    }
+
+
+def _signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def write_source(df, name, directory=RECORDS_DIR):
+    """Write the partitions of a dataframe of records, return their description for the manifest."""
+    columns = encode(df)
+    deces = columns['deces']
+    order = np.argsort(deces, kind='stable')
+    order = order[~np.isnat(deces[order])]  # sans date de décès la ligne ne peut être rangée
+    columns = {c: v[order] for c, v in columns.items()}
+    deces = columns['deces']
+    years = deces.astype('datetime64[Y]')
+    bounds = np.flatnonzero(np.r_[True, years[1:] != years[:-1], True])
+
+    tmp = os.path.join(directory, f'{name}.tmp-{os.getpid()}')
+    shutil.rmtree(tmp, ignore_errors=True)
+    partitions = []
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        year = int(str(years[a]))
+        os.makedirs(os.path.join(tmp, str(year)))
+        for c, v in columns.items():
+            np.save(os.path.join(tmp, str(year), c + '.npy'), v[a:b])
+        partitions.append({'year': year, 'rows': int(b - a), 'first': str(deces[a]), 'last': str(deces[b - 1])})
+    target = os.path.join(directory, name)
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmp, target)
+    return partitions
+
+
+def build(data_dir='fdc_deces/data', directory=RECORDS_DIR, force=False):
+    """Convert the backups of data_dir which changed since the last build, return their names."""
+    os.makedirs(directory, exist_ok=True)
+    manifest = RecordStore(directory).manifest
+    sources = {}
+    for path in sorted(glob.glob(os.path.join(data_dir, 'deces-*.pkl*'))):
+        sources.setdefault(source_name(path), path)  # le .pkl avant le .pkl.bz2
+    built = []
+    for name, path in sources.items():
+        entry = manifest['sources'].get(name)
+        if entry is not None and entry['signature'] == _signature(path) and not force:
+            continue
+        start = time.perf_counter()
+        partitions = write_source(pd.read_pickle(path), name, directory)
+        manifest['sources'][name] = {'signature': _signature(path), 'partitions': partitions}
+        print(f"{name}: {sum(p['rows'] for p in partitions)} records in {time.perf_counter() - start:.1f} s")
+        built.append(name)
+    for name in set(manifest['sources']) - set(sources):  # sauvegarde disparue, par exemple l'année en cours
+        del manifest['sources'][name]
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    tmp = os.path.join(directory, f'manifest.json.{os.getpid()}')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, os.path.join(directory, 'manifest.json'))
+    return built
+
+
+class RecordStore():
+    """Read access to the columns written by build."""
+
+    def __init__(self, directory=RECORDS_DIR):
+        self.directory = directory
+        self.manifest = {'version': VERSION, 'sources': {}}
+        try:
+            with open(os.path.join(directory, 'manifest.json')) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == VERSION:
+                self.manifest = manifest
+        except (OSError, ValueError):
+            pass
+
+    def sources(self):
+        return sorted(self.manifest['sources'])
+
+    def partitions(self, start=None, end=None, sources=None):
+        """(source, year) of the partitions with deaths in [start, end)."""
+        start = np.datetime64(start, 'D') if start is not None else None
+        end = np.datetime64(end, 'D') if end is not None else None
+        res = []
+        for name in sources or self.sources():
+            for p in self.manifest['sources'][name]['partitions']:
+                if start is not None and np.datetime64(p['last']) < start:
+                    continue
+                if end is not None and np.datetime64(p['first']) >= end:
+                    continue
+                res.append((name, p['year']))
+        return res
+
+    def _column(self, name, year, column):
+        return np.load(os.path.join(self.directory, name, str(year), column + '.npy'), mmap_mode='r')
+
+    def scan(self, columns, start=None, end=None, sources=None):
+        """Dict of memory-mapped columns for each partition, restricted to the deaths in [start, end)."""
+        for name, year in self.partitions(start, end, sources):
+            a, b = 0, None
+            if start is not None or end is not None:
+                deces = self._column(name, year, 'deces')
+                a = deces.searchsorted(np.datetime64(start, 'D')) if start is not None else 0
+                b = deces.searchsorted(np.datetime64(end, 'D')) if end is not None else len(deces)
+            yield {c: self._column(name, year, c)[a:b] for c in columns}
+
+    def read(self, columns, start=None, end=None, sources=None):
+        """Dict of columns, in memory, for the deaths in [start, end)."""
+        parts = list(self.scan(columns, start, end, sources))
+        return {c: np.concatenate([p[c] for p in parts]) if parts else np.empty(0) for c in columns}
+
+    def deaths_per_day(self, start=None, end=None, sources=None):
+        """Number of deaths per day, without the imprecise dates, as the morts_par_jour files."""
+        first = last = None
+        counts = np.zeros(0, dtype=np.int64)
+        for part in self.scan(['deces', 'deces_precise'], start, end, sources):
+            days = part['deces'][part['deces_precise']]
+            if len(days) == 0:
+                continue
+            if first is None:
+                first = days[0]
+            if last is None or days[-1] > last:
+                last = days[-1]
+            if days[0] < first:  # les partitions d'une autre sauvegarde peuvent commencer plus tôt
+                counts = np.r_[np.zeros(int((first - days[0]).astype(int)), dtype=np.int64), counts]
+                first = days[0]
+            n = int((last - first).astype(int)) + 1
+            counts = np.r_[counts, np.zeros(n - len(counts), dtype=np.int64)]
+            counts += np.bincount((days - first).astype(np.int64), minlength=n)
+        index = pd.date_range(first, last, freq='D', name='deces') if first is not None else \
+            pd.DatetimeIndex([], name='deces')
+        return pd.DataFrame({'morts': counts}, index=index)
+
+    def write_deaths_per_day(self, data_dir='fdc_deces/data'):
+        """morts_par_jour-YYYY-YYYY.pkl of every backup, from the store.
+
+        The file of a backup replaced by one of the store, e.g. deces-2020-2023 by
+        deces-2020-2026, is removed: the page sums every morts_par_jour file and would count
+        its days twice. The backups are not in git, so a file whose years no backup of the
+        store covers is kept and ValueError is raised before anything is written. The sum
+        of the files is then checked against the store.
+        """
+        paths = {name: os.path.join(data_dir, name.replace('deces-', 'morts_par_jour-') + '.pkl')
+                 for name in self.sources()}
+        ranges = [r for r in map(source_years, paths) if r]
+        stale, uncovered = [], []
+        for path in sorted(set(glob.glob(os.path.join(data_dir, 'morts_par_jour-*.pkl'))) - set(paths.values())):
+            r = source_years(os.path.basename(path))
+            if r and any(r[0] <= last and first <= r[1] for first, last in ranges):
+                stale.append(path)
+            else:
+                uncovered.append(path)
+        if uncovered:
+            raise ValueError(f"no backup of the store {self.directory} replaces {', '.join(uncovered)}, "
+                             "build it from every backup first")
+        for path in stale:
+            os.remove(path)
+            print(f"suppression {path}")
+        for name, path in paths.items():
+            self.deaths_per_day(sources=[name]).to_pickle(path)
+            print(f"sauvegarde {path}")
+        self.check_deaths_per_day(data_dir)
+
+    def check_deaths_per_day(self, data_dir='fdc_deces/data'):
+        """Raise ValueError when the morts_par_jour files, summed as the page does, differ from the store."""
+        files = pd.concat([pd.read_pickle(p) for p in glob.glob(os.path.join(data_dir, 'morts_par_jour-*.pkl'))])
+        files = files.groupby('deces').sum().sort_index()
+        expected = self.deaths_per_day()
+        expected = expected[expected.morts > 0]
+        files = files[files.morts > 0]
+        if not files.index.equals(expected.index) or not (files.morts.to_numpy() == expected.morts.to_numpy()).all():
+            raise ValueError(f"the morts_par_jour files of {data_dir} give {files.morts.sum()} deaths, "
+                             f"the store {expected.morts.sum()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['build', 'morts', 'check', 'info'])
+    parser.add_argument('--data', default='fdc_deces/data', help='directory of the backups (default: %(default)s)')
+    parser.add_argument('--dir', default=RECORDS_DIR, help='directory of the store (default: %(default)s)')
+    parser.add_argument('--force', action='store_true', help='convert every backup again')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build(args.data, args.dir, args.force)
+    elif args.command == 'morts':
+        RecordStore(args.dir).write_deaths_per_day(args.data)
+    elif args.command == 'check':
+        RecordStore(args.dir).check_deaths_per_day(args.data)
+        print(f"the morts_par_jour files of {args.data} add up to the store")
+    else:
+        records = RecordStore(args.dir)
+        for name in records.sources():
+            partitions = records.manifest['sources'][name]['partitions']
+            print(f"{name}: {sum(p['rows'] for p in partitions)} records, "
+                  f"{partitions[0]['first']} .. {partitions[-1]['last']}" if partitions else f"{name}: empty")
+        start = time.perf_counter()
+        df = records.deaths_per_day()
+        print(f"deaths per day: {len(df)} days, {df.morts.sum()} deaths in {time.perf_counter() - start:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""Daily mean of the deaths, as a sum of the main frequencies over sliding windows.
+
+For each window of ``width`` + 1 years starting every year, the deaths are
+detrended with a linear fit, the frequencies whose real part is below
+30 deaths per day are removed and the trend is added back. The prediction of
+a day is the mean of the windows which contain it. This is done twice, the
+days further than one standard deviation from the first prediction being
+clipped before the second one.
+
+``day_mean`` stacks the windows of the same length and does the fits and the
+FFTs in a few numpy calls, ``day_mean_loop`` is the original loop, kept to
+check and time the former:
+
+    python -m fdc_deces.smoothing
+
+The smoothed values of a window only depend on the deaths of the window, so
+``WindowCache`` keeps them, keyed by a hash of these deaths, in
+fdc_deces/data/day_mean_windows.pkl. When a month of data is added only the
+last windows, and those of the second pass whose clipped values changed, are
+computed again. The second pass depends on the standard deviation of all the
+days, which moves with every month, so most of its windows change anyway: a
+monthly update computes about half of the windows, for the same result.
+"""
+import glob
+import hashlib
+import os
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def window_bounds(index, width=10):
+    """Start and end (excluded) positions of the windows in the daily index."""
+    steps = np.arange(1970, index[-1].year - width + 1)
+    starts = index.searchsorted(pd.to_datetime([f'{s}-01-01' for s in steps]))
+    ends = index.searchsorted(pd.to_datetime([f'{s + width + 1}-01-01' for s in steps]))
+    return starts, ends
+
+
+class WindowCache():
+    """Smoothed values of windows, keyed by the hash of their deaths, saved in a pickle file."""
+    VERSION = 1  # à changer avec le calcul d'une fenêtre
+
+    def __init__(self, path=None):
+        self.path = path
+        self.windows = {}
+        self.used = set()
+        self.computed = 0
+        if path is not None:
+            try:
+                with open(path, 'rb') as f:
+                    data = pickle.load(f)
+                if data.get('version') == self.VERSION:
+                    self.windows = data['windows']
+            except (OSError, pickle.UnpicklingError, EOFError):
+                pass
+
+    @staticmethod
+    def key(w):
+        return hashlib.sha1(w.tobytes()).hexdigest()
+
+    def save(self):
+        """Write the windows used by the last computations, the others are dropped."""
+        windows = {k: v for k, v in self.windows.items() if k in self.used}
+        tmp = f"{self.path}.{os.getpid()}"
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump({'version': self.VERSION, 'windows': windows}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path)
+        except OSError:  # données en lecture seule, le cache n'est qu'une optimisation
+            pass
+
+
+def _smooth(w):
+    """Smoothed values of windows of the same length, one per row."""
+    from scipy import fft
+
+    n = w.shape[1]
+    # np.polyfit(x, w, 1) de chaque fenêtre
+    x = np.arange(n) - (n - 1) / 2
+    mean = w.mean(axis=1)
+    slope = (w - mean[:, None]) @ x / (x @ x)
+    v0 = mean - slope * (n - 1) / 2
+    y = fft.fft(w, axis=1)
+    # comparaison des complexes de numpy : partie réelle puis partie imaginaire
+    y[(y.real < 30 * n) | ((y.real == 30 * n) & (y.imag < 0))] = 0
+    pred = fft.ifft(y, axis=1).real
+    pred += (v0 - mean)[:, None] + slope[:, None] * np.arange(1, n + 1)
+    return pred
+
+
+def _predict(values, starts, ends, cache=None):
+    """Mean over the windows of the smoothed values of each window."""
+    total = np.zeros(len(values))
+    count = np.zeros(len(values) + 1)
+    np.add.at(count, starts, 1)
+    np.add.at(count, ends, -1)
+    for n in np.unique(ends - starts):
+        group = starts[ends - starts == n]
+        idx = group[:, None] + np.arange(n)
+        w = values[idx]
+        if cache is None:
+            pred = _smooth(w)
+        else:
+            keys = [cache.key(row) for row in w]
+            missing = [i for i, k in enumerate(keys) if k not in cache.windows]
+            if missing:
+                for i, row in zip(missing, _smooth(w[missing])):
+                    cache.windows[keys[i]] = row
+                cache.computed += len(missing)
+            cache.used.update(keys)
+            pred = np.stack([cache.windows[k] for k in keys])
+        total += np.bincount(idx.ravel(), weights=pred.ravel(), minlength=len(values))
+    return total / np.cumsum(count)[:-1]
+
+
+def day_mean(df, width=10, cache=None):
+    """Daily mean of ``df.morts`` (daily index), as a Series named x.
+
+    With a WindowCache, only the windows which are not in it are computed.
+    """
+    starts, ends = window_bounds(df.index, width)
+    morts = df.morts.to_numpy()
+    clipped = morts.copy()
+    for _ in range(2):
+        prediction = _predict(clipped.astype(float), starts, ends, cache)
+        std = np.std(morts - prediction)
+        clipped = np.where(clipped > prediction + std, prediction.astype(int) + int(std), clipped)
+        clipped = np.where(clipped < prediction - std, prediction.astype(int) - int(std), clipped)
+    return pd.Series(prediction, index=df.index, name='x')
+
+
+def day_mean_loop(df, width=10):
+    """Original computation of day_mean, one window at a time."""
+    from scipy import fft
+
+    df2 = df.copy()
+    for _ in range(2):
+        prediction = pd.DataFrame({'x': np.zeros(len(df))}, index=df.index)
+        prediction_nb = pd.DataFrame({'x': np.zeros(len(df))}, index=df.index)
+        for step in range(1970, df.index[-1].year - width + 1):
+            dfp = df2.loc[f'{step}':f'{step + width}']
+            pente, v0 = np.polyfit(np.arange(len(dfp)), dfp.morts.values, 1)
+            y = fft.fft(dfp.morts)
+            y[y < 30 * len(dfp)] = 0
+            pred = fft.ifft(y)
+            pred -= dfp.morts.mean() - v0
+            pred += np.cumsum([pente, ] * len(dfp))
+            prediction.loc[f'{step}':f'{step + width}', 'x'] += pred
+            prediction_nb.loc[f'{step}':f'{step + width}', 'x'] += 1
+        prediction = np.array([p.real for p in prediction.x]) / prediction_nb.x
+        std = np.std(df.morts - prediction)
+        df2.morts[df2.morts > prediction + std] = prediction.astype('int') + int(std)
+        df2.morts[df2.morts < prediction - std] = prediction.astype('int') - int(std)
+    return prediction
+
+
+def main():
+    import warnings
+    warnings.simplefilter('ignore')  # SettingWithCopyWarning de la boucle d'origine
+
+    df = pd.concat([pd.read_pickle(f) for f in glob.glob('fdc_deces/data/morts_par_jour-*')])
+    df = df.groupby('deces').sum().sort_index()
+    now = np.datetime64('now').astype('datetime64[M]')
+    df = df.loc['1973':now - np.timedelta64(2, 'M')]
+
+    times = {}
+    results = {}
+    for name, compute in [('loop', day_mean_loop), ('batched', day_mean)]:
+        compute(df)  # échauffement (import de scipy)
+        start = time.perf_counter()
+        results[name] = compute(df)
+        times[name] = time.perf_counter() - start
+        print(f"{name:8} {times[name]:8.3f} s")
+    diff = np.abs(results['batched'].to_numpy() - results['loop'].to_numpy())
+    print(f"speedup {times['loop'] / times['batched']:.1f}x, max difference {diff.max():.2e} deaths per day")
+
+    # mise à jour mensuelle : le cache est rempli sans le dernier mois
+    cache = WindowCache()
+    last_month = df.index[-1].to_period('M').start_time
+    day_mean(df.loc[:last_month - pd.Timedelta(days=1)], cache=cache)
+    cache.computed = 0
+    start = time.perf_counter()
+    incremental = day_mean(df, cache=cache)
+    elapsed = time.perf_counter() - start
+    diff = np.abs(incremental.to_numpy() - results['batched'].to_numpy())
+    print(f"one more month: {cache.computed} of {2 * len(window_bounds(df.index)[0])} windows computed, "
+          f"{elapsed:.3f} s, max difference {diff.max():.2e}")
+
+
+if __name__ == '__main__':
+    main()
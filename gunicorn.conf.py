@@ -0,0 +1,8 @@
+"""Settings read by gunicorn from the working directory, the command line giving the others."""
+
+
+def post_fork(server, worker):
+    # pool des callbacks lourds créé avant les threads du worker : ses processus en sont des forks sûrs
+    import delta  # déjà importé par le maître avec --preload
+    from delta_core.pool import heavy
+    heavy.start(delta.pages.pages.values())
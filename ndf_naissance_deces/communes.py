@@ -0,0 +1,221 @@
+"""Communes of a department, for the drill-down of the ndf maps.
+
+The contours of the ~35,000 communes are too heavy for one map, so ``build``
+cuts a national geojson of the communes (properties code and nom, e.g. the
+communes of france-geojson) into one shard per department, simplified once
+for the zooms at which a department fills the map (TOLERANCE):
+
+    ndf_naissance_deces/data/communes/<department>.json
+    ndf_naissance_deces/data/communes/index.npz     code, nom, departement, centroid, bbox of each commune
+
+The drill-down is disabled when there is no index. The births and deaths per
+commune come from get_data.py (commune_naissance<yy>.pkl and
+commune_deces<yy>.pkl) when the INSEE files carry the commune.
+
+Plotly selects a shape of a choropleth by its centroid, so the lasso and box
+selections of the commune map are resolved on the server with a grid index
+of the centroids of the department instead of the list of selected points.
+
+    python -m ndf_naissance_deces.communes communes.geojson
+"""
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from ndf_naissance_deces import geometry
+
+SHARDS_DIR = 'ndf_naissance_deces/data/communes'
+TOLERANCE = 0.001  # un tiers de pixel au zoom 9, où une petite commune remplit la carte
+CELL = 0.05        # côté en degrés d'une case de la grille, quelques communes par case
+
+
+def department(code):
+    """Department of an INSEE commune code: '2A004' -> '2A', '97105' -> '971', '75056' -> '75'."""
+    return code[:3] if code.startswith('97') else code[:2]
+
+
+def _polygons(geom):
+    return [geom['coordinates']] if geom['type'] == 'Polygon' else geom['coordinates']
+
+
+def centroid(geom):
+    """Centroid of the outer ring of the largest polygon of a geometry."""
+    best, best_area = None, -1
+    for rings in _polygons(geom):
+        ring = np.asarray(rings[0], dtype=float)
+        x, y = ring[:, 0], ring[:, 1]
+        cross = x[:-1] * y[1:] - x[1:] * y[:-1]
+        area = cross.sum() / 2
+        if abs(area) > best_area:
+            best_area = abs(area)
+            if area == 0:
+                best = ring.mean(axis=0)
+            else:
+                best = np.array([((x[:-1] + x[1:]) * cross).sum(), ((y[:-1] + y[1:]) * cross).sum()]) / (6 * area)
+    return best
+
+
+def bbox(geom):
+    points = np.concatenate([np.asarray(rings[0], dtype=float) for rings in _polygons(geom)])
+    return np.r_[points.min(axis=0), points.max(axis=0)]
+
+
+def contains(polygon, points):
+    """Mask of the points inside the polygon (even-odd rule), both as (n, 2) arrays."""
+    polygon = np.asarray(polygon, dtype=float)
+    x, y = points[:, 0], points[:, 1]
+    inside = np.zeros(len(points), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for (xa, ya), (xb, yb) in zip(polygon, np.roll(polygon, 1, axis=0)):
+            crosses = (ya > y) != (yb > y)
+            inside ^= crosses & (x < (xb - xa) * (y - ya) / (yb - ya) + xa)
+    return inside
+
+
+class GridIndex():
+    """Points put in square cells, to find those in a box or a polygon without testing them all."""
+
+    def __init__(self, points, cell=CELL):
+        self.points = np.asarray(points, dtype=float).reshape(-1, 2)
+        self.cell = cell
+        self.origin = self.points.min(axis=0) if len(self.points) else np.zeros(2)
+        cells = self._cells(self.points)
+        self.shape = cells.max(axis=0) + 1 if len(cells) else np.ones(2, dtype=int)
+        ids = cells[:, 0] * self.shape[1] + cells[:, 1]
+        self.order = np.argsort(ids, kind='stable')  # positions rangées par case
+        self.starts = np.searchsorted(ids[self.order], np.arange(self.shape[0] * self.shape[1] + 1))
+
+    def _cells(self, xy):
+        return np.floor((xy - self.origin) / self.cell).astype(int)
+
+    def in_box(self, x0, y0, x1, y1):
+        """Sorted positions of the points in the box."""
+        low = np.clip(self._cells(np.array([min(x0, x1), min(y0, y1)])), 0, self.shape - 1)
+        high = np.clip(self._cells(np.array([max(x0, x1), max(y0, y1)])), 0, self.shape - 1)
+        # les cases d'une colonne se suivent dans l'ordre des points
+        columns = [self.order[self.starts[i * self.shape[1] + low[1]]:self.starts[i * self.shape[1] + high[1] + 1]]
+                   for i in range(low[0], high[0] + 1)]
+        candidates = np.concatenate(columns) if columns else np.zeros(0, dtype=int)
+        p = self.points[candidates]
+        inside = ((p[:, 0] >= min(x0, x1)) & (p[:, 0] <= max(x0, x1)) &
+                  (p[:, 1] >= min(y0, y1)) & (p[:, 1] <= max(y0, y1)))
+        return np.sort(candidates[inside])
+
+    def in_polygon(self, polygon):
+        """Sorted positions of the points in the polygon."""
+        polygon = np.asarray(polygon, dtype=float)
+        if len(polygon) < 3:
+            return np.zeros(0, dtype=int)
+        candidates = self.in_box(*polygon.min(axis=0), *polygon.max(axis=0))
+        return candidates[contains(polygon, self.points[candidates])]
+
+
+def build(source, directory=SHARDS_DIR):
+    """Write the shards and the index of a national geojson of the communes."""
+    with open(source) as f:
+        features = json.load(f)['features']
+    by_department = {}
+    for feature in features:
+        by_department.setdefault(department(feature['properties']['code']), []).append(feature)
+
+    os.makedirs(directory, exist_ok=True)
+    index = {'code': [], 'nom': [], 'departement': [], 'centroid': [], 'bbox': []}
+    for dep, features in sorted(by_department.items()):
+        shard = geometry.simplify({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {'code': f['properties']['code']}, 'geometry': f['geometry']}
+            for f in features]}, TOLERANCE)
+        tmp = os.path.join(directory, f'{dep}.json.{os.getpid()}')
+        with open(tmp, 'w') as f:
+            json.dump(shard, f, separators=(',', ':'))
+        os.replace(tmp, os.path.join(directory, f'{dep}.json'))
+        for feature in features:
+            index['code'].append(feature['properties']['code'])
+            index['nom'].append(feature['properties'].get('nom', ''))
+            index['departement'].append(dep)
+            index['centroid'].append(centroid(feature['geometry']))
+            index['bbox'].append(bbox(feature['geometry']))
+        print(f"{dep}: {len(features)} communes, {os.path.getsize(os.path.join(directory, f'{dep}.json'))} bytes")
+    tmp = os.path.join(directory, f'index.{os.getpid()}.npz')
+    np.savez(tmp, **{k: np.array(v) for k, v in index.items()})
+    os.replace(tmp, os.path.join(directory, 'index.npz'))
+
+
+class Communes():
+    """Index and shards of the communes written by build."""
+
+    def __init__(self, directory=SHARDS_DIR):
+        self.directory = directory
+        with np.load(os.path.join(directory, 'index.npz')) as index:
+            self.codes = index['code'].astype(object)
+            self.names = index['nom'].astype(object)
+            self.deps = index['departement'].astype(str)
+            self.centroids = index['centroid']
+            self.bboxes = index['bbox']
+        self.order = np.argsort(self.deps, kind='stable')
+        deps, starts = np.unique(self.deps[self.order], return_index=True)
+        self.ranges = dict(zip(deps, zip(starts, np.r_[starts[1:], len(self.order)])))
+        self.grids = {}   # département -> GridIndex, à la première sélection
+        self.shards = {}  # département -> (JSON, ETag), à la première demande
+
+    @classmethod
+    def load(cls, directory=SHARDS_DIR):
+        """Communes of the directory, None when they were not built."""
+        if not os.path.isfile(os.path.join(directory, 'index.npz')):
+            return None
+        return cls(directory)
+
+    def __contains__(self, dep):
+        return dep in self.ranges
+
+    def of_department(self, dep):
+        """Positions of the communes of a department, in the order of the index."""
+        start, end = self.ranges[dep]
+        return np.sort(self.order[start:end])
+
+    def bounds(self, dep):
+        """(lon min, lat min, lon max, lat max) of a department."""
+        boxes = self.bboxes[self.of_department(dep)]
+        return np.r_[boxes[:, :2].min(axis=0), boxes[:, 2:].max(axis=0)]
+
+    def shard(self, dep):
+        """JSON and ETag of the contours of the communes of a department."""
+        if dep not in self.shards:
+            with open(os.path.join(self.directory, f'{dep}.json'), 'rb') as f:
+                data = f.read()
+            self.shards[dep] = (data, hashlib.sha1(data).hexdigest()[:16])
+        return self.shards[dep]
+
+    def select(self, dep, selected_data):
+        """Positions of the communes of a department selected on its map.
+
+        :param selected_data: selected data of the commune map, with lassoPoints or range for a
+            lasso or box selection, else the locations of the clicked communes.
+        """
+        positions = self.of_department(dep)
+        if not selected_data:
+            return positions[:0]
+        if dep not in self.grids:
+            self.grids[dep] = GridIndex(self.centroids[positions])
+        grid = self.grids[dep]
+        if selected_data.get('lassoPoints'):
+            return positions[grid.in_polygon(next(iter(selected_data['lassoPoints'].values())))]
+        if selected_data.get('range'):
+            (x0, y0), (x1, y1) = next(iter(selected_data['range'].values()))
+            return positions[grid.in_box(x0, y0, x1, y1)]
+        codes = {p.get('location') for p in selected_data.get('points', [])}
+        return positions[np.isin(self.codes[positions], list(codes))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='geojson of the communes of France')
+    parser.add_argument('--dir', default=SHARDS_DIR, help='output directory (default: %(default)s)')
+    args = parser.parse_args()
+    build(args.source, args.dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Dense arrays of the ndf data, indexed [year, department, month / age / city size].
+
+The pickles hold one frame per year indexed by (department, key). The pages
+only ask for sums over a selection of departments, so each column becomes a
+float array whose departments are those of the map, in the order of
+``dep_idx_map``: a selection is then a fancy index and a sum, and every year
+together a sum of the arrays of the years (on the union of their axes when
+they differ, see ``on_axis``).
+
+Missing (department, key) pairs are zeros, keys out of the axis are clipped
+to its ends when ``clip`` is set (ages 17 and less, 46 and more) and dropped
+otherwise.
+"""
+import numpy as np
+import pandas as pd
+
+
+def dense(frames, column, deps, axis, key=None, clip=False):
+    """Array [year, department, axis] of a column of frames indexed by (department, key).
+
+    :param frames: frames of every year.
+    :param column: column to take.
+    :param deps: departments of the second axis.
+    :param axis: keys of the third axis.
+    :param key: function of the second level of the index giving the key, e.g. the month of a date.
+    :param clip: whether the keys out of the axis go to its ends.
+    :return: float array.
+    """
+    res = np.zeros((len(frames), len(deps), len(axis)))
+    dep_index = pd.Index(deps)
+    axis_index = pd.Index(axis)
+    for y, df in enumerate(frames):
+        keys = df.index.get_level_values(1)
+        if key is not None:
+            keys = key(keys)
+        if clip:
+            keys = np.clip(keys, axis[0], axis[-1])
+        d = dep_index.get_indexer(df.index.get_level_values(0))
+        k = axis_index.get_indexer(keys)
+        ok = (d >= 0) & (k >= 0)
+        np.add.at(res[y], (d[ok], k[ok]), df[column].to_numpy(dtype=float)[ok])
+    return res
+
+
+def on_axis(rows, axis, target):
+    """[department, target] of rows [department, axis], zeros for the keys of target which are not in axis."""
+    res = np.zeros((rows.shape[0], len(target)))
+    res[:, pd.Index(target).get_indexer(axis)] = rows
+    return res
@@ -0,0 +1,97 @@
+"""Simplified versions of the department contours, one per zoom level.
+
+The maps only need the precision of a pixel, so each level keeps the points
+of the contours which are farther than its tolerance (in degrees) from the
+simplified line (Douglas-Peucker) and rounds the coordinates accordingly.
+"""
+import hashlib
+import json
+import math
+
+import numpy as np
+
+DEFAULT_ZOOM = 4.42
+# (zoom minimal, tolérance en degrés), la tolérance est d'un tiers de pixel au zoom minimal
+# sachant qu'un pixel fait 360 / (256 * 2**zoom) degrés
+LEVELS = [(0, 0.02), (5.5, 0.008), (7, 0.003), (8.5, 0)]
+
+
+def level_for_zoom(zoom):
+    """Index in LEVELS of the geometry to use at this mapbox zoom."""
+    if zoom is None:
+        zoom = DEFAULT_ZOOM
+    return max(i for i, (min_zoom, _) in enumerate(LEVELS) if zoom >= min_zoom)
+
+
+def _keep(points, tolerance):
+    """Mask of the points kept by Douglas-Peucker on an open line."""
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        a, b = points[start], points[end]
+        ab = b - a
+        p = points[start + 1:end] - a
+        norm = math.hypot(*ab)
+        if norm == 0:
+            dist = np.hypot(p[:, 0], p[:, 1])
+        else:
+            dist = np.abs(ab[0] * p[:, 1] - ab[1] * p[:, 0]) / norm
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance:
+            mid = start + 1 + i
+            keep[mid] = True
+            stack += [(start, mid), (mid, end)]
+    return keep
+
+
+def simplify_ring(ring, tolerance):
+    """Ring simplified to the tolerance, closed, possibly with less than 4 points."""
+    ring = np.asarray(ring, dtype=float)
+    if tolerance <= 0 or len(ring) <= 4:
+        return ring
+    # un anneau est fermé : on le coupe au point le plus éloigné du premier
+    far = int(np.argmax(np.hypot(*(ring - ring[0]).T)))
+    keep = np.concatenate([_keep(ring[:far + 1], tolerance)[:-1], _keep(ring[far:], tolerance)])
+    return ring[keep]
+
+
+def _simplify_polygon(rings, tolerance):
+    res = []
+    for i, ring in enumerate(rings):
+        ring = simplify_ring(ring, tolerance)
+        if len(ring) >= 4:
+            res.append(ring)
+        elif i == 0:  # le contour extérieur disparaît, donc le polygone
+            return None
+    return res
+
+
+def simplify(geojson, tolerance):
+    """Copy of the geojson with every polygon simplified, coordinates as lists."""
+    decimals = 6 if tolerance <= 0 else max(2, 1 - math.floor(math.log10(tolerance)))
+    features = []
+    for feature in geojson['features']:
+        geometry = feature['geometry']
+        polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+        simplified = [p for p in (_simplify_polygon(rings, tolerance) for rings in polygons) if p is not None]
+        if not simplified:  # département plus petit que la tolérance, on le garde tel quel
+            simplified = [[np.asarray(ring, dtype=float) for ring in rings] for rings in polygons]
+        coordinates = [[np.round(ring, decimals).tolist() for ring in rings] for rings in simplified]
+        features.append(dict(feature, geometry={
+            'type': geometry['type'],
+            'coordinates': coordinates[0] if geometry['type'] == 'Polygon' else coordinates,
+        }))
+    return dict(geojson, features=features)
+
+
+def levels(geojson):
+    """JSON and ETag of the geojson at each level of LEVELS."""
+    res = []
+    for _, tolerance in LEVELS:
+        data = json.dumps(simplify(geojson, tolerance), separators=(',', ':')).encode()
+        res.append((data, hashlib.sha1(data).hexdigest()[:16]))
+    return res
@@ -1,78 +1,197 @@
-import json
+"""Build the birth and death aggregates of ndf from the INSEE civil status files.
+
+Each year needs the zip of the births (etatcivil2019_nais2019_csv.zip) and
+the one of the deaths (etatcivil2019_dec2019_csv.zip), given by year for the
+known URLs or as local paths. The CSVs are read in chunks of the useful
+columns only, each chunk is counted by groupby and the counts of the chunks
+are summed, so the rows are never all in memory. Dates and department codes
+are built on the counts, not on the rows. The years run in parallel.
+
+When the files carry the commune of birth or death (COMNAIS, COMDEC), the
+counts per commune are saved too, for the drill-down of communes.py.
+
+    python ndf_naissance_deces/get_data.py 2018 2019 2020
+    python ndf_naissance_deces/get_data.py etatcivil2021_nais2021_csv.zip etatcivil2021_dec2021_csv.zip
+"""
+import argparse
+import concurrent.futures
+import os
+import re
+import ssl
 from io import BytesIO
 from urllib.request import urlopen
 from zipfile import ZipFile
 
-import dateutil as du
 import pandas as pd
-import ssl
+
+from ndf_naissance_deces.transform_data import fix_dep_codes
+
 ssl._create_default_https_context = ssl._create_unverified_context
 
-from transform_data import *
-def get_data_from_url(url, as_str):
-    """Unzip the data and return the dataframe.
+URLS = {
+    2018: ('https://www.insee.fr/fr/statistiques/fichier/4215180/etatcivil2018_nais2018_csv.zip',
+           'https://www.insee.fr/fr/statistiques/fichier/4216603/etatcivil2018_dec2018_csv.zip'),
+    2019: ('https://www.insee.fr/fr/statistiques/fichier/4768335/etatcivil2019_nais2019_csv.zip',
+           'https://www.insee.fr/fr/statistiques/fichier/4801913/etatcivil2019_dec2019_csv.zip'),
+    2020: ('https://www.insee.fr/fr/statistiques/fichier/5419785/etatcivil2020_nais2020_csv.zip',
+           'https://www.insee.fr/fr/statistiques/fichier/5431034/etatcivil2020_dec2020_csv.zip'),
+}
+# colonnes lues, les départements en texte et le reste en flottants pour accepter les valeurs manquantes
+NAISSANCE_COLUMNS = {'DEPNAIS': str, 'DEPDOM': str, 'ANAIS': float, 'MNAIS': float, 'TUDOM': float,
+                     'AGEMERE': float, 'AGEPERE': float}
+DECES_COLUMNS = {'DEPDEC': str, 'ADEC': float, 'MDEC': float, 'ANAIS': float, 'SEXE': float}
+# commune de naissance et de décès, lues quand le fichier les a
+COMMUNE_COLUMNS = {'naissance': 'COMNAIS', 'deces': 'COMDEC'}
+CHUNK = 200_000
+ZIP_NAME = re.compile(r'(nais|dec)(\d{4})')
 
-    :param url: url of the zip.
-    :param as_str: columns to parse as string.
-    :return:
-    """
-    data = urlopen(url)
-    zipfile = ZipFile(BytesIO(data.read()))
-    files = []
-    with zipfile as f:
-        for name in f.namelist():
-            with f.open(name) as zd:
-                files.append(
-                    pd.read_csv(zd, delimiter=';', dtype={as_str: str}))
-    return files[0]
-
-def save_data_as_pkl(urlsn, urlsd, year):
-    """Download online data and save it as pickle.
-
-    :param urlsn: URL of naissance data.
-    :param urlsd: URL of deces data.
+
+def open_zip(source):
+    """Zip of an URL or of a local path."""
+    if re.match(r'https?://', source):
+        return ZipFile(BytesIO(urlopen(source).read()))
+    return ZipFile(source)
+
+
+def read_chunks(source, dtypes):
+    """Chunks of the CSV of the zip, with the columns of dtypes only.
+
+    :param source: URL or path of the zip.
+    :param dtypes: types of the columns to read, those missing from the file are left out.
     """
-    dfn = fix_dep(get_data_from_url(urlsn, 'DEPNAIS'), ['DEPNAIS', 'DEPDOM'])
-    dfd = fix_dep(get_data_from_url(urlsd, 'DEPDEC'), ['DEPDEC'])
+    with open_zip(source) as z:
+        with z.open(z.namelist()[0]) as f:
+            yield from pd.read_csv(f, delimiter=';', usecols=lambda c: c in dtypes, dtype=dtypes, chunksize=CHUNK)
+
 
-    # Set 'date' from Month And Year information.
-    dfn['date'] = dfn.apply(lambda x: convert_date(x.ANAIS, x.MNAIS), axis=1)
-    dfn.set_index('date', inplace=True)
+class Counts():
+    """Sum of the groupby sizes of the chunks, with the levels typed as pandas would read them."""
 
-    # Set 'date' from Month And Year information.
-    dfd['date'] = dfd.apply(lambda x: convert_date(x.ADEC, x.MDEC), axis=1)
-    dfd['AGE'] = dfd['ADEC'] - dfd['ANAIS']
-    dfd.set_index('date', inplace=True)
+    def __init__(self, name):
+        self.name = name
+        self.parts = []
+        self.missing = set()  # colonnes numériques avec des valeurs manquantes, donc lues en flottants
 
-    dep = do_dep(dfn, dfd)
-    agen, aged = do_agen_aged(dfn, dfd)
-    tudom = dfn.groupby(['DEPDOM', 'TUDOM']).size().rename('SIZE').to_frame()
+    def add(self, df, keys):
+        for key in keys:
+            if df[key].dtype == float and df[key].isna().any():
+                self.missing.add(key)
+        self.parts.append(df.groupby(keys).size())
 
-    # Save to csv
-    tudom.fillna(0).to_pickle('ndf_naissance_deces/data/tudom' + year + '.pkl')
-    dep[0].fillna(0).to_pickle('ndf_naissance_deces/data/date_naissance' + year + '.pkl')
-    dep[1].fillna(0).to_pickle('ndf_naissance_deces/data/date_deces' + year + '.pkl')
-    agen.to_pickle('ndf_naissance_deces/data/age_naissance' + year + '.pkl')
-    aged.to_pickle('ndf_naissance_deces/data/age_deces' + year + '.pkl')
+    def result(self, names=None):
+        counts = pd.concat(self.parts).groupby(level=list(range(self.parts[0].index.nlevels))).sum()
+        counts = counts.rename(self.name)
+        index = counts.index.to_frame(index=False)
+        for key in index.columns:
+            if index[key].dtype == float and key not in self.missing:
+                index[key] = index[key].astype('int64')
+        counts.index = pd.MultiIndex.from_frame(index, names=names or list(index.columns))
+        return counts
 
 
-def convert_date(y, m):
-    """Convert data to dataframe.datetime format.
+def with_date(counts, year, month, name):
+    """Counts by (department, year, month) as counts by (department, 15th of the month)."""
+    index = counts.index.to_frame(index=False)
+    date = pd.to_datetime(pd.DataFrame({'year': index[year], 'month': index[month], 'day': 15}))
+    index = pd.MultiIndex.from_arrays([index.iloc[:, 0], date], names=[name, 'date'])
+    return counts.set_axis(index).groupby(level=[0, 1]).sum()
 
-    :param y: year.
-    :param m: month.
-    :return:
+
+def commune_counts(counts):
+    """Counts by commune as a frame, None when the file had no commune."""
+    if not counts.parts:
+        return None
+    return counts.result(['COMMUNE']).to_frame()
+
+
+def aggregate_naissances(source):
+    tudom, date, mere, pere = Counts('SIZE'), Counts('SIZE'), Counts('SIZEMEREN'), Counts('SIZEPEREN')
+    commune = Counts('SIZE')
+    for df in read_chunks(source, dict(NAISSANCE_COLUMNS, **{COMMUNE_COLUMNS['naissance']: str})):
+        df['DEPNAIS'] = fix_dep_codes(df['DEPNAIS'])
+        df['DEPDOM'] = fix_dep_codes(df['DEPDOM'])
+        tudom.add(df, ['DEPDOM', 'TUDOM'])
+        date.add(df, ['DEPNAIS', 'ANAIS', 'MNAIS'])
+        mere.add(df, ['DEPNAIS', 'AGEMERE'])
+        pere.add(df, ['DEPNAIS', 'AGEPERE'])
+        if COMMUNE_COLUMNS['naissance'] in df:
+            commune.add(df, [COMMUNE_COLUMNS['naissance']])
+    agemn = mere.result(['DEPNAIS', 'AGE']).to_frame()
+    agepn = pere.result(['DEPNAIS', 'AGE']).to_frame()
+    agen = pd.concat([agemn, agepn], axis=1).fillna(0)
+    return (tudom.result().to_frame(), with_date(date.result(), 'ANAIS', 'MNAIS', 'DEPNAIS').to_frame(), agen,
+            commune_counts(commune))
+
+
+def aggregate_deces(source):
+    date, femmes, hommes = Counts('SIZE'), Counts('SIZEMERED'), Counts('SIZEPERED')
+    commune = Counts('SIZE')
+    for df in read_chunks(source, dict(DECES_COLUMNS, **{COMMUNE_COLUMNS['deces']: str})):
+        df['DEPDEC'] = fix_dep_codes(df['DEPDEC'])
+        df['AGE'] = df['ADEC'] - df['ANAIS']
+        date.add(df, ['DEPDEC', 'ADEC', 'MDEC'])
+        femmes.add(df[df.SEXE == 2], ['DEPDEC', 'AGE'])
+        hommes.add(df[df.SEXE == 1], ['DEPDEC', 'AGE'])
+        if COMMUNE_COLUMNS['deces'] in df:
+            commune.add(df, [COMMUNE_COLUMNS['deces']])
+    aged = pd.concat([femmes.result(), hommes.result()], axis=1).fillna(0)
+    return with_date(date.result(), 'ADEC', 'MDEC', 'DEPDEC').to_frame(), aged, commune_counts(commune)
+
+
+def save_year(year, naissance, deces, directory='ndf_naissance_deces/data'):
+    """Build and save the pickles of a year.
+
+    :param year: year of the data, the pickles end with its last two digits.
+    :param naissance: URL or path of the zip of the births.
+    :param deces: URL or path of the zip of the deaths.
     """
-    return du.parser.parse(f"15-{m}-{y}")
+    tudom, daten, agen, communen = aggregate_naissances(naissance)
+    dated, aged, communed = aggregate_deces(deces)
+    suffix = str(year)[-2:]
+    tudom.fillna(0).to_pickle(os.path.join(directory, f'tudom{suffix}.pkl'))
+    daten.fillna(0).to_pickle(os.path.join(directory, f'date_naissance{suffix}.pkl'))
+    dated.fillna(0).to_pickle(os.path.join(directory, f'date_deces{suffix}.pkl'))
+    agen.to_pickle(os.path.join(directory, f'age_naissance{suffix}.pkl'))
+    aged.to_pickle(os.path.join(directory, f'age_deces{suffix}.pkl'))
+    for name, counts in [('commune_naissance', communen), ('commune_deces', communed)]:
+        if counts is not None:
+            counts.to_pickle(os.path.join(directory, f'{name}{suffix}.pkl'))
+    return year
+
+
+def jobs(sources):
+    """(year, births, deaths) of years and zip paths, the zips being paired by the year of their name."""
+    years = {}
+    for source in sources:
+        if source.isdigit():
+            if int(source) not in URLS:
+                raise ValueError(f"no known URL for {source}, give the paths of its zips")
+            years[int(source)] = dict(zip(['nais', 'dec'], URLS[int(source)]))
+            continue
+        m = ZIP_NAME.search(os.path.basename(source))
+        if m is None:
+            raise ValueError(f"{source}: the name of the zip should contain nais<year> or dec<year>")
+        years.setdefault(int(m.group(2)), {})[m.group(1)] = source
+    for year, zips in sorted(years.items()):
+        if set(zips) != {'nais', 'dec'}:
+            raise ValueError(f"{year}: both the births and deaths zips are needed")
+        yield year, zips['nais'], zips['dec']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sources', nargs='*', default=[str(y) for y in URLS],
+                        help='years with a known URL or paths of zips (default: %(default)s)')
+    parser.add_argument('--dir', default='ndf_naissance_deces/data', help='output directory (default: %(default)s)')
+    parser.add_argument('--workers', type=int, help='processes of the pool (default: one per CPU)')
+    args = parser.parse_args()
+
+    todo = list(jobs(args.sources))
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+        futures = [pool.submit(save_year, year, naissance, deces, args.dir) for year, naissance, deces in todo]
+        for future in concurrent.futures.as_completed(futures):
+            print(f"{future.result()} saved in {args.dir}")
 
 
 if __name__ == '__main__':
-    url_naissance = ['https://www.insee.fr/fr/statistiques/fichier/4215180/etatcivil2018_nais2018_csv.zip',
-                     'https://www.insee.fr/fr/statistiques/fichier/4768335/etatcivil2019_nais2019_csv.zip', 
-                     "https://www.insee.fr/fr/statistiques/fichier/5419785/etatcivil2020_nais2020_csv.zip"]
-    url_deces = ['https://www.insee.fr/fr/statistiques/fichier/4216603/etatcivil2018_dec2018_csv.zip',
-                 'https://www.insee.fr/fr/statistiques/fichier/4801913/etatcivil2019_dec2019_csv.zip',
-                 "https://www.insee.fr/fr/statistiques/fichier/5431034/etatcivil2020_dec2020_csv.zip"]
-    save_data_as_pkl(url_naissance[0], url_deces[0], '18')
-    save_data_as_pkl(url_naissance[1], url_deces[1], '19')
-    save_data_as_pkl(url_naissance[2], url_deces[2], '20')
+    main()
@@ -1,21 +1,36 @@
 from dash import dcc
 from dash import html
 import dash
+import collections
+import copy
+import flask
 import json
 import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 import plotly.subplots as sp
-import plotly.express as px
+import plotly.colors
+import threading
 from ndf_naissance_deces.transform_data import *
+from ndf_naissance_deces import communes, cubes, geometry, years
+from delta_core.pages import Page, needs_data, triggered
+from delta_core.cache import cached_figure
+from delta_core.figures import webgl
+from delta_core.pool import heavy
+from delta_core.store import store
+from delta_core.snapshot import snapshot
+from delta_core.transport import compact_figure
 
 N_DEP_METROPOLE = 96
-YEARS = ['2018', '2019', '2020']
+YEARS = years.discover()  # années dont les cinq pickles sont dans ndf_naissance_deces/data
+ALL_YEARS = 'Toutes'  # somme des années, les mois mis bout à bout
 
-class Naissance():
+class Naissance(Page):
     '''
     SIZE: amount of death/birth per given reference
 
+    Frames of a year (see years.py):
+
     daten = date (yyyy-mm-dd), SIZE, Id DepaNais - Amount of births (SIZE) per month (date) per deparment (DepNais)
     dated = date (yyyy-mm-dd), SIZE, Id DepaDec - Amount of deaths (SIZE) per month (date) per deparment (DepDec)
     
@@ -25,58 +40,114 @@ class Naissance():
     agen = age, SIZEMEREN, SIZEPEREN - age of giving birth
     aged = age, SIZEMEREN, SIZEPEREN - age of death
 
+    The callbacks use the same data as dense arrays [department, month/age/city size]
+    (see cubes.py), the departments being in the order of dep_idx_map. A year is read the
+    first time it is shown and kept with the last MAX_YEARS ones, counted over the worker
+and its heavy pool (see load_year and delta_core/pool.py).
+
+    The traces of the two maps are built once per year; a change of the zoom, of the
+    selection or of the year only sends the properties it changes (see map_patch).
+
+    A click on a department opens the map of its communes when their contours were built
+    (see communes.py), the selections on this map being resolved on the server.
     '''
-    def __init__(self, application=None):
-        with open('ndf_naissance_deces/data/departements.geojson') as f:
-            self.dep_json = json.load(f)                                        # contours des départements
-        self.dep = pd.read_pickle('ndf_naissance_deces/data/departements.pkl')  # num et nom des départements
-        self.tudom = {}  # taille de la ville de la mère lors de la naissance
-        self.daten = {}  # nombre de naissance par département et par mois
-        self.dated = {}  # nombre de décès par département et par mois
-        self.depn = {}
-        self.depd = {}
-        self.agen = {}  # âges des parents à la naissance de leur enfant
-        self.aged = {}  # âge du décès pour les hommes et femmes
-
-        # Load pkl and create dataframe
-        for year in YEARS:
-            self.tudom[year] = pd.read_pickle(f'ndf_naissance_deces/data/tudom{year[-2:]}.pkl')
-            self.daten[year] = pd.read_pickle(f'ndf_naissance_deces/data/date_naissance{year[-2:]}.pkl')
-            self.dated[year] = pd.read_pickle(f'ndf_naissance_deces/data/date_deces{year[-2:]}.pkl')
-            self.depn[year] = self.daten[year].groupby('DEPNAIS').sum()[:N_DEP_METROPOLE]
-            self.depd[year] = self.dated[year].groupby('DEPDEC').sum()[:N_DEP_METROPOLE]
-            if year == YEARS[0]:
-                self.depn[year]['VARIATION'] = np.nan
-                self.depd[year]['VARIATION'] = np.nan
-            else:
-                self.depn[year]['VARIATION'] = self.depn[year]['SIZE'] /  self.depn[str(int(year)-1)]['SIZE'] - 1
-                self.depd[year]['VARIATION'] = self.depd[year]['SIZE'] /  self.depd[str(int(year)-1)]['SIZE'] - 1
-            self.agen[year] = pd.read_pickle(f'ndf_naissance_deces/data/age_naissance{year[-2:]}.pkl')
-            self.aged[year] = pd.read_pickle(f'ndf_naissance_deces/data/age_deces{year[-2:]}.pkl')
+    # les contours des communes en font partie : leur ETag est dans les figures mises en cache
+    data_files = ['ndf_naissance_deces/data/*.pkl', 'ndf_naissance_deces/data/departements.geojson',
+                  'ndf_naissance_deces/data/communes/*']
+    # entrées de map_sync qui se traduisent par un patch de la figure
+    MAP_INPUTS = {'map.relayoutData', 'map.selectedData', 'year.value'}
+    MAP_SUBPLOTS = ['mapbox', 'mapbox2']
+    # propriétés des traces qui changent avec l'année
+    YEAR_PROPERTIES = ['locations', 'customdata', 'hovertemplate', 'z', 'zmin', 'zmax', 'colorbar']
+    # choix Chacun/Somme des courbes
+    MODES = ['wps-uni-mg-1', 'wps-uni-mg-11', 'wps-uni-mg-2', 'wps-uni-mg-3']
+    MAX_SUMS = 256  # sommes de sélections gardées
+    MAX_YEARS = 4   # années gardées en mémoire, toutes les années ensemble comptant pour une
 
-        # Set info for maps
-        self.tickval = {}
-        for year in YEARS:
-            zmax = max(self.depn[year]['SIZE'].max(), self.depd[year]['SIZE'].max())
-            zmin = min(self.depn[year]['SIZE'].min(), self.depd[year]['SIZE'].min())
-            self.tickval[year] = [zmin, 1000, 2000, 5000, 10000, 20000, zmax]
+    def __init__(self, application=None):
+        if application:
+            self.app = application
+            # application should have its own layout and use self.main_layout as a page or in a component
+        else:
+            self.app = dash.Dash(__name__)
+            self.app.layout = self.layout
 
-        self.color_sequence= px.colors.qualitative.D3  # cf https://plotly.com/python/discrete-color/
+        # One request per change: the map, the list of departments and the curves are
+        # updated by a single callback, which only computes the outputs of the changed inputs.
+        self.app.callback(
+            dash.dependencies.Output('map', 'figure'),
+            dash.dependencies.Output('list_department', 'children'),
+            dash.dependencies.Output('courbe_naissances_deces', 'figure'),
+            dash.dependencies.Output('ville_naissance', 'figure'),
+            dash.dependencies.Output('courbe_naissance', 'figure'),
+            dash.dependencies.Output('courbe_deces', 'figure'),
+            dash.dependencies.Output('communes', 'figure'),
+            dash.dependencies.Output('communes-div', 'style'),
+            dash.dependencies.Input('map', 'relayoutData'),
+            dash.dependencies.Input('map', 'selectedData'),
+            dash.dependencies.Input('year', 'value'),
+            dash.dependencies.Input('wps-naissance-deces-1', 'value'),
+            dash.dependencies.Input('wps-uni-mg-1', 'value'),
+            dash.dependencies.Input('wps-uni-mg-11', 'value'),
+            dash.dependencies.Input('wps-uni-mg-2', 'value'),
+            dash.dependencies.Input('wps-hf-2', 'value'),
+            dash.dependencies.Input('wps-uni-mg-3', 'value'),
+            dash.dependencies.Input('wps-hf-3', 'value'),
+            dash.dependencies.Input('map', 'clickData'),
+        )(self.update_page)
+        self.app.callback(
+            dash.dependencies.Output('list_communes', 'children'),
+            dash.dependencies.Input('communes', 'selectedData'),
+            dash.dependencies.State('map', 'clickData'),
+            dash.dependencies.State('year', 'value'),
+        )(self.commune_selection)
+
+        # Somme n'a pas de sens pour un seul département : choix mis à jour dans le navigateur.
+        self.app.clientside_callback(
+            """
+            function(selected, ...values) {
+                const one = Boolean(selected && selected.points && selected.points.length === 1);
+                const options = [{label: 'Chacun', value: 'Chacun'}, {label: 'Somme', value: 'Somme', disabled: one}];
+                return values.map(() => options).concat(
+                    values.map(v => one && v !== 'Chacun' ? 'Chacun' : window.dash_clientside.no_update));
+            }
+            """,
+            [dash.dependencies.Output(i, 'options') for i in self.MODES] +
+            [dash.dependencies.Output(i, 'value') for i in self.MODES],
+            dash.dependencies.Input('map', 'selectedData'),
+            [dash.dependencies.State(i, 'value') for i in self.MODES],
+        )
 
-        self.date_axis = {}
-        for year in YEARS:
-            self.date_axis[year] = [pd.to_datetime(d) for d in sorted(set(self.daten[year].reset_index()['date']))]
+        # Contours des départements, servis à part et mis en cache par le navigateur.
+        self.app.server.add_url_rule('/ndf/departements/<int:level>.geojson', 'ndf_departements',
+                                     self.departements)
+        self.app.server.add_url_rule('/ndf/communes/<dep>.geojson', 'ndf_communes', self.communes_geojson)
 
+    def build(self):
+        self.dep_json = store.read_json('ndf_naissance_deces/data/departements.geojson')  # contours des départements
+        self.dep = store.read_pickle('ndf_naissance_deces/data/departements.pkl')        # num et nom des départements
         self.age_naissances_axis = list(range(17, 47))  # 17 -> 17 et moins, 46 -> 46 et plus
         self.tudom_axis = ['< 2k', '2k-5k', '5k-10k', '10k-20k', '20k-50k', '50k-100k', '100k-200k', '200k-2M', 'Aglo Paris']
-        self.age_deces_axis = {}
-        for year in YEARS:
-            self.age_deces_axis[year] = list(sorted(set(self.aged[year].reset_index()['AGE'])))
 
         self.dep_map = {unplace_dep(pd.to_numeric(replace_dep(d['properties']['code']))): d['properties']['nom']
                for d in self.dep_json['features']}
         self.dep_idx_map = {d: i for i, d in enumerate(sorted(self.dep_map))}
 
+        # JSON et ETag des contours simplifiés pour chaque niveau de zoom
+        self.geometry = snapshot.derived('ndf.geometry', ['ndf_naissance_deces/data/departements.geojson',
+                                                          geometry.__file__],
+                                         lambda: geometry.levels(self.dep_json), geometry.LEVELS)
+
+        self.color_sequence= plotly.colors.qualitative.D3  # cf https://plotly.com/python/discrete-color/
+        self.communes = communes.Communes.load()  # None sans les contours des communes
+
+        # état des années lu à la première demande, voir load_year
+        self.year_cache = years.YearCache(self.load_year, heavy.share(self.MAX_YEARS))
+        self.sizes = {}  # année -> naissances et décès par département, petits donc gardés pour les variations
+        self.all_deps = frozenset(self.dep_idx_map)
+        self.sums = collections.OrderedDict()  # (série, année, départements) -> somme, la plus récente en dernier
+        self.sums_lock = threading.Lock()
+
         # Double map Naissance/Deces
         self.fig = sp.make_subplots(
             rows=1,
@@ -100,6 +171,8 @@ class Naissance():
             center={"lat": 47.0353, "lon": 2.2928},
             zoom=4.42,
         )
+        self.map_layout = self.fig.to_dict()['layout']
+        self.year(YEARS[-1])  # l'année affichée au départ
 
         # main layout
         self.main_layout = html.Div(children=[
@@ -115,8 +188,8 @@ class Naissance():
 #                            ),
 #                html.Label("en", style={'margin-left':'15px','margin-right':'15px'}),
                 dcc.RadioItems( id='year',
-                                options=[{'label': i, 'value': i} for i in YEARS],
-                                value='2020',
+                                options=[{'label': i, 'value': i} for i in YEARS + [ALL_YEARS]],
+                                value=YEARS[-1],
                                 inline=True,
                                 labelStyle={'display': 'block','font-size': 15},
                             ),
@@ -135,6 +208,12 @@ class Naissance():
                 }
             ),
 
+            # Communes of the clicked department.
+            html.Div([
+                dcc.Graph(id='communes', style={'width': '100%'}),
+                html.Plaintext(id='list_communes', style={'whiteSpace': 'normal', 'height': 'auto'}),
+            ], id='communes-div', style={'display': 'none'}),
+
             # List of department name.
             html.Div([
                 html.Plaintext(id='list_department',
@@ -284,90 +363,113 @@ class Naissance():
             'padding': '10px 50px 10px 50px',
         })
 
-        if application:
-            self.app = application
-            # application should have its own layout and use self.main_layout as a page or in a component
+    def bound_caches(self):
+        # MAX_YEARS années pour le worker et les processus de son pool ensemble
+        self.year_cache.resize(heavy.share(self.MAX_YEARS))
+
+    def year(self, year):
+        """State of a year, or of every year together for ALL_YEARS, loaded on first use."""
+        return self.year_cache.get(year)
+
+    def load_year(self, year):
+        """Read a year and compute its state.
+
+        :return: dict of the series per department (rows), their sums over France (totals),
+            date_axis, age_deces_axis and the compact traces of both maps (map_traces).
+        """
+        if year == ALL_YEARS:
+            state = self.load_all_years()
         else:
-            self.app = dash.Dash(__name__)
-            self.app.layout = self.main_layout
+            frames = years.read(year)
+            deps = sorted(self.dep_map)
+            months = list(range(1, 13))
+            age_deces_axis = sorted(set(frames['age_deces'].index.get_level_values('AGE')))
+
+            def dense(name, column, axis, **kwargs):
+                return cubes.dense([frames[name]], column, deps, axis, **kwargs)[0]
+
+            rows = {
+                'naissances': dense('date_naissance', 'SIZE', months, key=lambda d: d.month),
+                'deces': dense('date_deces', 'SIZE', months, key=lambda d: d.month),
+                'villes': dense('tudom', 'SIZE', range(len(self.tudom_axis))),
+                'age_meres': dense('age_naissance', 'SIZEMEREN', self.age_naissances_axis, clip=True),
+                'age_peres': dense('age_naissance', 'SIZEPEREN', self.age_naissances_axis, clip=True),
+                'age_femmes': dense('age_deces', 'SIZEMERED', age_deces_axis),
+                'age_hommes': dense('age_deces', 'SIZEPERED', age_deces_axis),
+            }
+            date_axis = [pd.to_datetime(d) for d in sorted(set(frames['date_naissance'].index.get_level_values('date')))]
+            self.sizes.setdefault(year, self.dep_sizes(frames))
+            state = {'rows': rows, 'date_axis': date_axis, 'age_deces_axis': age_deces_axis,
+                     'communes': {name: pd.Series(df['SIZE'].to_numpy(), index=df.index.get_level_values(0))
+                                  for name, df in years.read_present(year, years.COMMUNES).items()}}
+
+        state['totals'] = {kind: rows.sum(axis=0) for kind, rows in state['rows'].items()}
+        for array in list(state['rows'].values()) + list(state['totals'].values()):
+            array.setflags(write=False)
+        depn, depd = self.variations(year)
+        geojson = self.geojson_url(None)
+        traces = [self.create_map_naissances(depn, depd, year, geojson), self.create_map_deces(depn, depd, year, geojson)]
+        state['map_traces'] = compact_figure(go.Figure(traces))['data']
+        return state
+
+    def load_all_years(self):
+        """State of every year together: the months one after the other, the sums of the years otherwise.
+
+        The years missing from the cache are read one after the other and not kept.
+        """
+        states = [self.year_cache.get(y, keep=False) for y in YEARS]
+        ages = sorted(set().union(*(state['age_deces_axis'] for state in states)))
+        rows = {}
+        for kind in ['naissances', 'deces']:
+            rows[kind] = np.concatenate([state['rows'][kind] for state in states], axis=1)
+        for kind in ['villes', 'age_meres', 'age_peres']:
+            rows[kind] = sum(state['rows'][kind] for state in states)
+        for kind in ['age_femmes', 'age_hommes']:
+            rows[kind] = sum(cubes.on_axis(state['rows'][kind], state['age_deces_axis'], ages) for state in states)
+        commune_counts = {}
+        for state in states:
+            for name, counts in state['communes'].items():
+                commune_counts[name] = counts.add(commune_counts[name], fill_value=0) if name in commune_counts else counts
+        return {'rows': rows, 'date_axis': [d for state in states for d in state['date_axis']],
+                'age_deces_axis': ages, 'communes': commune_counts}
+
+    @staticmethod
+    def dep_sizes(frames):
+        """Births and deaths (SIZE) per metropolitan department of the frames of a year."""
+        return (frames['date_naissance'].groupby('DEPNAIS').sum()[:N_DEP_METROPOLE],
+                frames['date_deces'].groupby('DEPDEC').sum()[:N_DEP_METROPOLE])
+
+    def year_sizes(self, year):
+        """Births and deaths per department of a year, only its dates being read when it is not loaded."""
+        if year not in self.sizes:
+            if year == ALL_YEARS:
+                sizes = [self.year_sizes(y) for y in YEARS]
+                self.sizes[year] = (sum(n for n, _ in sizes), sum(d for _, d in sizes))
+            else:
+                self.sizes[year] = self.dep_sizes(years.read(year, ['date_naissance', 'date_deces']))
+        return self.sizes[year]
 
-        # Update subgraph when the selected department are updated.
-        self.app.callback(
-            dash.dependencies.Output('courbe_naissances_deces', 'figure'),
-            dash.dependencies.Input('map', 'selectedData'),
-            dash.dependencies.Input('wps-naissance-deces-1', 'value'),
-            dash.dependencies.Input('wps-uni-mg-1', 'value'),
-            dash.dependencies.Input('year', 'value'),
-        )(self.courbe_naissances_deces)
-        self.app.callback(
-            dash.dependencies.Output('ville_naissance', 'figure'),
-            dash.dependencies.Input('map', 'selectedData'),
-            dash.dependencies.Input('wps-uni-mg-11', 'value'),
-            dash.dependencies.Input('year', 'value'),
-        )(self.ville_naissance)
-        self.app.callback(
-            dash.dependencies.Output('courbe_naissance', 'figure'),
-            dash.dependencies.Input('map', 'selectedData'),
-            dash.dependencies.Input('wps-uni-mg-2', 'value'),
-            dash.dependencies.Input('wps-hf-2', 'value'),
-            dash.dependencies.Input('year', 'value'),
-        )(self.courbe_naissance)
-        self.app.callback(
-            dash.dependencies.Output('courbe_deces', 'figure'),
-            dash.dependencies.Input('map', 'selectedData'),
-            dash.dependencies.Input('wps-uni-mg-3', 'value'),
-            dash.dependencies.Input('wps-hf-3', 'value'),
-            dash.dependencies.Input('year', 'value'),
-        )(self.courbe_deces)
-        
-        # Update list of department names upon map selection.
-        self.app.callback(
-            dash.dependencies.Output('list_department', 'children'),
-            dash.dependencies.Input('map', 'selectedData'),
-        )(self.list_dep)
-        # Sync mapboxes layout and selection.
-        self.app.callback(
-            dash.dependencies.Output('map', 'figure'),
-            dash.dependencies.Input('map', 'relayoutData'),
-            dash.dependencies.Input('map', 'selectedData'),
-            dash.dependencies.Input('year', 'value'),
-        )(self.map_sync)
-        self.app.callback(
-            dash.dependencies.Output('wps-uni-mg-11', 'options'),
-            dash.dependencies.Input('map', 'selectedData'),
-        )(self.update_thing)
-        self.app.callback(
-            dash.dependencies.Output('wps-uni-mg-2', 'options'),
-            dash.dependencies.Input('map', 'selectedData'),
-        )(self.update_thing)
-        self.app.callback(
-            dash.dependencies.Output('wps-uni-mg-3', 'options'),
-            dash.dependencies.Input('map', 'selectedData'),
-        )(self.update_thing)
-        self.app.callback(
-            dash.dependencies.Output('wps-uni-mg-1', 'options'),
-            dash.dependencies.Input('map', 'selectedData'),
-        )(self.update_thing)
-        self.app.callback(
-            dash.dependencies.Output('wps-uni-mg-1', 'value'),
-            dash.dependencies.Input('wps-uni-mg-1', 'value'),
-            dash.dependencies.Input('map', 'selectedData'),
-        )(self.update_things2)
-        self.app.callback(
-            dash.dependencies.Output('wps-uni-mg-11', 'value'),
-            dash.dependencies.Input('wps-uni-mg-11', 'value'),
-            dash.dependencies.Input('map', 'selectedData'),
-        )(self.update_things2)
-        self.app.callback(
-            dash.dependencies.Output('wps-uni-mg-2', 'value'),
-            dash.dependencies.Input('wps-uni-mg-2', 'value'),
-            dash.dependencies.Input('map', 'selectedData'),
-        )(self.update_things2)
-        self.app.callback(
-            dash.dependencies.Output('wps-uni-mg-3', 'value'),
-            dash.dependencies.Input('wps-uni-mg-3', 'value'),
-            dash.dependencies.Input('map', 'selectedData'),
-        )(self.update_things2)
+    def variations(self, year):
+        """Births and deaths per department with their VARIATION, NaN without the previous year.
+
+        :return: depn, depd.
+        """
+        depn, depd = (df.copy() for df in self.year_sizes(year))
+        previous = None if year == ALL_YEARS else str(int(year) - 1)
+        if previous in YEARS:
+            depn['VARIATION'] = depn['SIZE'] / self.year_sizes(previous)[0]['SIZE'] - 1
+            depd['VARIATION'] = depd['SIZE'] / self.year_sizes(previous)[1]['SIZE'] - 1
+        else:
+            depn['VARIATION'] = np.nan
+            depd['VARIATION'] = np.nan
+        return depn, depd
+
+    @staticmethod
+    def ticks(depn, depd):
+        """Values of the ticks of the color bar of the maps."""
+        zmax = max(depn['SIZE'].max(), depd['SIZE'].max())
+        zmin = min(depn['SIZE'].min(), depd['SIZE'].min())
+        return [zmin, 1000, 2000, 5000, 10000, 20000, zmax]
 
     def get_mapbox_layout_params(self, relayout_data):
         """Get the layout data from any mapbox in the figure.
@@ -383,125 +485,283 @@ class Naissance():
 
         return params
 
-    def map_sync(self, relayout_data, selected_data, year):
-        """Update the layout and selection of other maps.
+    @needs_data
+    def departements(self, level):
+        """Geojson of the departments simplified for a zoom level.
 
-        :param relayout_data: layout of the updated map.
-        :param selected_data: select data of the updated map.
-        :return: New figure with all maps synced.
+        :param level: index in geometry.LEVELS.
+        :return: response cached one year by the browsers, the URL changing with the data.
         """
-        deps = self.get_selected_department(selected_data)
-        depn = self.depn[year]
-        depd = self.depd[year]
-        self.fig = {}
-        self.fig = sp.make_subplots(
-            rows=1,
-            cols=2,
-            subplot_titles=('Nombre de naissances', 'Nombre de décès'),
-            specs=[[{"type": "mapbox"}, {"type": "mapbox"}]],
-        )
-
-        # Enable multi-element selection
-        self.fig.update_layout(
+        if not 0 <= level < len(self.geometry):
+            flask.abort(404)
+        return self.geojson_response(*self.geometry[level])
+
+    @staticmethod
+    def geojson_response(data, etag):
+        """Response of a geojson cached one year by the browsers, its URL changing with the data."""
+        response = flask.Response(data, mimetype='application/json')
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        return response.make_conditional(flask.request)
+
+    @needs_data
+    def communes_geojson(self, dep):
+        """Geojson of the communes of a department."""
+        if self.communes is None or dep not in self.communes:
+            flask.abort(404)
+        return self.geojson_response(*self.communes.shard(dep))
+
+    @staticmethod
+    def clicked_department(click_data):
+        if click_data and click_data.get('points'):
+            return click_data['points'][0].get('location')
+        return None
+
+    def commune_sizes(self, year, codes):
+        """Births and deaths of the communes of a year, zeros when unknown."""
+        counts = self.year(year)['communes']
+        return tuple(counts[name].reindex(codes).fillna(0).to_numpy() if name in counts else np.zeros(len(codes))
+                     for name in years.COMMUNES)
+
+    def drill_down(self, click_data, year):
+        """Map of the communes of the clicked department and the style of its div, hidden without one."""
+        dep = self.clicked_department(click_data)
+        if dep is None:
+            return dash.no_update, dash.no_update
+        if self.communes is None or dep not in self.communes:
+            return dash.no_update, {'display': 'none'}
+        return self.commune_map(dep, year), {'display': 'block'}
+
+    @cached_figure
+    @needs_data
+    def commune_map(self, dep, year):
+        """Choropleth of the communes of a department, the births or, without them, the deaths.
+
+        The contours are fetched from the shard of the department, so the figure only holds
+        the codes and values of its communes.
+        """
+        positions = self.communes.of_department(dep)
+        codes = self.communes.codes[positions]
+        naissances, deces = self.commune_sizes(year, codes)
+        values, what = (naissances, 'naissances') if naissances.any() else (deces, 'décès')
+        lon0, lat0, lon1, lat1 = self.communes.bounds(dep)
+        span = max((lon1 - lon0) / 2, (lat1 - lat0) * 1.5, 1e-3)
+        data, etag = self.communes.shard(dep)
+        fig = go.Figure(go.Choroplethmapbox(
+            geojson=self.app.get_relative_path(f'/ndf/communes/{dep}.geojson') + f'?v={etag}',
+            featureidkey='properties.code',
+            locations=codes,
+            z=np.log10(np.where(values > 0, values, np.nan)),
+            customdata=np.stack((self.communes.names[positions], naissances, deces), axis=1),
+            hovertemplate="<b>%{customdata[0]}<br> Naissance : %{customdata[1]}<br> Décès : %{customdata[2]}<br>",
+            colorscale='Inferno',
+            colorbar=dict(thickness=20, title=f'log10 {what}'),
+            marker_line_width=0.5,
+            name='',
+        ))
+        fig.update_layout(
+            title=f"Communes : {self.dep_map.get(dep, dep)} ({what})",
             clickmode='event+select',
-            hovermode='closest',
             margin=dict(l=0, r=0, t=30, b=0),
+            mapbox=dict(style='carto-positron', center={'lon': (lon0 + lon1) / 2, 'lat': (lat0 + lat1) / 2},
+                        zoom=float(np.clip(np.log2(360 / span) + 0.5, 5, 11))),
         )
+        return fig
 
-        self.fig.add_trace(self.create_map_naissances(depn, depd, year), row=1, col=1)
-        self.fig.add_trace(self.create_map_deces(depn, depd, year), row=1, col=2)
+    @needs_data
+    def commune_selection(self, selected_data, click_data, year):
+        """Births and deaths of the communes selected on the map of the communes.
 
-        self.fig.update_mapboxes(
-            style='carto-positron',
-            center={"lat": 47.0353, "lon": 2.2928},
-            zoom=4.42,
-        )
+        :param selected_data: selection of the commune map, by lasso, box or clicks.
+        :return: text of the selection.
+        """
+        dep = self.clicked_department(click_data)
+        if self.communes is None or dep not in self.communes or not selected_data:
+            return ''
+        positions = self.communes.select(dep, selected_data)
+        naissances, deces = self.commune_sizes(year, self.communes.codes[positions])
+        names = ', '.join(self.communes.names[positions]) if len(positions) <= 10 else f'{len(positions)} communes'
+        return f"Sélection : {names} - {int(naissances.sum())} naissances, {int(deces.sum())} décès"
+
+    def geojson_url(self, relayout_data):
+        """URL of the geojson suited to the zoom of the map.
+
+        :param relayout_data: relayout data of the map, None at first.
+        :return: URL with the ETag of the geojson, so that it changes with the data.
+        """
+        zoom = self.get_mapbox_layout_params(relayout_data).get('zoom') if relayout_data else None
+        level = geometry.level_for_zoom(zoom)
+        return self.app.get_relative_path(f'/ndf/departements/{level}.geojson') + f'?v={self.geometry[level][1]}'
+
+    @needs_data
+    def update_page(self, relayout_data, selected_data, year, unit_mean_1, type_1, type_11,
+                    type_2, parents_2, type_3, sexes_3, click_data):
+        """Update the outputs of the page whose inputs changed, the others get dash.no_update.
 
-        # upate selected elements to reflect on both maps
-        self.fig.update_traces(
-            selectedpoints=[self.dep_idx_map[d] for d in deps])
+        The selection is resolved once for all the curves.
 
-        if relayout_data is not None:
-            params = self.get_mapbox_layout_params(relayout_data)
+        :return: map, list of the departments, the four curves, the map of the communes and its style.
+        """
+        inputs = triggered()
+
+        def changed(*names):  # tout au premier appel
+            return not inputs or bool(inputs & {'map.selectedData', 'year.value', *names})
+
+        deps = self.get_selected_department(selected_data)
+        res = [dash.no_update] * 8
+        if not inputs or inputs & self.MAP_INPUTS:
+            res[0] = self.map_sync(relayout_data, selected_data, year)
+        if not inputs or 'map.selectedData' in inputs:
+            res[1] = self.list_dep(deps)
+        if changed('wps-naissance-deces-1.value', 'wps-uni-mg-1.value'):
+            res[2] = self.courbe_naissances_deces(deps, unit_mean_1, type_1, year)
+        if changed('wps-uni-mg-11.value'):
+            res[3] = self.ville_naissance(deps, type_11, year)
+        if changed('wps-uni-mg-2.value', 'wps-hf-2.value'):
+            res[4] = self.courbe_naissance(deps, type_2, parents_2, year)
+        if changed('wps-uni-mg-3.value', 'wps-hf-3.value'):
+            res[5] = self.courbe_deces(deps, type_3, sexes_3, year)
+        if not inputs or inputs & {'map.clickData', 'year.value'}:
+            res[6:] = self.drill_down(click_data, year)
+        return res
+
+    @needs_data
+    def map_sync(self, relayout_data, selected_data, year):
+        """Update the layout and selection of other maps.
 
-            # update layout to reflect on both maps
-            self.fig.update_mapboxes(params)
+        The whole figure is sent at first; afterwards a change of one input of
+        the map only sends a patch of the properties it changes.
 
-        return self.fig
+        :param relayout_data: layout of the updated map.
+        :param selected_data: select data of the updated map.
+        :return: New figure with all maps synced, or a patch of the figure in the browser.
+        """
+        inputs = triggered() & self.MAP_INPUTS
+        if len(inputs) == 1:
+            return self.map_patch(inputs.pop(), relayout_data, selected_data, year)
+        return self.map_figure(relayout_data, selected_data, year)
+
+    def selected_points(self, selected_data):
+        return [self.dep_idx_map[d] for d in self.get_selected_department(selected_data)]
+
+    @cached_figure
+    @needs_data
+    def map_figure(self, relayout_data, selected_data, year):
+        """Both maps of a year, with the selection and layout of the last update."""
+        layout = copy.deepcopy(self.map_layout)
+        params = self.get_mapbox_layout_params(relayout_data) if relayout_data else {}
+        geojson = self.geojson_url(relayout_data)
+        selected = self.selected_points(selected_data)
+        data = []
+        for trace, subplot in zip(self.year(year)['map_traces'], self.MAP_SUBPLOTS):
+            data.append(dict(trace, geojson=geojson, selectedpoints=selected, subplot=subplot))
+            layout[subplot].update(params)
+        return {'data': data, 'layout': layout}
+
+    @needs_data
+    def map_patch(self, trigger, relayout_data, selected_data, year):
+        """Patch of the maps for the change of one input.
+
+        :param trigger: input which changed, one of MAP_INPUTS.
+        :return: dash.Patch, or dash.no_update when the change does not concern the maps.
+        """
+        patch = dash.Patch()
+        if trigger == 'map.relayoutData':
+            params = self.get_mapbox_layout_params(relayout_data) if relayout_data else {}
+            if not params:  # sélection au lasso, autosize...
+                return dash.no_update
+            for subplot in self.MAP_SUBPLOTS:
+                patch['layout'][subplot].update(params)
+            if 'zoom' in ''.join(relayout_data):  # la finesse des contours dépend du zoom
+                geojson = self.geojson_url(relayout_data)
+                for i in range(len(self.MAP_SUBPLOTS)):
+                    patch['data'][i]['geojson'] = geojson
+        elif trigger == 'map.selectedData':
+            selected = self.selected_points(selected_data)
+            for i in range(len(self.MAP_SUBPLOTS)):
+                patch['data'][i]['selectedpoints'] = selected
+        else:
+            for i, trace in enumerate(self.year(year)['map_traces']):
+                for key in self.YEAR_PROPERTIES:
+                    patch['data'][i][key] = trace[key]
+        return patch
 
-    def list_dep(self, selected_data):
+    def list_dep(self, deps):
         """List the department selected, if all are selected return
         'Toute la France'
 
-        :param selected_data: selected data on the map.
+        :param deps: selected departments.
         :return: String of departments.
         """
-        deps = self.get_selected_department(selected_data)
-
         if len(deps) == N_DEP_METROPOLE:
             return 'Sélection : toute la France'
         else:
             return 'Sélection : ' + ', '.join([self.dep_map[d] for d in deps])
 
-    def create_map_naissances(self, depn, depd, year):
+    def create_map_naissances(self, depn, depd, year, geojson=None):
         """Setup `Naissances` figure.
 
+        :param geojson: URL of the contours of the departments, embedded when None.
         :return: new figure
         """
         customdata=np.stack((self.dep['NAME'], depn['SIZE'], depn['VARIATION'],
                              depd['SIZE'],depd['VARIATION']),
                              axis=1)
+        tickval = self.ticks(depn, depd)
         #hovertemplate="<b>Departement : %{customdata[1]}</b><br><br>" + "Nom : %{customdata[0]}<br>" + "Naissance : %{customdata[2]}<br>"
-        if year == YEARS[0]:
+        if depn['VARIATION'].isna().all():  # pas d'année précédente
             hovertemplate="<b>Dep. : %{customdata[0]}<br> Naissance : %{customdata[1]}<br> Décès : %{customdata[3]}<br>"
         else:
             hovertemplate="<b>Dep. : %{customdata[0]}<br> Naissance : %{customdata[1]} (%{customdata[2]:+0.2%})<br> Décès : %{customdata[3]} (%{customdata[4]:+.2%})<br>"
         return go.Choroplethmapbox(
-            geojson=self.dep_json,
+            geojson=self.dep_json if geojson is None else geojson,
             name='',
             colorscale='Inferno',
             colorbar=dict(
-                tickvals=[np.log10(i) for i in self.tickval[year]],
-                ticktext=self.tickval[year],
+                tickvals=[np.log10(i) for i in tickval],
+                ticktext=tickval,
                 thickness=20,
                 x=0.46,
             ),
-            locations=self.depn[year].index,
+            locations=depn.index,
             customdata=customdata,
             hovertemplate=hovertemplate,
             z=np.log10(depn['SIZE']),
-            zmin=np.log10(self.tickval[year][0]),
-            zmax=np.log10(self.tickval[year][-1]),
+            zmin=np.log10(tickval[0]),
+            zmax=np.log10(tickval[-1]),
         )
 
-    def create_map_deces(self, depn, depd, year):
+    def create_map_deces(self, depn, depd, year, geojson=None):
         """Setup `Décès` figure.
 
+        :param geojson: URL of the contours of the departments, embedded when None.
         :return: new figure
         """
         customdata=np.stack((self.dep['NAME'], depn['SIZE'], depn['VARIATION'],
                              depd['SIZE'],depd['VARIATION']),
                              axis=1)
-        if year == YEARS[0]:
+        tickval = self.ticks(depn, depd)
+        if depn['VARIATION'].isna().all():  # pas d'année précédente
             hovertemplate="<b>Dep. : %{customdata[0]}<br> Naissance : %{customdata[1]}<br> Décès : %{customdata[3]}<br>"
         else:
             hovertemplate="<b>Dep. : %{customdata[0]}<br> Naissance : %{customdata[1]} (%{customdata[2]:+0.2%})<br> Décès : %{customdata[3]} (%{customdata[4]:+.2%})<br>"
         return go.Choroplethmapbox(
-            geojson=self.dep_json,
+            geojson=self.dep_json if geojson is None else geojson,
             name='',
             colorscale='Inferno',
             colorbar=dict(
-                tickvals=[np.log10(i) for i in self.tickval[year]],
-                ticktext=self.tickval[year],
+                tickvals=[np.log10(i) for i in tickval],
+                ticktext=tickval,
                 thickness=20,
                 x=0.46,
             ),
-            locations=self.depd[year].index,
+            locations=depd.index,
             customdata=customdata,
             hovertemplate=hovertemplate,
             z=np.log10(depd['SIZE']),
-            zmin=np.log10(self.tickval[year][0]),
-            zmax=np.log10(self.tickval[year][-1]),
+            zmin=np.log10(tickval[0]),
+            zmax=np.log10(tickval[-1]),
         )
 
     def get_selected_department(self, selected_data):
@@ -515,55 +775,88 @@ class Naissance():
             return list(self.dep_map.keys())
         return [p['location'] for p in selected_data['points']]
 
-    def courbe_naissances_deces(self, selected_data, unit_mean, type, year):
+    def selection(self, deps):
+        """Rows of the departments in the cubes.
+
+        :param deps: list of department id.
+        :return: list of positions.
+        """
+        return [self.dep_idx_map[d] for d in deps]
+
+    def series(self, kind, year, deps):
+        """Rows of a series for the selected departments, [department, axis]."""
+        return self.year(year)['rows'][kind][self.selection(deps)]
+
+    def total(self, kind, year, deps):
+        """Sum of a series over the selected departments.
+
+        Every department is precomputed; the sums of the last selections are kept
+        so that switching back to a selection does not add its rows again.
+
+        :param kind: key of the rows of load_year.
+        :param deps: list of department id.
+        :return: read-only array of the axis of the series.
+        """
+        deps = frozenset(deps)
+        if deps == self.all_deps:
+            return self.year(year)['totals'][kind]
+        key = (kind, year, deps)
+        with self.sums_lock:
+            if key in self.sums:
+                self.sums.move_to_end(key)
+                return self.sums[key]
+        res = self.year(year)['rows'][kind][sorted(self.dep_idx_map[d] for d in deps)].sum(axis=0)
+        res.setflags(write=False)
+        with self.sums_lock:
+            self.sums[key] = res
+            while len(self.sums) > self.MAX_SUMS:
+                self.sums.popitem(last=False)
+        return res
+
+    @cached_figure
+    @heavy
+    @needs_data
+    def courbe_naissances_deces(self, deps, unit_mean, type, year):
         """Graph about size of Naissance and Deces of every department.
 
-        :param selected_data: selected department.
+        :param deps: selected departments.
         :param unit_mean: 'Naissance' or 'Deces'.
         :param type: 'Chacun' or 'Somme'.
         :return: figure of the graph.
         """
-        deps = self.get_selected_department(selected_data)
-        dfn = self.daten[year]
-        dfd = self.dated[year]
-        date_axis = self.date_axis[year]
+        date_axis = self.year(year)['date_axis']
         what = []
         if type == 'Chacun':
+            naissances, deces = self.series('naissances', year, deps), self.series('deces', year, deps)
             if 'Naissance' in unit_mean:
-                what += [(d, dfn.loc[d,'SIZE'], 'Naissance ' + self.dep_map[d], None) for d in deps]
+                what += [(d, naissances[i], 'Naissance ' + self.dep_map[d], None) for i, d in enumerate(deps)]
 
             if 'Décès' in unit_mean:
-                what += [(d, dfd.loc[d,'SIZE'], 'Décès ' + self.dep_map[d], 'dash') for d in deps]
+                what += [(d, deces[i], 'Décès ' + self.dep_map[d], 'dash') for i, d in enumerate(deps)]
         else:
             if 'Naissance' in unit_mean:
-                data = dfn.loc[deps].groupby('date').sum()
-                what += [(None, data['SIZE'], 'Naissance', None)]
+                what += [(None, self.total('naissances', year, deps), 'Naissance', None)]
             if 'Décès' in unit_mean:
-                data = dfd.loc[deps].groupby('date').sum()
-                what += [(None, data['SIZE'], 'Décès', 'dash')]
+                what += [(None, self.total('deces', year, deps), 'Décès', 'dash')]
 
-        return self.cts(date_axis, what,
-                        "Nombre de naissances et décès par mois")
+        return webgl(self.cts(date_axis, what,
+                              "Nombre de naissances et décès par mois"))
     
-    def ville_naissance(self, selected_data, type, year):
+    @cached_figure
+    @needs_data
+    def ville_naissance(self, deps, type, year):
         """Graph about size of Naissance and Deces of every department.
 
-        :param selected_data: selected department.
+        :param deps: selected departments.
         :param type: 'Chacun' or 'Somme'.
         :return: figure of the graph.
         """
-        deps = self.get_selected_department(selected_data)
-        tudom = self.tudom[year]
         what = []
         if type == 'Chacun':
-            for d in deps:
-                tud_dep = np.zeros(9)
-                for city_size in tudom.loc[d].index:
-                    tud_dep[city_size] = tudom.loc[(d,city_size), 'SIZE']
-                what.append((d, tud_dep, self.dep_map[d], 'dot'))
+            villes = self.series('villes', year, deps)
+            what += [(d, villes[i], self.dep_map[d], 'dot') for i, d in enumerate(deps)]
         else:
-            data = tudom.loc[deps].groupby('TUDOM').sum()
-            what += [(None, data['SIZE'], 'Naissance', 'dot')]
+            what += [(None, self.total('villes', year, deps), 'Naissance', 'dot')]
         fig = self.cts(self.tudom_axis, what,
                         "Nombre de naissances en fonction de la taille de la ville de la mère")
         for sca in fig.data:
@@ -572,79 +865,85 @@ class Naissance():
             else:
                 sca['mode'] = 'markers'
             sca['marker'] = {'size':20, 'symbol':'diamond-wide'}
-        return fig
+        return webgl(fig)
 
-    def courbe_naissance(self, selected_data, unit_mean, type, year):
+    @cached_figure
+    @heavy
+    @needs_data
+    def courbe_naissance(self, deps, unit_mean, type, year):
         """Graph about parents age when they have a child of every department.
 
-        :param selected_data: selected department.
+        :param deps: selected departments.
         :param unit_mean: 'Naissance' or 'Deces'.
         :param type: 'Homme, 'Femme, 'Chacun' or 'Somme'.
         :return: figure of the graph.
         """
-        dep = self.get_selected_department(selected_data)
-        agen = self.agen[year]
         what = []
 
         if unit_mean == 'Chacun':
-            data = agen.loc[dep].groupby('AGE').max()  # pour l'annotation
+            meres, peres = self.series('age_meres', year, deps), self.series('age_peres', year, deps)
+            data_meres, data_peres = meres.max(axis=0), peres.max(axis=0)  # pour l'annotation
             if 'Mère' in type:
-                what += [(d, agen.loc[d,'SIZEMEREN'], 'Mère ' + self.dep_map[d], None) for d in dep]
+                what += [(d, meres[i], 'Mère ' + self.dep_map[d], None) for i, d in enumerate(deps)]
             if 'Père' in type:
-                what += [(d, agen.loc[d,'SIZEPEREN'], 'Père ' + self.dep_map[d], 'dash') for d in dep]
+                what += [(d, peres[i], 'Père ' + self.dep_map[d], 'dash') for i, d in enumerate(deps)]
             if 'Moyenne M/P' in type:
-                what += [(d, agen.loc[d,'MGMEREPEREN'], 'Moyenne H/F ' + self.dep_map[d], 'dashdot') for d in dep]
+                what += [(d, (meres[i] + peres[i]) / 2, 'Moyenne M/P ' + self.dep_map[d], 'dashdot')
+                         for i, d in enumerate(deps)]
 
         else:
-            data = agen.loc[dep].groupby('AGE').sum()
+            data_meres, data_peres = self.total('age_meres', year, deps), self.total('age_peres', year, deps)
             if 'Mère' in type:
-                what += [(None, data['SIZEMEREN'], 'Mère', None)]
+                what += [(None, data_meres, 'Mère', None)]
             if 'Père' in type:
-                what += [(None, data['SIZEPEREN'], 'Père', 'dash')]
+                what += [(None, data_peres, 'Père', 'dash')]
             if 'Moyenne M/P' in type:
-                what += [(None, data['MGMEREPEREN'], 'Moyenne M/P', 'dashdot')]
+                what += [(None, (data_meres + data_peres) / 2, 'Moyenne M/P', 'dashdot')]
 
         fig = self.cts(self.age_naissances_axis, what,
                         "Nombre de naissances en fonction de l'âge des parents")
-        fig.add_annotation(x=17, y=round(data['SIZEMEREN'][17]), xshift=10, yshift=10, text="17 et -", showarrow=False)
-        fig.add_annotation(x=46, y=round(data['SIZEPEREN'][46]), xshift=-10, yshift=10, text="46 et +", showarrow=False)
-        return fig
-
-    def courbe_deces(self, selected_data, unit_mean, type, year):
+        fig.add_annotation(x=17, y=round(data_meres[0]), xshift=10, yshift=10, text="17 et -", showarrow=False)
+        fig.add_annotation(x=46, y=round(data_peres[-1]), xshift=-10, yshift=10, text="46 et +", showarrow=False)
+        return webgl(fig)
+
+    @cached_figure
+    @heavy
+    @needs_data
+    def courbe_deces(self, deps, unit_mean, type, year):
         """Graph about age of death of male and female of every department.
 
-        :param selected_data: selected department.
+        :param deps: selected departments.
         :param unit_mean: 'Naissance' or 'Deces'.
         :param type: 'Homme, 'Femme, 'Chacun' or 'Somme'.
         :return: figure of the graph.
         """
-        dep = self.get_selected_department(selected_data)
         what = []
-        aged = self.aged[year]
-        age_deces_axis = self.age_deces_axis[year]
+        age_deces_axis = self.year(year)['age_deces_axis']
 
         if unit_mean == 'Chacun':
+            femmes, hommes = self.series('age_femmes', year, deps), self.series('age_hommes', year, deps)
             if 'Femme' in type:
-                what += [(d, aged.loc[d,'SIZEMERED'], 'Femme ' + self.dep_map[d], None) for d in dep]
+                what += [(d, femmes[i], 'Femme ' + self.dep_map[d], None) for i, d in enumerate(deps)]
             if 'Homme' in type:
-                what += [(d, aged.loc[d,'SIZEPERED'], 'Homme ' + self.dep_map[d], 'dash') for d in dep]
+                what += [(d, hommes[i], 'Homme ' + self.dep_map[d], 'dash') for i, d in enumerate(deps)]
             if 'H + F' in type:
-                what += [(d, aged.loc[d,'SIZEMERED'] + aged['SIZEPERED'], 'H + F ' + self.dep_map[d], 'dot') for d in dep]
+                what += [(d, femmes[i] + hommes[i], 'H + F ' + self.dep_map[d], 'dot') for i, d in enumerate(deps)]
             if 'Moyenne H/F' in type:
-                what += [(d,  (aged.loc[d,'SIZEMERED'] + aged['SIZEPERED'])/2, 'Moyenne H/F ' + self.dep_map[d], 'dashdot') for d in dep]
+                what += [(d, (femmes[i] + hommes[i]) / 2, 'Moyenne H/F ' + self.dep_map[d], 'dashdot')
+                         for i, d in enumerate(deps)]
         else:
-            data = aged.loc[dep].groupby("AGE").sum()
+            femmes, hommes = self.total('age_femmes', year, deps), self.total('age_hommes', year, deps)
             if 'Femme' in type:
-                what += [(None, data['SIZEMERED'], 'Femmes', None)]
+                what += [(None, femmes, 'Femmes', None)]
             if 'Homme' in type:
-                what += [(None, data['SIZEPERED'], 'Hommes', 'dash')]
+                what += [(None, hommes, 'Hommes', 'dash')]
             if 'H + F' in type:
-                what += [(None, data['SIZEMERED'] + data['SIZEPERED'], 'H + F', 'dot')]
+                what += [(None, femmes + hommes, 'H + F', 'dot')]
             if 'Moyenne H/F' in type:
-                what += [(None, (data['SIZEMERED'] + data['SIZEPERED'])/2, 'Moyenne H/F', 'dashdot')]
+                what += [(None, (femmes + hommes) / 2, 'Moyenne H/F', 'dashdot')]
 
-        return self.cts(age_deces_axis, what,
-                        "Nombre de décès en fonction de l'âge")
+        return webgl(self.cts(age_deces_axis, what,
+                              "Nombre de décès en fonction de l'âge"))
 
     def cts(self, x_axis, what, title):
         scatters = []
@@ -684,21 +983,6 @@ class Naissance():
         )
 
     # pas propre !
-    def update_thing(self, selected_data):
-        deps = self.get_selected_department(selected_data)
-        if len(deps) == 1:
-            return [{"label": "Chacun", "value": "Chacun"},
-            {"label": "Somme", "value": "Somme", "disabled": True},]
-        else:
-            return [{"label": "Chacun", "value": "Chacun"},
-            {"label": "Somme", "value": "Somme"},]
-
-    def update_things2(self, value, selected_data):
-        deps = self.get_selected_department(selected_data)
-        if len(deps) == 1:
-            return 'Chacun'
-        else:
-            return value
 
 if __name__ == '__main__':
     mpj = Naissance()
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import json
 
@@ -17,9 +18,17 @@ def unplace_dep(x):
         return str("0" + str(int(x)))
     return str(x.astype(int))
 
+def fix_dep_codes(codes):
+    """Department codes as in the geojson ('01', '2A', '971'), each distinct code being converted once."""
+    idx, uniques = pd.factorize(pd.Series(codes))  # -1 pour les valeurs manquantes, quelle que soit la version
+    fixed = np.array(list(map(unplace_dep, pd.to_numeric(list(map(replace_dep, uniques))))) + [None],
+                     dtype=object)
+    return fixed[idx]  # -1, une valeur manquante, donne None
+
+
 def fix_dep(df, cols):
     for col in cols:
-        df[col] = list(map(unplace_dep, pd.to_numeric(list(map(replace_dep, df[col])))))
+        df[col] = fix_dep_codes(df[col])
     return df
 
 def do_dep(dfn, dfd):
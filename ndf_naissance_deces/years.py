@@ -0,0 +1,88 @@
+"""Years of the ndf data, discovered from the pickles and loaded on demand.
+
+get_data.py writes five pickles per year, named with the last two digits of
+the year (tudom20.pkl, date_naissance20.pkl...). A year is available when its
+five pickles are in the data directory, so adding a year only needs its files.
+
+The pages keep the state of the last years used in a ``YearCache``: a year is
+read the first time it is asked for and dropped when it is the least recently
+used one of a full cache, so memory does not grow with the number of years.
+"""
+import collections
+import os
+import re
+import threading
+
+from delta_core.store import store
+
+DATA_DIR = 'ndf_naissance_deces/data'
+NAMES = ['tudom', 'date_naissance', 'date_deces', 'age_naissance', 'age_deces']
+COMMUNES = ['commune_naissance', 'commune_deces']  # quand les fichiers de l'INSEE ont la commune
+PICKLE = re.compile(r'([a-z_]+)(\d\d)\.pkl')
+
+
+def discover(directory=DATA_DIR):
+    """Sorted years with their five pickles, e.g. ['2018', '2019', '2020']."""
+    found = {}
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    for name in names:
+        m = PICKLE.fullmatch(name)
+        if m and m.group(1) in NAMES:
+            found.setdefault(m.group(2), set()).add(m.group(1))
+    return sorted(str(2000 + int(suffix)) for suffix, names in found.items() if len(names) == len(NAMES))
+
+
+def path(year, name, directory=DATA_DIR):
+    return os.path.join(directory, f'{name}{year[-2:]}.pkl')
+
+
+def read(year, names=NAMES, directory=DATA_DIR):
+    """Frames of a year by name, not kept by the store unless they were preloaded."""
+    return {name: store.read_pickle(path(year, name, directory), keep=False) for name in names}
+
+
+def read_present(year, names, directory=DATA_DIR):
+    """Frames of a year by name, for the pickles which exist only."""
+    return {name: store.read_pickle(path(year, name, directory), keep=False) for name in names
+            if os.path.isfile(path(year, name, directory))}
+
+
+class YearCache():
+    """State of the last years used, at most ``size`` of them.
+
+    :param load: function of a year giving its state.
+    :param size: number of years kept.
+    """
+
+    def __init__(self, load, size):
+        self.load = load
+        self.size = size
+        self.years = collections.OrderedDict()  # année -> état, la plus récente en dernier
+        self._lock = threading.Lock()
+
+    def __contains__(self, year):
+        return year in self.years
+
+    def resize(self, size):
+        """Keep at most ``size`` years, dropping the least recently used ones."""
+        with self._lock:
+            self.size = size
+            while len(self.years) > self.size:
+                self.years.popitem(last=False)
+
+    def get(self, year, keep=True):
+        """State of a year, loaded if needed and kept unless keep is False."""
+        with self._lock:
+            if year in self.years:
+                self.years.move_to_end(year)
+                return self.years[year]
+        value = self.load(year)
+        if keep:
+            with self._lock:
+                self.years[year] = value
+                while len(self.years) > self.size:
+                    self.years.popitem(last=False)
+        return value
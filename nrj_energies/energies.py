@@ -6,14 +6,20 @@ from dash import html
 import pandas as pd
 import numpy as np
 import plotly.graph_objs as go
-import plotly.express as px
 import dateutil as du
+from delta_core.pages import Page, needs_data
+from delta_core.cache import cached_figure
+from delta_core.figures import webgl
+from delta_core.store import store
 
 
-class Energies():
+class Energies(Page):
     mois = {'janv': 1, 'févr': 2, 'mars': 3, 'avr': 4, 'mai': 5, 'juin': 6, 'juil': 7, 'août': 8, 'sept': 9, 'oct': 10,
             'nov': 11, 'déc': 12}
 
+    data_files = ['nrj_energies/data/energies.pkl']
+    reload_data = True  # après python -m nrj_energies.prepare_data
+
     quoi = {"Prix d'une tonne de propane": [1000, 'Propane','cyan'], "Bouteille de butane de 13 kg": [13, 'Butane','blue'],
             "100 litres de FOD au tarif C1": [100, 'Fioul','black'], 
             "Un litre de super carburant ARS": [1, 'Essence','tomato'], "Un litre de super sans plomb 95": [1, 'Essence','orange'],
@@ -30,11 +36,33 @@ class Energies():
              'Charbon': 20,
              'Electricité': 3.6}  # en MJ / kg sauf électicité en MJ / kWh
 
+    # prix par unité d'énergie : valeur du choix du prix -> (unité, MJ par unité)
+    unités = {1: ('mégajoule', 1), 3: ('kWh', 3.6), 4: ('tep', 41868)}  # 1 tep = 41,868 GJ
+
     def __init__(self, application = None):
         self.dir = 'nrj_energies/'
-        self.energie = pd.read_pickle(self.dir + 'data/energies.pkl')
-        self.petrole = self.energie[ list(self.quoi.keys())[:8] ] # les comburants 
-        self.years = np.arange(self.petrole.index.min().year, self.petrole.index.max().year + 1)
+
+        if application:
+            self.app = application
+            # application should have its own layout and use self.main_layout as a page or in a component
+        else:
+            self.app = dash.Dash(__name__)
+            self.app.layout = self.layout
+
+        self.app.callback(
+            dash.dependencies.Output('nrg-main-graph', 'figure'),
+            [dash.dependencies.Input('nrg-price-type', 'value'),
+             dash.dependencies.Input('nrg-which-month', 'value'),
+             dash.dependencies.Input('nrg-which-year', 'value'),
+             dash.dependencies.Input('nrg-xaxis-type', 'value')])(self.update_graph)
+        self.app.callback(
+            [dash.dependencies.Output('nrg-which-month', 'disabled'),
+             dash.dependencies.Output('nrg-which-year', 'disabled')],
+            dash.dependencies.Input('nrg-price-type', 'value'))(self.disable_month_year)
+
+    def build(self):
+        # tout est calculé avant d'être rangé : un rechargement ne montre jamais un état à moitié construit
+        vars(self).update(self.prices(store.read_pickle(self.dir + 'data/energies.pkl')))
 
         self.main_layout = html.Div(children=[
             html.H3(children='Évolution des prix de différentes énergies en France'),
@@ -45,6 +73,8 @@ class Energies():
                               id='nrg-price-type',
                               options=[{'label': 'Absolu', 'value': 0},
                                        {'label': 'Équivalent J', 'value': 1},
+                                       {'label': 'Équivalent kWh', 'value': 3},
+                                       {'label': 'Équivalent tep', 'value': 4},
                                        {'label': 'Relatif : 1 en ', 'value': 2}],
                               value=1,
                               labelStyle={'display': 'block'},
@@ -103,54 +133,59 @@ class Energies():
         }
         )
 
-        if application:
-            self.app = application
-            # application should have its own layout and use self.main_layout as a page or in a component
-        else:
-            self.app = dash.Dash(__name__)
-            self.app.layout = self.main_layout
-
-        self.app.callback(
-            dash.dependencies.Output('nrg-main-graph', 'figure'),
-            [dash.dependencies.Input('nrg-price-type', 'value'),
-             dash.dependencies.Input('nrg-which-month', 'value'),
-             dash.dependencies.Input('nrg-which-year', 'value'),
-             dash.dependencies.Input('nrg-xaxis-type', 'value')])(self.update_graph)
-        self.app.callback(
-            [dash.dependencies.Output('nrg-which-month', 'disabled'),
-             dash.dependencies.Output('nrg-which-year', 'disabled')],
-            dash.dependencies.Input('nrg-price-type', 'value'))(self.disable_month_year)
+    def prices(self, energie):
+        """Prices of the page and their conversions, by attribute name."""
+        petrole = energie[list(self.quoi.keys())[:8]]  # les comburants
+        # MJ dans la quantité vendue de chaque colonne, l'unité étant en kg quand la densité manque
+        mj = np.array([self.quoi[c][0] * self.densité.get(self.quoi[c][1], 1) * self.calor[self.quoi[c][1]]
+                       for c in energie.columns])
+        # prix relatifs [mois de référence, mois, énergie] : un changement de référence est un index
+        prix = petrole.to_numpy()
+        with np.errstate(invalid='ignore'):
+            relatif = prix[None, :, :] / prix[:, None, :]
+        return {
+            'energie': energie,
+            'petrole': petrole,
+            'years': np.arange(petrole.index.min().year, petrole.index.max().year + 1),
+            'mj': mj,
+            'prix_mj': energie.to_numpy() / mj,
+            'relatif': relatif,
+            'ref': {(d.year, d.month): i for i, d in enumerate(petrole.index)},
+        }
 
+    @cached_figure
+    @needs_data
     def update_graph(self, price_type, month, year, xaxis_type):
-        if price_type == 0 or month == None or year == None:
+        import plotly.express as px  # import lent, fait au premier graphique
+
+        if price_type in self.unités:
+            unité, mj = self.unités[price_type]
+            df = pd.DataFrame(self.prix_mj * mj,
+                              index=self.energie.index, columns=self.energie.columns)
+            ytitle = f'Prix en € pour 1 {unité}'
+        elif price_type == 0 or month == None or year == None:
             df = self.energie
-        elif price_type == 1:
-            df = self.energie.copy()
-            for c in df.columns:
-                alias = Energies.quoi[c][1]
-                try:
-                    df[c] = df[c] / (Energies.quoi[c][0] * Energies.densité[alias] * Energies.calor[alias])
-                except:  # l'unité est déjà en kg et donc densité n'existe pas
-                    df[c] = df[c] / (Energies.quoi[c][0] * Energies.calor[alias])
+            ytitle = 'Prix en €'
         else:
-            df = self.petrole.copy()
-            df.loc[f"{year}-{month}-15"]
-            cols = df.loc[f"{year}-{month}-15"].dropna().index
-            df = df[cols] / df.loc[f"{year}-{month}-15", cols]
+            ytitle = 'Prix relative (sans unité)'
+            if (year, month) not in self.ref:  # pas de prix ce mois-là
+                raise dash.exceptions.PreventUpdate
+            relatif = self.relatif[self.ref[(year, month)]]
+            cols = ~np.isnan(relatif[self.ref[(year, month)]])  # énergies avec un prix au mois de référence
+            df = pd.DataFrame(relatif[:, cols], index=self.petrole.index, columns=self.petrole.columns[cols])
         fig = px.line(df[df.columns[0]], template='plotly_white', color_discrete_sequence=[self.quoi[df.columns[0]][2]])
         for i,c in enumerate(df.columns[1:]):
             fig.add_scatter(x=df.index, y=df[c], mode='lines', name=c, text=c, hoverinfo='x+y+text',
                             marker_color=self.quoi[c][2])
-        ytitle = ['Prix en €', 'Prix en € pour 1 mégajoule', 'Prix relative (sans unité)']
         fig.update_layout(
             # title = 'Évolution des prix de différentes énergies',
-            yaxis=dict(title=ytitle[price_type],
+            yaxis=dict(title=ytitle,
                        type='linear' if xaxis_type == 'Linéaire' else 'log', ),
             height=450,
             hovermode='closest',
             legend={'title': 'Énergie'},
         )
-        return fig
+        return webgl(fig)
 
     def disable_month_year(self, price_type):
         if price_type == 2:
@@ -1,9 +1,32 @@
-import sys
+"""Build nrj_energies/data/energies.pkl from the Pégase and electricity tariff CSVs.
+
+The prices come from three parts, each built from its sources:
+
+    petrole       pegase_prix_petrole_particulier.csv
+    bois          pegase_prix_bois_particulier.csv
+    electricite   prix_reglemente_electricite.csv, on the months of bois
+
+Each part is saved in data/parts with the SHA-1 of its sources in
+data/parts/manifest.json. A run only parses the parts whose sources changed,
+takes the others from their pickles and joins them into energies.pkl, which is
+rewritten only when it changes. The running page reloads it on the next
+callback (see Page.reload_data).
+
+    python -m nrj_energies.prepare_data            # after an update of the CSVs
+    python -m nrj_energies.prepare_data --force    # parse every source again
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+
 import pandas as pd
 import numpy as np
-import dateutil as du
 
 
+DATA_DIR = 'nrj_energies/data'
+
 mois = {'janv': 1, 'févr': 2, 'mars': 3, 'avr': 4, 'mai': 5, 'juin': 6, 'juil': 7, 'août': 8, 'sept': 9, 'oct': 10,
         'nov': 11, 'déc': 12}
 
@@ -23,46 +46,115 @@ calor = {'Essence': 47.3, 'Gazole': 44.8, 'Fioul': 42.6, 'Propane': 50.35, 'Buta
          'Charbon': 20,
          'Electricité': 3.6}  # en MJ / kg sauf électicité en MJ / kWh
 
-def _conv_date(d):
-    ma = d.split('-')  # coupe la chaine au - et ainsi ma[0] est le mois et ma[1] l'année
-    return du.parser.parse(
-        f"15-{mois[ma[0].lower()]}-{ma[1]}")  # parfois le mois a une majuscule d'où lower()
+
+def _conv_dates(periodes):
+    """15th of the months of Pégase periods: 'janv-83' -> 1983-01-15, 'Déc-07' -> 2007-12-15."""
+    ma = periodes.str.lower().str.split('-', expand=True)  # ma[0] est le mois et ma[1] l'année sur 2 chiffres
+    return pd.to_datetime('15-' + ma[0].map(mois).astype(str) + '-' + ma[1], format='%d-%m-%y')
+
 
 def _make_dataframe_from_pegase(filename):
     df = pd.read_csv(filename, sep=";", encoding="latin1", skiprows=[0, 1, 3], header=None)
     df = df.set_index(0).T
-    df['date'] = df['Période'].apply(_conv_date)
+    df['date'] = _conv_dates(df['Période']).to_numpy()
     df = df.set_index('date')
     df.drop(columns=['Période'], inplace=True)
     df = df.replace('-', np.nan).astype('float64')
     return df
 
-bois = _make_dataframe_from_pegase("data/pegase_prix_bois_particulier.csv")
-petrole = _make_dataframe_from_pegase("data/pegase_prix_petrole_particulier.csv")
-
-bois.drop(columns=['Une tonne de granulés de bois en sacs', '100 kWh PCI de bois en sacs'], inplace=True)
-petrole.drop(columns=["Tarif d'une tonne de propane en citerne", "100 kWh PCI de propane en citerne",
-                      "100 kWh PCS de propane",
-                      "Un litre d'essence ordinaire",
-                      "100 kWh PCI de propane", "100 kWh PCI de FOD au tarif C1"], inplace=True)  # doublons
-
-electricite = pd.read_csv('data/prix_reglemente_electricite.csv', sep=';', decimal=',', parse_dates=['DATE_DEBUT'], infer_datetime_format=True)
-electricite = electricite.set_index(['P_SOUSCRITE',"DATE_DEBUT"])
-electricite.drop(columns=['DATE_FIN', 'PART_FIXE_HT', 'PART_FIXE_TTC', 'PART_VARIABLE_HT'], inplace=True)
-electricite.dropna(inplace=True)
-electricite = electricite.unstack().T.reset_index(0, drop=True)
-electricite = electricite.rename(columns={i: f"1 kWh (contrat {i:.0f} kW)" for i in electricite.columns})
-duration = pd.DatetimeIndex(electricite.index.values)
-new_index = pd.DatetimeIndex(
-    [f"{y}-{m:02d}-15" for y in range(duration[0].year, duration[-1].year + 1) for m in range(1, 13)])
-electricite = electricite.reindex(np.concatenate([electricite.index.values, new_index.values]))
-electricite.sort_index(inplace=True)
-electricite = electricite.fillna(method='ffill')
-electricite = electricite.loc[new_index]
-electricite = electricite.reindex(bois.index)
-electricite.drop(columns=["1 kWh (contrat 6 kW)", "1 kWh (contrat 12 kW)", "1 kWh (contrat 15 kW)"],
-                 inplace=True)
-
-energie = petrole.join(bois, how='outer').join(electricite, how='outer')
-#energie = pd.concat([petrole, bois, electricite])  # cela devrait faire comme ci-dessus mais j'ai 3 lignes par index...
-energie.to_pickle('data/energies.pkl')
+
+def petrole(data_dir=DATA_DIR):
+    df = _make_dataframe_from_pegase(os.path.join(data_dir, 'pegase_prix_petrole_particulier.csv'))
+    return df.drop(columns=["Tarif d'une tonne de propane en citerne", "100 kWh PCI de propane en citerne",
+                            "100 kWh PCS de propane",
+                            "Un litre d'essence ordinaire",
+                            "100 kWh PCI de propane", "100 kWh PCI de FOD au tarif C1"])  # doublons
+
+
+def bois(data_dir=DATA_DIR):
+    df = _make_dataframe_from_pegase(os.path.join(data_dir, 'pegase_prix_bois_particulier.csv'))
+    return df.drop(columns=['Une tonne de granulés de bois en sacs', '100 kWh PCI de bois en sacs'])
+
+
+def electricite(data_dir=DATA_DIR):
+    """Regulated tariffs of the 15th of each month, on the months of bois."""
+    df = pd.read_csv(os.path.join(data_dir, 'prix_reglemente_electricite.csv'), sep=';', decimal=',',
+                     parse_dates=['DATE_DEBUT'], dayfirst=True)
+    df = df.set_index(['P_SOUSCRITE', "DATE_DEBUT"])
+    df = df.drop(columns=['DATE_FIN', 'PART_FIXE_HT', 'PART_FIXE_TTC', 'PART_VARIABLE_HT']).dropna()
+    df = df.unstack().T.reset_index(0, drop=True).sort_index()
+    df = df.rename(columns={i: f"1 kWh (contrat {i:.0f} kW)" for i in df.columns})
+    # tarif en vigueur le 15 de chaque mois : le dernier connu à cette date
+    months = pd.date_range(f"{df.index[0].year}-01-01", f"{df.index[-1].year}-12-01", freq='MS') + pd.Timedelta(days=14)
+    df = df.ffill().reindex(months, method='ffill')
+    df = df.reindex(bois(data_dir).index)
+    return df.drop(columns=["1 kWh (contrat 6 kW)", "1 kWh (contrat 12 kW)", "1 kWh (contrat 15 kW)"])
+
+
+# part -> (fonction qui la construit, sources), dans l'ordre des colonnes de energies.pkl
+PARTS = {
+    'petrole': (petrole, ['pegase_prix_petrole_particulier.csv']),
+    'bois': (bois, ['pegase_prix_bois_particulier.csv']),
+    'electricite': (electricite, ['prix_reglemente_electricite.csv', 'pegase_prix_bois_particulier.csv']),
+}
+
+
+def checksum(paths):
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def build(data_dir=DATA_DIR, force=False):
+    """Parse the parts whose sources changed and write energies.pkl, return the names of the parsed parts."""
+    parts_dir = os.path.join(data_dir, 'parts')
+    os.makedirs(parts_dir, exist_ok=True)
+    try:
+        with open(os.path.join(parts_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    frames, parsed = [], []
+    for name, (make, sources) in PARTS.items():
+        path = os.path.join(parts_dir, f'{name}.pkl')
+        digest = checksum([os.path.join(data_dir, s) for s in sources])
+        if manifest.get(name) == digest and os.path.isfile(path) and not force:
+            frames.append(pd.read_pickle(path))
+            continue
+        start = time.perf_counter()
+        df = make(data_dir)
+        df.to_pickle(path)
+        manifest[name] = digest
+        frames.append(df)
+        parsed.append(name)
+        print(f"{name}: {df.shape[1]} prices over {len(df)} months in {time.perf_counter() - start:.2f} s")
+
+    energie = frames[0]
+    for df in frames[1:]:
+        energie = energie.join(df, how='outer')
+    target = os.path.join(data_dir, 'energies.pkl')
+    if force or not os.path.isfile(target) or not pd.read_pickle(target).equals(energie):
+        tmp = f'{target}.{os.getpid()}'
+        energie.to_pickle(tmp)
+        os.replace(tmp, target)  # la page relit le fichier complet, jamais un fichier à moitié écrit
+        print(f"{target} written")
+    tmp = os.path.join(parts_dir, f'manifest.json.{os.getpid()}')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, os.path.join(parts_dir, 'manifest.json'))
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default=DATA_DIR, help='directory of the sources (default: %(default)s)')
+    parser.add_argument('--force', action='store_true', help='parse every source again')
+    args = parser.parse_args()
+    build(args.data, args.force)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,37 +6,57 @@ from dash import html
 import pandas as pd
 import numpy as np
 import plotly.graph_objs as go
-import plotly.express as px
 import json
+from delta_core.pages import Page, needs_data
+from delta_core.cache import cached_figure
+from delta_core.store import store
+from delta_core.snapshot import snapshot
 
-class WorldPopulationStats():
+class WorldPopulationStats(Page):
     START = 'Start'
     STOP  = 'Stop'
 
+    data_files = ['wfr_fertilite_revenus/data/subWDIdata.pkl']
+
     def __init__(self, application = None):
         self.dir = 'wfr_fertilite_revenus/'
-        self.df = pd.read_pickle(self.dir + 'data/subWDIdata.pkl')
-        self.df['Population'] /= 1E6
+
+        if application:
+            self.app = application
+            # application should have its own layout and use self.main_layout as a page or in a component
+        else:
+            self.app = dash.Dash(__name__)
+            self.app.layout = self.layout
+
+        # I link callbacks here since @app decorator does not work inside a class
+        # (somhow it is more clear to have here all interaction between functions and components)
+        self.app.callback(
+            dash.dependencies.Output('wps-div-country', 'children'),
+            dash.dependencies.Input('wps-main-graph', 'hoverData'))(self.country_chosen)
+        self.app.callback(
+            dash.dependencies.Output('wps-income-time-series', 'figure'),
+            [dash.dependencies.Input('wps-main-graph', 'hoverData')])(self.update_income_timeseries)
+            # dash.dependencies.Input('wps-crossfilter-xaxis-type', 'value')])(self.update_income_timeseries)
+        self.app.callback(
+            dash.dependencies.Output('wps-fertility-time-series', 'figure'),
+            [dash.dependencies.Input('wps-main-graph', 'hoverData')])(self.update_fertility_timeseries)
+            #dash.dependencies.Input('wps-crossfilter-xaxis-type', 'value')])(self.update_fertility_timeseries)
+        self.app.callback(
+            dash.dependencies.Output('wps-pop-time-series', 'figure'),
+            [dash.dependencies.Input('wps-main-graph', 'hoverData')])(self.update_pop_timeseries)
+            #dash.dependencies.Input('wps-crossfilter-xaxis-type', 'value')])(self.update_pop_timeseries)
+
+    def build(self):
+        self.df = store.read_pickle(self.dir + 'data/subWDIdata.pkl')
+        self.df = self.df.assign(Population=self.df['Population'] / 1E6)  # le jeu partagé n'est pas modifié
         self.continent_colors = {'Asie':'gold', 'Europe':'green', 'Afrique':'brown', 'Océanie':'red', 'Amerique':'navy'}
         self.years = sorted(set(self.df.index.values))
         self.max_incomes = self.df["Revenus"].max()
         self.max_childs = self.df["Nb d'enfants par femme"].max()
         self.max_pop = self.df["Population"].max()
 
-        self.main_graph = px.scatter(self.df, x='Revenus', y="Nb d'enfants par femme", color="Continent",
-                                        hover_name="Nom",
-                                        hover_data = {'Année':True, 'Revenus':":.2f", "Nb d'enfants par femme":":.1f", \
-                                                      'Continent':False, 'Population':':.2f'},
-                                        color_discrete_map=self.continent_colors,
-                                        # title="Évolution du taux de fertilité vs le revenu moyen par pays",
-                                        labels={'Revenus':"Revenus nets par personne",
-                                                "Population":"Population (millions)"},
-                                        size = 'Population',  size_max=60,
-                                        animation_frame=self.df["Année"], animation_group=self.df['Nom'],
-                                        range_x=[10, self.df["Revenus"].max()], log_x = True,
-                                        range_y=[0, int(self.df["Nb d'enfants par femme"].max()) + 1],
-                                        # height = 600,  # j'aimerais mettre un % de la hauteur comme '40vh' 
-                                       )
+        # figure longue à construire, elle vient du snapshot quand il est à jour
+        self.main_graph = snapshot.derived('wfr.main_graph', self.data_files + [__file__], self.create_main_graph)
 
         self.main_layout = html.Div(children=[
             html.H3(children='Évolution du taux de fertilité vs le niveau moyen de revenu par pays'),
@@ -86,31 +106,25 @@ class WorldPopulationStats():
                  'padding': '10px 50px 10px 50px',
                  }
         )
-        
-        if application:
-            self.app = application
-            # application should have its own layout and use self.main_layout as a page or in a component
-        else:
-            self.app = dash.Dash(__name__)
-            self.app.layout = self.main_layout
 
-        # I link callbacks here since @app decorator does not work inside a class
-        # (somhow it is more clear to have here all interaction between functions and components)
-        self.app.callback(
-            dash.dependencies.Output('wps-div-country', 'children'),
-            dash.dependencies.Input('wps-main-graph', 'hoverData'))(self.country_chosen)
-        self.app.callback(
-            dash.dependencies.Output('wps-income-time-series', 'figure'),
-            [dash.dependencies.Input('wps-main-graph', 'hoverData')])(self.update_income_timeseries)
-            # dash.dependencies.Input('wps-crossfilter-xaxis-type', 'value')])(self.update_income_timeseries)
-        self.app.callback(
-            dash.dependencies.Output('wps-fertility-time-series', 'figure'),
-            [dash.dependencies.Input('wps-main-graph', 'hoverData')])(self.update_fertility_timeseries)
-            #dash.dependencies.Input('wps-crossfilter-xaxis-type', 'value')])(self.update_fertility_timeseries)
-        self.app.callback(
-            dash.dependencies.Output('wps-pop-time-series', 'figure'),
-            [dash.dependencies.Input('wps-main-graph', 'hoverData')])(self.update_pop_timeseries)
-            #dash.dependencies.Input('wps-crossfilter-xaxis-type', 'value')])(self.update_pop_timeseries)
+    def create_main_graph(self):
+        import plotly.express as px  # import lent, fait seulement si le snapshot n'est pas à jour
+
+        fig = px.scatter(self.df, x='Revenus', y="Nb d'enfants par femme", color="Continent",
+                         hover_name="Nom",
+                         hover_data = {'Année':True, 'Revenus':":.2f", "Nb d'enfants par femme":":.1f", \
+                                       'Continent':False, 'Population':':.2f'},
+                         color_discrete_map=self.continent_colors,
+                         # title="Évolution du taux de fertilité vs le revenu moyen par pays",
+                         labels={'Revenus':"Revenus nets par personne",
+                                 "Population":"Population (millions)"},
+                         size = 'Population',  size_max=60,
+                         animation_frame=self.df["Année"], animation_group=self.df['Nom'],
+                         range_x=[10, self.df["Revenus"].max()], log_x = True,
+                         range_y=[0, int(self.df["Nb d'enfants par femme"].max()) + 1],
+                         # height = 600,  # j'aimerais mettre un % de la hauteur comme '40vh' 
+                        )
+        return fig.to_dict()
 
     # graph incomes vs years
 
@@ -142,19 +156,37 @@ class WorldPopulationStats():
     def country_chosen(self, hoverData):
         return self.get_country(hoverData)
 
-    # graph incomes vs years
+    # Les graphiques ne dépendent que du pays : le survol, avec ses coordonnées et sa bbox en pixels,
+    # est d'abord réduit au pays pour que la clé du cache soit le pays.
+
+    @needs_data
     def update_income_timeseries(self, hover_data):
-        country = self.get_country(hover_data)
+        return self.income_timeseries(self.get_country(hover_data))
+
+    @needs_data
+    def update_fertility_timeseries(self, hover_data):
+        return self.fertility_timeseries(self.get_country(hover_data))
+
+    @needs_data
+    def update_pop_timeseries(self, hover_data):
+        return self.pop_timeseries(self.get_country(hover_data))
+
+    # graph incomes vs years
+    @cached_figure
+    @needs_data
+    def income_timeseries(self, country):
         return self.create_time_series(country, 'Revenus', 'log', 'PIB par personne (US $ 2020)', maxy = np.log10(self.max_incomes))
 
     # graph children vs years
-    def update_fertility_timeseries(self, hover_data):
-        country = self.get_country(hover_data) 
+    @cached_figure
+    @needs_data
+    def fertility_timeseries(self, country):
         return self.create_time_series(country, "Nb d'enfants par femme", 'linear', "Nombre d'enfants par femme", maxy=self.max_childs)
 
-    # graph population vs years self.get_country(hover_data)
-    def update_pop_timeseries(self, hover_data):
-        country = self.get_country(hover_data) 
+    # graph population vs years
+    @cached_figure
+    @needs_data
+    def pop_timeseries(self, country):
         return self.create_time_series(country, 'Population', 'linear', 'Population (millions)')
 
     def run(self, debug=False, port=8050):